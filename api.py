@@ -0,0 +1,104 @@
+"""Streaming JSON message lists for Warbler's API routes.
+
+A list is read with a server-side cursor (yield_per), hydrated a batch at a
+time, and written to the response as it goes, so a large export holds one
+batch in memory rather than the whole list. Lists page with the same
+cursors as the HTML pages; the cursor for the next page comes last:
+
+    {"messages": [{"id": 1, "text": ..., "user": {...}, ...}, ...],
+     "next_cursor": "MjAxNy0wMS0yMVQxMTowNDo1My41MjI4MDd8NDI"}
+
+next_cursor is null on the last page.
+"""
+
+import json
+from itertools import islice
+
+from flask import Response, abort, current_app, request, stream_with_context
+
+from feed import hydrate
+from pagination import encode_cursor, keyset
+
+# rows fetched from the cursor, and hydrated, at a time
+BATCH_SIZE = 500
+
+
+def message_json(view):
+    """A MessageView as a JSON-able dict."""
+
+    return {
+        'id': view.id,
+        'text': view.text,
+        'timestamp': view.timestamp.isoformat(),
+        'user': {
+            'id': view.user.id,
+            'username': view.user.username,
+            'image_url': view.user.image_url,
+        },
+        'likes_count': view.likes_count,
+        'liked': view.liked,
+    }
+
+
+def page_limit():
+    """The `limit` query arg: messages per page, up to API_MAX_LIMIT.
+
+    Aborts with 400 if it's out of range.
+    """
+
+    limit = request.args.get(
+        'limit', current_app.config['MESSAGES_PER_PAGE'], type=int)
+
+    if not 1 <= limit <= current_app.config['API_MAX_LIMIT']:
+        abort(400)
+
+    return limit
+
+
+def stream_messages(query, columns, viewer_id):
+    """Stream a page of `query`'s messages, ordered by `columns`, as JSON.
+
+    `query` selects the message id first, then the `columns` sort key,
+    e.g. (TimelineEntry.timestamp, TimelineEntry.message_id). The page
+    starts after the request's `cursor` and holds up to `limit` messages;
+    like state is `viewer_id`'s.
+    """
+
+    limit = page_limit()
+    query = (keyset(query, columns, request.args.get('cursor'))
+             .limit(limit + 1)
+             .yield_per(BATCH_SIZE))
+
+    def generate():
+        yield '{"messages": ['
+
+        rows = iter(query)
+        sent = 0
+        more = False
+        last = None
+        separator = ''
+
+        for batch in iter(lambda: list(islice(rows, BATCH_SIZE)), []):
+            # the query reads one row past the page, to tell if there's
+            # another page
+            if sent + len(batch) > limit:
+                batch = batch[:limit - sent]
+                more = True
+
+            for view in hydrate((row[0] for row in batch), viewer_id):
+                yield separator + json.dumps(message_json(view))
+                separator = ', '
+
+            sent += len(batch)
+            if batch:
+                last = batch[-1]
+
+        next_cursor = None
+        if more:
+            next_cursor = encode_cursor(
+                tuple(getattr(last, column.key) for column in columns))
+
+        yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+
+    return Response(
+        stream_with_context(generate()), mimetype='application/json')
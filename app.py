@@ -1,12 +1,38 @@
 import os
+import click
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Flask, abort, jsonify, render_template, request, flash, redirect, session,
+    g)
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
 
+from api import stream_messages
+from feed import hydrate, hydrate_page
+from follow_graph import follow_graph, init_follow_graph
 from forms import EditUserForm, UserAddForm, LoginForm, MessageForm, CSRFProtectForm
-from models import LikedMessage, db, connect_db, User, Message
+from fragments import init_fragments, invalidate_message
+from hashing import HasherBusy
+from hashtags import init_hashtags
+from http_cache import init_http_cache, request_is_fresh, set_cache_headers
+from instrumentation import init_instrumentation
+from jobs import enqueue, run_worker
+from likes import init_likes, set_like
+from loader import CHUNK_SIZE, load_csvs
+from merge_feed import (
+    init_merge_feed, merged_page, message_added, message_deleted)
+from models import (
+    CurrentUser, Follows, FollowSuggestion, LikedMessage, LikeRollup,
+    MessageTag, TagRollup, TimelineEntry, TimelineSize, db, connect_db,
+    current_user_cache, follow_cache, User, Message)
+from pagination import paginate
+from purge import delete_account, purge_deleted
+from routing import init_replica_routing
+from search import search_users, username_index
+from suggestions import suggest_follows
+import tasks  # registers the job handlers
 
 load_dotenv()
 
@@ -20,11 +46,118 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ['DATABASE_URL'].replace("postgres://", "postgresql://"))
 app.config['SQLALCHEMY_ECHO'] = False
+# optional read replicas (comma-separated URLs) for GET requests' reads, and
+# how many seconds a user's reads stay on the primary after they POST
+app.config['SQLALCHEMY_REPLICA_URIS'] = [
+    url.strip().replace("postgres://", "postgresql://")
+    for url in os.environ.get('REPLICA_DATABASE_URLS', '').split(',')
+    if url.strip()]
+app.config['REPLICA_STICKY_SECONDS'] = int(
+    os.environ.get('REPLICA_STICKY_SECONDS', 10))
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+# newest messages kept in each user's home timeline, and how many more it
+# may grow by before `flask trim-timelines` cuts it back
+app.config['TIMELINE_LENGTH'] = int(os.environ.get('TIMELINE_LENGTH', 800))
+app.config['TIMELINE_SLACK'] = int(os.environ.get('TIMELINE_SLACK', 200))
+app.config['MESSAGES_PER_PAGE'] = 50
+app.config['USERS_PER_PAGE'] = 30
+# most messages one API request may ask for; they're streamed, so this can
+# be large enough for exports
+app.config['API_MAX_LIMIT'] = int(os.environ.get('API_MAX_LIMIT', 100000))
+# users whose follow sets are cached per process (0 disables), and for how
+# many seconds
+app.config['FOLLOW_CACHE_SIZE'] = int(os.environ.get('FOLLOW_CACHE_SIZE', 0))
+app.config['FOLLOW_CACHE_TTL'] = int(os.environ.get('FOLLOW_CACHE_TTL', 60))
+# bcrypt work factor, and the process pool that runs it: how many workers
+# (0 hashes inline), how many more calls may queue before new ones get a
+# 503, and how many seconds one may take
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['HASH_WORKERS'] = int(os.environ.get('HASH_WORKERS', 2))
+app.config['HASH_QUEUE_DEPTH'] = int(os.environ.get('HASH_QUEUE_DEPTH', 8))
+app.config['HASH_TIMEOUT'] = 10
+# logged-in users whose profile fields are cached per process, and for how
+# many seconds; edits made through another worker show up after the TTL
+app.config['CURRENT_USER_CACHE_SIZE'] = int(
+    os.environ.get('CURRENT_USER_CACHE_SIZE', 1024))
+app.config['CURRENT_USER_CACHE_TTL'] = int(
+    os.environ.get('CURRENT_USER_CACHE_TTL', 30))
+# count and time each request's SQL, and warn when one statement shape runs
+# more than this many times in a request (likely an N+1)
+app.config['SQL_INSTRUMENTATION'] = (
+    os.environ.get('SQL_INSTRUMENTATION', '1') == '1')
+app.config['SQL_REPEAT_WARNING'] = int(
+    os.environ.get('SQL_REPEAT_WARNING', 10))
+# rendered message list items cached per process (0 disables), or in Redis
+# if FRAGMENT_CACHE_URL is set, for this many seconds
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['FRAGMENT_CACHE_URL'] = os.environ.get('FRAGMENT_CACHE_URL')
+app.config['FRAGMENT_CACHE_TTL'] = int(
+    os.environ.get('FRAGMENT_CACHE_TTL', 3600))
+# seconds likes wait in memory, merged per user and message, before being
+# written in a batch (0 writes them at once), and how many may wait
+app.config['LIKE_BUFFER_SECONDS'] = float(
+    os.environ.get('LIKE_BUFFER_SECONDS', 0))
+app.config['LIKE_BUFFER_SIZE'] = int(os.environ.get('LIKE_BUFFER_SIZE', 1000))
+# messages on the most-liked leaderboard, and seconds each window's ranking
+# is cached per process (0 reads the rollups every time)
+app.config['LEADERBOARD_SIZE'] = 50
+app.config['LEADERBOARD_CACHE_TTL'] = int(
+    os.environ.get('LEADERBOARD_CACHE_TTL', 60))
+# tags listed as trending, and seconds each window's ranking is cached per
+# process (0 reads the rollups every time)
+app.config['TRENDING_SIZE'] = 20
+app.config['TRENDING_CACHE_TTL'] = int(
+    os.environ.get('TRENDING_CACHE_TTL', 60))
+# deleted accounts with more rows than this (messages, follows, likes) are
+# purged on a background thread; rows deleted per batch while purging
+app.config['ACCOUNT_PURGE_THRESHOLD'] = int(
+    os.environ.get('ACCOUNT_PURGE_THRESHOLD', 10000))
+app.config['PURGE_BATCH_SIZE'] = int(os.environ.get('PURGE_BATCH_SIZE', 1000))
+# directory holding the memory-mapped follow graph snapshot and its log,
+# shared by the workers on a machine (unset: follow lookups query the
+# database); see follow_graph.py
+app.config['FOLLOW_GRAPH_DIR'] = os.environ.get('FOLLOW_GRAPH_DIR')
+# how home feeds are built: "timeline" reads the materialized timelines,
+# "merge" merges per-author recent-message lists at read time (see
+# merge_feed.py); the lists hold this many messages, for this many authors
+# per process, for this many seconds
+app.config['FEED_STRATEGY'] = os.environ.get('FEED_STRATEGY', 'timeline')
+app.config['AUTHOR_RECENT_LENGTH'] = int(
+    os.environ.get('AUTHOR_RECENT_LENGTH', 200))
+app.config['RECENT_CACHE_SIZE'] = int(
+    os.environ.get('RECENT_CACHE_SIZE', 2000))
+app.config['RECENT_CACHE_TTL'] = int(os.environ.get('RECENT_CACHE_TTL', 60))
+# run follow-on work (timeline fan-out and backfill, account purges) within
+# the request, or, with JOBS_EAGER=0, queue it for `flask worker` (see
+# jobs.py); seconds a worker may hold a job before it's taken to have died,
+# seconds before the first retry of a failed job (doubling after each), and
+# attempts before it's given up on
+app.config['JOBS_EAGER'] = os.environ.get('JOBS_EAGER', '1') == '1'
+app.config['JOB_LEASE_SECONDS'] = int(
+    os.environ.get('JOB_LEASE_SECONDS', 300))
+app.config['JOB_RETRY_SECONDS'] = int(
+    os.environ.get('JOB_RETRY_SECONDS', 10))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+# who-to-follow suggestions kept per user by `flask suggest-follows`, how
+# many the home page shows, and how many users' scores are worked out at
+# once (more is faster but takes more memory; see suggestions.py)
+app.config['SUGGESTIONS_PER_USER'] = 20
+app.config['SUGGESTIONS_SHOWN'] = 5
+app.config['SUGGESTION_BLOCK_SIZE'] = int(
+    os.environ.get('SUGGESTION_BLOCK_SIZE', 10000))
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+init_instrumentation(app)
+init_fragments(app)
+init_http_cache(app)
+init_replica_routing(app)
+init_likes(app)
+init_follow_graph(app)
+init_merge_feed(app)
+init_hashtags(app)
 
 
 ##############################################################################
@@ -34,10 +167,14 @@ connect_db(app)
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global, and instantiate
-    CSRF Protection form"""
+    CSRF Protection form
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.user is a CurrentUser served from a per-process cache; static files
+    don't need a user at all.
+    """
+
+    if CURR_USER_KEY in session and request.endpoint != 'static':
+        g.user = CurrentUser.load(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -85,6 +222,7 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            username_index.invalidate()
 
         except IntegrityError:
             flash("Username already taken", 'danger')
@@ -110,6 +248,8 @@ def login():
             form.password.data)
 
         if user:
+            # saves the password hash if authenticate upgraded it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -140,7 +280,8 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username; matches
+    are ranked exact, then prefix, then substring. Shown a page at a time.
     """
 
     if not g.user:
@@ -148,13 +289,17 @@ def list_users():
         return redirect("/")
 
     search = request.args.get('q')
+    cursor = request.args.get('cursor')
 
     if not search:
-        users = User.query.all()
+        users = paginate(
+            User.active(), (User.id,), app.config['USERS_PER_PAGE'], cursor)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = search_users(search, app.config['USERS_PER_PAGE'], cursor)
 
-    return render_template('users/index.html', users=users)
+    return render_template(
+        'users/index.html', users=users,
+        followed_ids=g.user.followed_among(user.id for user in users))
 
 
 @app.get('/users/<int:user_id>')
@@ -165,8 +310,20 @@ def show_user(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/show.html', user=user)
+    user = User.get_active_or_404(user_id)
+
+    if request_is_fresh([g.user, user], request.args.get('cursor')):
+        return '', 304
+
+    messages = hydrate_page(paginate(
+        db.session
+        .query(Message.id, Message.timestamp)
+        .filter(Message.user_id == user.id),
+        (Message.timestamp, Message.id),
+        app.config['MESSAGES_PER_PAGE'],
+        request.args.get('cursor')), g.user.id)
+
+    return render_template('users/show.html', user=user, messages=messages)
 
 
 @app.get('/users/<int:user_id>/following')
@@ -177,8 +334,24 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.get_active_or_404(user_id)
+    following = paginate(
+        User.active()
+        .join(Follows, Follows.user_being_followed_id == User.id)
+        .filter(Follows.user_following_id == user.id),
+        (Follows.user_being_followed_id,),
+        app.config['USERS_PER_PAGE'],
+        request.args.get('cursor'),
+        key=lambda u: (u.id,))
+
+    if request_is_fresh([g.user, user, *following],
+                        request.args.get('cursor')):
+        return '', 304
+
+    return render_template(
+        'users/following.html', user=user, following=following,
+        followed_ids=g.user.followed_among(
+            followed.id for followed in following))
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -189,8 +362,24 @@ def show_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.get_active_or_404(user_id)
+    followers = paginate(
+        User.active()
+        .join(Follows, Follows.user_following_id == User.id)
+        .filter(Follows.user_being_followed_id == user.id),
+        (Follows.user_following_id,),
+        app.config['USERS_PER_PAGE'],
+        request.args.get('cursor'),
+        key=lambda u: (u.id,))
+
+    if request_is_fresh([g.user, user, *followers],
+                        request.args.get('cursor')):
+        return '', 304
+
+    return render_template(
+        'users/followers.html', user=user, followers=followers,
+        followed_ids=g.user.followed_among(
+            follower.id for follower in followers))
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -205,9 +394,16 @@ def start_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    followed_user = User.get_active_or_404(follow_id)
+    db.session.add(Follows(
+        user_being_followed_id=followed_user.id,
+        user_following_id=g.user.id))
+    User.adjust_counts([g.user.id], following_count=1)
+    User.adjust_counts([followed_user.id], followers_count=1)
+    enqueue('backfill', {'user_id': g.user.id, 'author_id': followed_user.id})
     db.session.commit()
+    follow_cache.delete(g.user.id)
+    follow_graph.record([(g.user.id, followed_user.id, True)])
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -223,9 +419,20 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    followed_user = User.query.get_or_404(follow_id)
+    removed = (Follows.query
+               .filter_by(user_being_followed_id=followed_user.id,
+                          user_following_id=g.user.id)
+               .delete())
+
+    if removed:
+        User.adjust_counts([g.user.id], following_count=-1)
+        User.adjust_counts([followed_user.id], followers_count=-1)
+        TimelineEntry.remove_author(g.user.id, followed_user.id)
+
     db.session.commit()
+    follow_cache.delete(g.user.id)
+    follow_graph.record([(g.user.id, followed_user.id, False)])
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -238,24 +445,27 @@ def profile():
         flash("Access unauthorized.", "danger")
         return redirect("/login")
 
-    form = EditUserForm(obj = g.user)
+    user = g.user.model
+    form = EditUserForm(obj = user)
 
     if form.validate_on_submit():
-        g.user.username = form.username.data
-        g.user.email = form.email.data
-        g.user.image_url = form.image_url.data
-        g.user.header_image_url = form.header_image_url.data
-        g.user.bio = form.bio.data
-        password = form.password.data
-
-        if not User.authenticate(g.user.username, password):
-            form = EditUserForm(obj = g.user)
+        if not user.check_password(form.password.data):
+            form = EditUserForm(obj = user)
             flash("Access unauthorized.", "danger")
             return render_template('users/edit.html', form = form)
         else:
+            user.username = form.username.data
+            user.email = form.email.data
+            user.image_url = form.image_url.data
+            user.header_image_url = form.header_image_url.data
+            user.bio = form.bio.data
+            user.profile_version = User.profile_version + 1
+            User.touch([user.id])
             db.session.commit()
-            flash(f'{g.user.username} has been updated!')
-            return redirect(f'/users/{g.user.id}')
+            current_user_cache.delete(user.id)
+            username_index.invalidate()
+            flash(f'{user.username} has been updated!')
+            return redirect(f'/users/{user.id}')
 
     else:
         return render_template('users/edit.html', form = form)
@@ -278,8 +488,9 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
-    db.session.commit()
+    # soft-deleted at once; the rows go in batches, in a job or thread for
+    # big accounts (see purge.py)
+    delete_account(g.user.model)
 
     return redirect("/signup")
 
@@ -291,8 +502,16 @@ def show_liked_messages(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/like.html', user=user)
+    user = User.get_active_or_404(user_id)
+    messages = hydrate_page(paginate(
+        db.session
+        .query(LikedMessage.message_id)
+        .filter(LikedMessage.user_id == user.id),
+        (LikedMessage.message_id,),
+        app.config['MESSAGES_PER_PAGE'],
+        request.args.get('cursor')), g.user.id)
+
+    return render_template('users/like.html', user=user, messages=messages)
 
 
 
@@ -314,15 +533,87 @@ def add_message():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        User.adjust_counts([g.user.id], messages_count=1)
+        MessageTag.index(msg)
+        enqueue('fan_out', {'message_id': msg.id})
         db.session.commit()
+        message_added(msg)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/create.html', form=form)
 
 
+@app.get('/messages/top')
+def top_messages():
+    """Show the most liked messages of the last 24 hours or 7 days.
+
+    Ranked from the hourly like rollups; `window` is 24h (the default)
+    or 7d.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    window = request.args.get('window', '24h')
+
+    if window not in LikeRollup.WINDOWS:
+        abort(404)
+
+    top = LikeRollup.leaderboard(window)
+    messages = hydrate((message_id for message_id, _ in top), g.user.id)
+
+    return render_template(
+        'messages/top.html', messages=messages, window=window,
+        windows=LikeRollup.WINDOWS)
+
+
+@app.get('/tags')
+def trending_tags():
+    """Show the most used hashtags of the last 24 hours or 7 days.
+
+    Ranked from the hourly tag rollups; `window` is 24h (the default) or
+    7d.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    window = request.args.get('window', '24h')
+
+    if window not in TagRollup.WINDOWS:
+        abort(404)
+
+    return render_template(
+        'tags/trending.html', tags=TagRollup.trending(window),
+        window=window, windows=TagRollup.WINDOWS)
+
+
+@app.get('/tags/<tag>')
+def show_tag(tag):
+    """Show the messages tagged #`tag`, newest first, a page at a time."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    tag = tag.lower()
+    messages = hydrate_page(paginate(
+        db.session
+        .query(MessageTag.message_id, MessageTag.timestamp)
+        .filter(MessageTag.tag == tag),
+        (MessageTag.timestamp, MessageTag.message_id),
+        app.config['MESSAGES_PER_PAGE'],
+        request.args.get('cursor')), g.user.id)
+
+    return render_template('tags/show.html', tag=tag, messages=messages)
+
+
 @app.get('/messages/<int:message_id>')
 def show_message(message_id):
     """Show a message."""
@@ -331,15 +622,28 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    author = (User.active()
+              .join(Message, Message.user_id == User.id)
+              .filter(Message.id == message_id)
+              .first_or_404())
+
+    if request_is_fresh([g.user, author], message_id):
+        return '', 304
+
+    views = hydrate([message_id], g.user.id)
+
+    if not views:
+        abort(404)
+
+    return render_template('messages/show.html', message=views[0])
 
 
 @app.post('/messages/<int:message_id>/like')
 def like_message(message_id):
     """Like a message.
 
-    Adds message to liked_messages list for g.user
+    Adds message to liked_messages list for g.user; liking it again does
+    nothing.
     """
     if not g.user:
         flash("Access unauthorized.", "danger")
@@ -347,21 +651,19 @@ def like_message(message_id):
     form = g.csrf_form
 
     if form.validate_on_submit():
-
-        msg = LikedMessage(user_id = g.user.id, message_id = message_id)
-        db.session.add(msg)
+        set_like(g.user.id, message_id, True)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
 
-# can consolidate add/delete msg
-# if in, pop, if not append
+    return redirect(request.referrer or "/")
+
 
 @app.post('/messages/<int:message_id>/unlike')
 def unlike_message(message_id):
     """Unlike a message.
 
-    Removes message from liked_messages list for g.user
+    Removes message from liked_messages list for g.user, if it's there.
     """
 
     if not g.user:
@@ -371,14 +673,44 @@ def unlike_message(message_id):
     form = g.csrf_form
 
     if form.validate_on_submit():
-
-        LikedMessage.query.filter(
-                    LikedMessage.message_id == message_id,
-                    LikedMessage.user_id == g.user.id).delete()
+        set_like(g.user.id, message_id, False)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
 
+    return redirect(request.referrer or "/")
+
+
+@app.post('/messages/<int:message_id>/toggle-like')
+def toggle_like(message_id):
+    """Like or unlike a message, answering with JSON instead of a page.
+
+    The form's `liked` field ("true" or "false") says which, so repeating
+    a request is harmless; without it, the like is flipped.
+    Returns {"liked": ..., "likes_count": ...}.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    if not g.csrf_form.validate_on_submit():
+        return jsonify(error="Invalid CSRF token."), 400
+
+    views = hydrate([message_id], g.user.id)
+
+    if not views:
+        return jsonify(error="No such message."), 404
+
+    liked = request.form.get('liked')
+    liked = not views[0].liked if liked is None else liked == 'true'
+
+    set_like(g.user.id, message_id, liked)
+    db.session.commit()
+
+    view = hydrate([message_id], g.user.id)[0]
+
+    return jsonify(liked=view.liked, likes_count=view.likes_count)
+
 
 @app.post('/messages/<int:message_id>/delete')
 def delete_message(message_id):
@@ -394,12 +726,73 @@ def delete_message(message_id):
         return redirect("/")
 
     # msg = Message.query.get_or_404(message_id)
+    User.adjust_counts(
+        select(LikedMessage.user_id)
+        .where(LikedMessage.message_id == msg.id),
+        likes_count=-1)
+    User.adjust_counts([msg.user_id], messages_count=-1)
+    MessageTag.unindex([msg.id])
     db.session.delete(msg)
     db.session.commit()
+    invalidate_message(message_id, g.user.id, g.user.profile_version)
+    message_deleted(g.user.id, message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# JSON API routes: the home timeline, a user's messages and a user's likes,
+# for the logged-in user, streamed a page at a time (see api.py)
+
+@app.get('/api/timeline')
+def api_timeline():
+    """The logged-in user's home timeline, newest first."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    return stream_messages(
+        db.session
+        .query(TimelineEntry.message_id, TimelineEntry.timestamp)
+        .filter(TimelineEntry.user_id == g.user.id),
+        (TimelineEntry.timestamp, TimelineEntry.message_id),
+        g.user.id)
+
+
+@app.get('/api/users/<int:user_id>/messages')
+def api_user_messages(user_id):
+    """A user's messages, newest first."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    user = User.get_active_or_404(user_id)
+
+    return stream_messages(
+        db.session
+        .query(Message.id, Message.timestamp)
+        .filter(Message.user_id == user.id),
+        (Message.timestamp, Message.id),
+        g.user.id)
+
+
+@app.get('/api/users/<int:user_id>/likes')
+def api_user_likes(user_id):
+    """The messages a user has liked, newest message first."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    user = User.get_active_or_404(user_id)
+
+    return stream_messages(
+        db.session
+        .query(LikedMessage.message_id)
+        .filter(LikedMessage.user_id == user.id),
+        (LikedMessage.message_id,),
+        g.user.id)
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -409,35 +802,175 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time,
+      read from the user's materialized timeline, or merged from the
+      authors' recent messages if FEED_STRATEGY is "merge"; and, on the
+      first page, who to follow
     """
 
-    if g.user:
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(
-                        [u.id for u in g.user.following] + [g.user.id]))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages)
+    if not g.user:
+        return render_template('home-anon.html')
 
+    if app.config['FEED_STRATEGY'] == 'merge':
+        page = merged_page(
+            g.user.following_ids() | {g.user.id},
+            app.config['MESSAGES_PER_PAGE'],
+            request.args.get('cursor'))
     else:
-        return render_template('home-anon.html')
+        page = paginate(
+            db.session
+            .query(TimelineEntry.message_id, TimelineEntry.timestamp)
+            .filter(TimelineEntry.user_id == g.user.id),
+            (TimelineEntry.timestamp, TimelineEntry.message_id),
+            app.config['MESSAGES_PER_PAGE'],
+            request.args.get('cursor'))
+
+    messages = hydrate_page(page, g.user.id)
+    suggestions = []
+
+    if not request.args.get('cursor'):
+        suggestions = FollowSuggestion.for_user(
+            g.user.id, app.config['SUGGESTIONS_SHOWN'])
+
+    return render_template(
+        'home.html', messages=messages, suggestions=suggestions)
+
+
+@app.errorhandler(HasherBusy)
+def hasher_busy(error):
+    """Shed login/signup load when the password hashing queue is full."""
+
+    return ("Warbler is busy, please try again in a moment.", 503,
+            {'Retry-After': '1'})
+
+
+##############################################################################
+# Maintenance commands
+
+# timelines trimmed per transaction by trim-timelines
+TRIM_BATCH_SIZE = 1000
+
+
+@app.cli.command('recount')
+def recount():
+    """Recompute every user's message, follow and like counts, every
+    message's like count, the timeline sizes trim-timelines goes by, and
+    the leaderboard and trending rollups.
+
+    Run as `flask recount` after bulk loads or if the counts drift.
+    """
+
+    User.recount()
+    Message.recount_likes()
+    TimelineSize.rebuild()
+    LikeRollup.rebuild()
+    TagRollup.rebuild()
+    db.session.commit()
+    print("Recounted users, messages, timelines and tags.")
+
+
+@app.cli.command('prune-rollups')
+def prune_rollups():
+    """Delete like and tag rollup buckets too old for any window.
+
+    Run as `flask prune-rollups`, e.g. hourly from cron.
+    """
+
+    pruned = LikeRollup.prune() + TagRollup.prune()
+    db.session.commit()
+    print(f"Pruned {pruned} rollup buckets.")
+
+
+@app.cli.command('trim-timelines')
+def trim_timelines():
+    """Cut home timelines that have grown past TIMELINE_LENGTH +
+    TIMELINE_SLACK back to TIMELINE_LENGTH.
+
+    Run as `flask trim-timelines`, e.g. hourly from cron.
+    """
+
+    user_ids = TimelineEntry.overgrown()
+    deleted = 0
+
+    for start in range(0, len(user_ids), TRIM_BATCH_SIZE):
+        deleted += TimelineEntry.trim(
+            user_ids[start:start + TRIM_BATCH_SIZE])
+        db.session.commit()
+
+    print(f"Trimmed {deleted} entries from {len(user_ids)} timelines.")
+
+
+@app.cli.command('purge-deleted')
+def purge_deleted_users():
+    """Finish purging deleted accounts, e.g. after a worker died mid-purge.
+
+    Run as `flask purge-deleted`.
+    """
+
+    print(f"Purged {purge_deleted()} deleted users.")
+
+
+@app.cli.command('compact-follow-graph')
+def compact_follow_graph():
+    """Rebuild the follow graph snapshot in FOLLOW_GRAPH_DIR.
+
+    Run as `flask compact-follow-graph`, e.g. from cron, to fold the log of
+    follows since the last snapshot into a new one.
+    """
+
+    if follow_graph.directory is None:
+        raise click.UsageError("FOLLOW_GRAPH_DIR isn't set.")
+
+    Follows.compact_graph()
+    print(f"Compacted the follow graph in {follow_graph.directory}.")
+
+
+@app.cli.command('suggest-follows')
+def suggest_follows_command():
+    """Rescore everyone's who-to-follow suggestions.
+
+    Run as `flask suggest-follows`, e.g. nightly from cron.
+    """
+
+    suggest_follows()
+
+
+@app.cli.command('worker')
+@click.option('--once', is_flag=True,
+              help="Exit when no jobs are left to run.")
+@click.option('--poll', default=1.0, show_default=True,
+              help="Seconds to wait between checks for new jobs.")
+def worker(once, poll):
+    """Run queued jobs (see jobs.py).
+
+    Run as `flask worker`, as many as needed; needs JOBS_EAGER=0 in the web
+    processes to have anything to do.
+    """
+
+    run_worker(once=once, poll=poll)
+
+
+@app.cli.command('load')
+@click.argument('directory', default='generator')
+@click.option('--drop', is_flag=True,
+              help="Drop and recreate all tables before loading.")
+@click.option('--chunk-size', default=CHUNK_SIZE, show_default=True,
+              help="Rows sent to the database per batch.")
+def load(directory, drop, chunk_size):
+    """Bulk load users/messages/follows/likes CSVs from DIRECTORY.
+
+    Run as `flask load path/to/csvs`; prints rows/sec for each table.
+    """
+
+    load_csvs(directory, drop=drop, chunk_size=chunk_size)
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Caching headers: fingerprinted static files are cached for good, pages with
+# validators are revalidated, and nothing else is stored (see http_cache.py)
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add caching headers on every request."""
 
-    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
-    return response
+    return set_cache_headers(response)
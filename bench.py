@@ -0,0 +1,283 @@
+"""Per-route benchmarks for Warbler.
+
+Seeds a database with a generated dataset, requests every route through
+the Flask test client as a logged-in user, and records latency percentiles
+and SQL statement counts per route as JSON:
+
+    python bench.py run --users 10000 --messages 100000 --out before.json
+    ... change things ...
+    python bench.py run --users 10000 --messages 100000 --out after.json
+    python bench.py compare before.json after.json
+
+compare exits non-zero if any route got slower than --threshold times its
+old median latency, or runs more SQL statements than before.
+
+The database is --database-url, by default a SQLite file; point it at a
+scratch PostgreSQL database to benchmark against production-like plans.
+It is dropped and reloaded on every run unless --no-seed is given.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from math import ceil
+from statistics import mean
+from time import perf_counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_DATABASE_URL = 'sqlite:///' + os.path.join(
+    tempfile.gettempdir(), 'warbler_bench.db')
+
+
+def percentile(values, p):
+    """The `p`th percentile of `values` (nearest rank)."""
+
+    ordered = sorted(values)
+    return ordered[max(0, ceil(p / 100 * len(ordered)) - 1)]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def seed(args):
+    """Generate a dataset of the requested size and load it."""
+
+    from loader import load_csvs
+
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run([
+            sys.executable, os.path.join(HERE, 'generator', 'create_csvs.py'),
+            '--users', str(args.users),
+            '--messages', str(args.messages),
+            '--follows', str(args.follows),
+            '--likes', str(args.likes),
+            '--seed', str(args.seed),
+            '--out', directory,
+        ], check=True, stdout=subprocess.DEVNULL)
+
+        load_csvs(directory, drop=True, echo=lambda line: None)
+
+
+def routes(profile, message, search):
+    """(name, method, url, form data) for every route to benchmark.
+
+    Write routes come in pairs (like/unlike, follow/unfollow) that leave
+    the data as they found it. The posted messages are tagged #benchmark,
+    so its tag page has messages once warmed up.
+    """
+
+    return [
+        ('home', 'GET', '/', None),
+        ('list_users', 'GET', '/users', None),
+        ('search_users', 'GET', f'/users?q={search}', None),
+        ('show_user', 'GET', f'/users/{profile}', None),
+        ('show_following', 'GET', f'/users/{profile}/following', None),
+        ('show_followers', 'GET', f'/users/{profile}/followers', None),
+        ('show_liked_messages', 'GET',
+         f'/users/{profile}/likedmessages', None),
+        ('show_message', 'GET', f'/messages/{message}', None),
+        ('top_messages', 'GET', '/messages/top?window=7d', None),
+        ('trending_tags', 'GET', '/tags?window=7d', None),
+        ('show_tag', 'GET', '/tags/benchmark', None),
+        ('api_timeline', 'GET', '/api/timeline', None),
+        ('api_user_messages', 'GET', f'/api/users/{profile}/messages', None),
+        ('api_user_likes', 'GET', f'/api/users/{profile}/likes', None),
+        ('new_message_form', 'GET', '/messages/new', None),
+        ('add_message', 'POST', '/messages/new',
+         {'text': 'benchmark #benchmark'}),
+        ('like_message', 'POST', f'/messages/{message}/like', None),
+        ('unlike_message', 'POST', f'/messages/{message}/unlike', None),
+        ('toggle_like_on', 'POST', f'/messages/{message}/toggle-like',
+         {'liked': 'true'}),
+        ('toggle_like_off', 'POST', f'/messages/{message}/toggle-like',
+         {'liked': 'false'}),
+        ('start_following', 'POST', f'/users/follow/{profile}', None),
+        ('stop_following', 'POST', f'/users/stop-following/{profile}', None),
+    ]
+
+
+def run(args):
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    # statement counts come from the SQL instrumentation
+    os.environ['SQL_INSTRUMENTATION'] = '1'
+    sys.path.insert(0, HERE)
+
+    from app import app, CURR_USER_KEY
+    from instrumentation import stats_listeners
+    from models import db, Follows, LikedMessage, Message, TimelineEntry, User
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+    if not args.no_seed:
+        seed(args)
+
+    # the busiest feed reader, looking at the most followed profile
+    viewer = User.query.order_by(User.following_count.desc()).first()
+    profile = User.query.order_by(User.followers_count.desc()).first()
+    message = (Message.query
+               .filter(Message.user_id != viewer.id)
+               .order_by(Message.id)
+               .first())
+    search = profile.username[:3]
+    viewer, profile, message = viewer.id, profile.id, message.id
+
+    # start from a state the write pairs can toggle
+    LikedMessage.query.filter_by(
+        user_id=viewer, message_id=message).delete()
+    Follows.query.filter_by(
+        user_following_id=viewer, user_being_followed_id=profile).delete()
+    TimelineEntry.remove_author(viewer, profile)
+    User.recount([viewer, profile])
+    db.session.commit()
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = viewer
+
+    bench_routes = routes(profile, message, search)
+    samples = {name: ([], []) for name, *_ in bench_routes}
+
+    # the final counts, streamed bodies included
+    counts = []
+    stats_listeners.append(lambda stats: counts.append(stats.count))
+
+    for iteration in range(args.warmup + args.requests):
+        # run the whole list each time so the write pairs stay paired
+        for name, method, url, data in bench_routes:
+            counts.clear()
+            start = perf_counter()
+            response = client.open(url, method=method, data=data)
+            # read streamed bodies through, and end them before the next
+            # request
+            response.get_data()
+            response.close()
+            elapsed = perf_counter() - start
+
+            if response.status_code >= 400:
+                raise SystemExit(
+                    f"{name}: {method} {url} -> {response.status_code}")
+
+            if iteration >= args.warmup:
+                samples[name][0].append(elapsed * 1000)
+                samples[name][1].append(counts[-1])
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'database': db.engine.dialect.name,
+            'python': platform.python_version(),
+            'dataset': {
+                'users': args.users,
+                'messages': args.messages,
+                'follows': args.follows,
+                'likes': args.likes,
+                'seed': args.seed,
+            },
+            'requests': args.requests,
+        },
+        'routes': {
+            name: {
+                'p50_ms': round(percentile(latencies, 50), 3),
+                'p90_ms': round(percentile(latencies, 90), 3),
+                'p99_ms': round(percentile(latencies, 99), 3),
+                'mean_ms': round(mean(latencies), 3),
+                'max_ms': round(max(latencies), 3),
+                'statements': percentile(counts, 50),
+                'max_statements': max(counts),
+            }
+            for name, (latencies, counts) in samples.items()
+        },
+    }
+
+    with open(args.out, 'w') as file:
+        json.dump(results, file, indent=2)
+
+    print(f"{'route':<22}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"
+          f"{'queries':>9}")
+    for name, result in results['routes'].items():
+        print(f"{name:<22}{result['p50_ms']:>10.2f}{result['p90_ms']:>10.2f}"
+              f"{result['p99_ms']:>10.2f}{result['statements']:>9}")
+    print(f"wrote {args.out}")
+
+
+def compare(args):
+    with open(args.old) as file:
+        old = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+
+    regressions = 0
+
+    print(f"{'route':<22}{'old p50':>10}{'new p50':>10}{'ratio':>8}"
+          f"{'queries':>12}")
+
+    for name, result in new['routes'].items():
+        before = old['routes'].get(name)
+
+        if before is None:
+            print(f"{name:<22}{'':>10}{result['p50_ms']:>10.2f}  (new)")
+            continue
+
+        ratio = result['p50_ms'] / (before['p50_ms'] or 1e-9)
+        queries = f"{before['statements']}->{result['statements']}"
+        slower = ratio > args.threshold
+        more_queries = result['statements'] > before['statements']
+        flag = "  REGRESSION" if slower or more_queries else ""
+        regressions += bool(flag)
+
+        print(f"{name:<22}{before['p50_ms']:>10.2f}{result['p50_ms']:>10.2f}"
+              f"{ratio:>8.2f}{queries:>12}{flag}")
+
+    if regressions:
+        raise SystemExit(f"{regressions} route(s) regressed")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Per-route benchmarks for Warbler.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="benchmark every route")
+    run_parser.add_argument('--database-url', default=DEFAULT_DATABASE_URL)
+    run_parser.add_argument('--users', type=int, default=1000)
+    run_parser.add_argument('--messages', type=int, default=10000)
+    run_parser.add_argument('--follows', type=int, default=20000)
+    run_parser.add_argument('--likes', type=int, default=10000)
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--requests', type=int, default=30,
+                            help="timed requests per route")
+    run_parser.add_argument('--warmup', type=int, default=3,
+                            help="untimed requests per route first")
+    run_parser.add_argument('--no-seed', action='store_true',
+                            help="reuse the data already in the database")
+    run_parser.add_argument('--out', default='bench_results.json')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser(
+        'compare', help="compare two results files")
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=1.25,
+                                help="slowdown ratio that counts as a "
+                                     "regression")
+    compare_parser.set_defaults(func=compare)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    args.func(args)
@@ -0,0 +1,116 @@
+"""In-process caches for Warbler.
+
+These live in a single worker process. Anything cached here can be stale in
+other workers until it expires, so entries should have a TTL unless every
+write path that changes them runs in-process.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class LRUCache:
+    """Bounded, thread-safe mapping with LRU eviction and an optional TTL.
+
+    A cache with max_size 0 is disabled: nothing is stored and every get
+    misses, so callers can use it unconditionally.
+    """
+
+    def __init__(self, max_size=1024, ttl=None):
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.configure(max_size, ttl)
+
+    def configure(self, max_size, ttl=None):
+        """Set the size bound and TTL in seconds, and empty the cache."""
+
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            self._entries.clear()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key, default=None):
+        """Return the value cached for `key`, or `default` if missing."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return default
+
+            value, expires = entry
+
+            if expires is not None and expires <= monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Cache `value` under `key`, evicting the least recently used."""
+
+        if not self.enabled:
+            return
+
+        expires = monotonic() + self.ttl if self.ttl else None
+
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        """Drop `keys` from the cache, if present."""
+
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache:
+    """Cache shared by every worker, kept in Redis.
+
+    Has LRUCache's interface, for string values, so it can stand in where
+    staleness across workers matters. Size is bounded by Redis's own
+    maxmemory policy. Needs the redis package, which isn't a requirement
+    otherwise.
+    """
+
+    def __init__(self, url, ttl=None, prefix='warbler:'):
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    enabled = True
+
+    def get(self, key, default=None):
+        value = self._client.get(f"{self.prefix}{key}")
+        return default if value is None else value.decode()
+
+    def set(self, key, value):
+        self._client.set(f"{self.prefix}{key}", value, ex=self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self._client.delete(*[f"{self.prefix}{key}" for key in keys])
+
+    def clear(self):
+        for key in self._client.scan_iter(f"{self.prefix}*"):
+            self._client.delete(key)
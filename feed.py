@@ -0,0 +1,95 @@
+"""Batched hydration of message lists for Warbler's templates.
+
+List routes page over message ids only, then hydrate() turns a page of ids
+into MessageView objects carrying everything the templates show: the
+message, its author's profile fields, how many users liked it (the
+messages' likes_count column), and whether the viewer did. That takes two
+queries however long the page is, where touching `msg.user` and the like
+state row by row took two per message.
+"""
+
+from likes import like_buffer
+from models import db, LikedMessage, Message, User
+
+
+class AuthorView:
+    """The profile fields of a message's author that templates show."""
+
+    __slots__ = ('id', 'username', 'image_url', 'profile_version')
+
+    def __init__(self, id, username, image_url, profile_version):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+        self.profile_version = profile_version
+
+
+class MessageView:
+    """A message as rendered in a list, with its author and like state."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'user', 'likes_count', 'liked')
+
+    def __init__(self, id, text, timestamp, user, likes_count=0,
+                 liked=False):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.user = user
+        self.likes_count = likes_count
+        self.liked = liked
+
+    @property
+    def user_id(self):
+        return self.user.id
+
+
+def hydrate(message_ids, viewer_id=None):
+    """Return MessageViews for `message_ids`, in the same order.
+
+    `viewer_id` is the user whose like state to fill in. Ids of messages
+    that no longer exist, or whose author is deleted, are skipped.
+    """
+
+    message_ids = list(message_ids)
+
+    if not message_ids:
+        return []
+
+    rows = (db.session
+            .query(Message.id, Message.text, Message.timestamp,
+                   Message.likes_count, User.id, User.username,
+                   User.image_url, User.profile_version)
+            .join(User, User.id == Message.user_id)
+            .filter(Message.id.in_(message_ids),
+                    User.deleted_at.is_(None)))
+
+    views = {
+        id: MessageView(id, text, timestamp, AuthorView(*author), likes_count)
+        for id, text, timestamp, likes_count, *author in rows}
+
+    if viewer_id is not None:
+        liked = (db.session
+                 .query(LikedMessage.message_id)
+                 .filter(LikedMessage.user_id == viewer_id,
+                         LikedMessage.message_id.in_(message_ids)))
+
+        for (message_id,) in liked:
+            if message_id in views:
+                views[message_id].liked = True
+
+        # the viewer's likes still waiting in the like buffer
+        for message_id, liked in like_buffer.pending_for(viewer_id).items():
+            view = views.get(message_id)
+
+            if view is not None and view.liked != liked:
+                view.liked = liked
+                view.likes_count += 1 if liked else -1
+
+    return [views[id] for id in message_ids if id in views]
+
+
+def hydrate_page(page, viewer_id=None):
+    """Replace a Page of rows led by message ids with their MessageViews."""
+
+    page.items = hydrate((row[0] for row in page), viewer_id)
+    return page
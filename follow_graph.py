@@ -0,0 +1,342 @@
+"""Shared, array-backed snapshot of the follow graph.
+
+With FOLLOW_GRAPH_DIR set, follow lookups (is-following checks, the ids a
+user follows, follower and following degrees) are answered from a CSR
+(compressed sparse row) adjacency of the follows table, held in both
+directions:
+
+    following: indptr[u]..indptr[u + 1] slices indices to the sorted ids
+               user u follows
+    followers: the same, for the ids following u
+
+That's 4 bytes per edge per direction plus 8 per user id. The arrays are
+.npy files opened with mmap_mode='r', so every worker on the machine
+shares one copy through the page cache, and a lookup is a searchsorted
+over one row, a few microseconds.
+
+Follows and unfollows made after the snapshot are appended to a log,
+fixed-size records written with O_APPEND so workers can write
+concurrently. Each worker replays new log records into a small in-memory
+overlay at the start of every request. compact() (run as `flask
+compact-follow-graph`, e.g. from cron) rebuilds the snapshot from the
+follows table and switches workers to it through the CURRENT file. Each
+snapshot starts a new log segment, and its meta.json lists the segments
+to replay: the previous one from where the snapshot was taken (workers
+that haven't switched yet still write there), then its own. The follows
+table stays the source of truth, and compaction also repairs any drift,
+e.g. from a worker dying between commit and log.
+
+compact() keeps the previous snapshot and its segment until the next
+compaction, for workers that read CURRENT just before it changed, and
+removes anything older.
+"""
+
+import json
+import os
+import shutil
+from threading import Lock
+from time import time_ns
+
+import numpy as np
+
+CURRENT = 'CURRENT'
+
+# the log segment written before the first snapshot
+FOLLOW_LOG = 'follows.log'
+
+# follower id, followed id, 1 for follow / 0 for unfollow
+RECORD = np.dtype([('follower', '<i4'), ('followed', '<i4'), ('op', '<i4')])
+
+DIRECTIONS = ('following', 'followers')
+
+
+def edge_arrays(edges):
+    """(follower ids, followed ids) arrays of `edges`, which yields lists
+    of (follower id, followed id) rows."""
+
+    pairs = np.concatenate(
+        [np.array(rows, dtype=np.int64).reshape(-1, 2) for rows in edges]
+        or [np.zeros((0, 2), dtype=np.int64)])
+
+    return pairs[:, 0], pairs[:, 1]
+
+
+class CSR:
+    """One direction of the graph: sorted neighbor ids per user id."""
+
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    def row(self, user_id):
+        if not 0 <= user_id < len(self.indptr) - 1:
+            return self.indices[:0]
+
+        return self.indices[self.indptr[user_id]:self.indptr[user_id + 1]]
+
+    def contains(self, user_id, other_id):
+        row = self.row(user_id)
+        i = np.searchsorted(row, other_id)
+        return bool(i < len(row) and row[i] == other_id)
+
+    @classmethod
+    def build(cls, sources, targets, size):
+        """CSR of the edges sources[i] -> targets[i], for ids below
+        `size`."""
+
+        order = np.lexsort((targets, sources))
+        indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=size), out=indptr[1:])
+
+        return cls(indptr, targets[order].astype(np.int32))
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32))
+
+
+class FollowGraph:
+    """The snapshot in `directory`, plus the log records since.
+
+    Disabled (every lookup must go to the database) until configured
+    with a directory that holds a snapshot.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.configure(None)
+
+    def configure(self, directory):
+        """Use the snapshot and log in `directory` (None disables)."""
+
+        with self._lock:
+            self.directory = directory
+            self._current = None
+            # [segment, offset] of the log to replay, the last one being
+            # the segment written to
+            self._log = [[FOLLOW_LOG, 0]]
+            self._graph = {direction: CSR.empty() for direction in DIRECTIONS}
+            # direction -> user id -> {other id: followed?}, for changes
+            # logged since the snapshot
+            self._overlay = {direction: {} for direction in DIRECTIONS}
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.refresh()
+
+    @property
+    def enabled(self):
+        return self._current is not None
+
+    def _path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def refresh(self):
+        """Switch to a newer snapshot if there is one, and replay new log
+        records."""
+
+        if self.directory is None:
+            return
+
+        with self._lock:
+            try:
+                with open(self._path(CURRENT)) as file:
+                    current = file.read().strip()
+            except FileNotFoundError:
+                return
+
+            if current != self._current:
+                self._load(current)
+
+            self._replay()
+
+    def _load(self, generation):
+        with open(self._path(generation, 'meta.json')) as file:
+            meta = json.load(file)
+
+        self._graph = {
+            direction: CSR(
+                np.load(self._path(generation, f'{direction}.indptr.npy'),
+                        mmap_mode='r'),
+                np.load(self._path(generation, f'{direction}.indices.npy'),
+                        mmap_mode='r'))
+            for direction in DIRECTIONS}
+        self._overlay = {direction: {} for direction in DIRECTIONS}
+        self._log = [list(position) for position in meta['log']]
+        self._current = generation
+
+    def _replay(self):
+        for position in self._log:
+            segment, offset = position
+
+            try:
+                with open(self._path(segment), 'rb') as file:
+                    file.seek(offset)
+                    data = file.read()
+            except FileNotFoundError:
+                continue
+
+            # a record being written right now is picked up next time
+            whole = len(data) - len(data) % RECORD.itemsize
+
+            for follower, followed, op in np.frombuffer(data[:whole],
+                                                        RECORD):
+                self._overlay['following'].setdefault(
+                    int(follower), {})[int(followed)] = bool(op)
+                self._overlay['followers'].setdefault(
+                    int(followed), {})[int(follower)] = bool(op)
+
+            position[1] += whole
+
+    def record(self, changes):
+        """Log `changes`, [(follower_id, followed_id, followed?)], made
+        after they're committed."""
+
+        if self.directory is None or not changes:
+            return
+
+        records = np.array(
+            [(follower, followed, int(op))
+             for follower, followed, op in changes], dtype=RECORD)
+
+        # write to the newest snapshot's segment
+        self.refresh()
+        segment = self._log[-1][0]
+
+        # one write per call, so concurrent writers' records don't interleave
+        fd = os.open(self._path(segment),
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, records.tobytes())
+        finally:
+            os.close(fd)
+
+        self.refresh()
+
+    def _changes(self, direction, user_id):
+        return self._overlay[direction].get(user_id, {})
+
+    def contains(self, direction, user_id, other_id):
+        """Is `other_id` among `user_id`'s neighbors in `direction`?"""
+
+        changed = self._changes(direction, user_id).get(other_id)
+
+        if changed is not None:
+            return changed
+
+        return self._graph[direction].contains(user_id, other_id)
+
+    def is_following(self, follower_id, followed_id):
+        return self.contains('following', follower_id, followed_id)
+
+    def neighbors(self, direction, user_id):
+        """Sorted array of `user_id`'s neighbor ids in `direction`."""
+
+        row = self._graph[direction].row(user_id)
+        changes = self._changes(direction, user_id)
+
+        if not changes:
+            return row
+
+        added = [id for id, followed in changes.items() if followed]
+        removed = [id for id, followed in changes.items() if not followed]
+
+        return np.setdiff1d(np.union1d(row, added), removed).astype(np.int32)
+
+    def following(self, user_id):
+        return self.neighbors('following', user_id)
+
+    def followers(self, user_id):
+        return self.neighbors('followers', user_id)
+
+    def degree(self, direction, user_id):
+        """How many neighbors `user_id` has in `direction`."""
+
+        csr = self._graph[direction]
+        degree = len(csr.row(user_id))
+
+        for other_id, followed in self._changes(direction, user_id).items():
+            degree += followed - csr.contains(user_id, other_id)
+
+        return degree
+
+    def compact(self, edges, size):
+        """Write a new snapshot of `edges`, and switch to it.
+
+        `edges` yields lists of (follower_id, followed_id) rows, e.g. one
+        per chunk read from the follows table, and `size` is one more than
+        the largest user id. The caller must start reading the edges after
+        this is called, so no follow is missed between the snapshot and
+        the log position it records.
+        """
+
+        self.refresh()
+        previous = self._current
+        previous_segment = self._log[-1][0]
+        log_offset = 0
+
+        if os.path.exists(self._path(previous_segment)):
+            log_offset = os.path.getsize(self._path(previous_segment))
+            log_offset -= log_offset % RECORD.itemsize
+
+        followers, followed = edge_arrays(edges)
+
+        if len(followers):
+            size = max(size, int(followers.max()) + 1,
+                       int(followed.max()) + 1)
+
+        started = time_ns()
+        generation = f'snapshot-{started}'
+        segment = f'follows-{started}.log'
+        os.makedirs(self._path(generation))
+
+        for direction, sources, targets in (
+                ('following', followers, followed),
+                ('followers', followed, followers)):
+            csr = CSR.build(sources, targets, size)
+            np.save(self._path(generation, f'{direction}.indptr.npy'),
+                    csr.indptr)
+            np.save(self._path(generation, f'{direction}.indices.npy'),
+                    csr.indices)
+
+        with open(self._path(generation, 'meta.json'), 'w') as file:
+            json.dump({'log': [[previous_segment, log_offset],
+                               [segment, 0]],
+                       'edges': len(followers), 'size': size}, file)
+
+        with open(self._path(CURRENT + '.tmp'), 'w') as file:
+            file.write(generation)
+        os.replace(self._path(CURRENT + '.tmp'), self._path(CURRENT))
+
+        # workers still mapping an older snapshot keep their mapping
+        for name in os.listdir(self.directory):
+            if (name.startswith('snapshot-')
+                    and name not in (generation, previous)):
+                shutil.rmtree(self._path(name), ignore_errors=True)
+            elif (name.startswith('follows')
+                    and name not in (segment, previous_segment)):
+                try:
+                    os.remove(self._path(name))
+                except FileNotFoundError:
+                    pass
+
+        self.refresh()
+
+
+follow_graph = FollowGraph()
+
+
+def init_follow_graph(app):
+    """Load the snapshot in FOLLOW_GRAPH_DIR, and catch up with the log at
+    the start of every request."""
+
+    follow_graph.configure(app.config['FOLLOW_GRAPH_DIR'])
+
+    if follow_graph.directory is not None and not follow_graph.enabled:
+        app.logger.warning(
+            "No follow graph snapshot in %s; run `flask "
+            "compact-follow-graph`", follow_graph.directory)
+
+    @app.before_request
+    def refresh_follow_graph():
+        follow_graph.refresh()
@@ -0,0 +1,73 @@
+"""Cached HTML for the messages in Warbler's lists.
+
+A feed page renders the same list items over and over, and all that changes
+between viewers is the like button. render_message() caches each item's
+HTML under the message id, author id and author's profile_version, and
+splices the viewer's like button and the current like count into slots in
+it on every render.
+
+Messages can't be edited, so an item only goes stale when its author's
+profile changes, which bumps profile_version and so the key; old entries
+age out. Deleting a message drops its entry.
+
+The cache is a per-process LRUCache, or a RedisCache shared by every worker
+if FRAGMENT_CACHE_URL is set.
+"""
+
+from flask import get_template_attribute
+from markupsafe import Markup
+
+from caching import LRUCache, RedisCache
+
+TEMPLATE = 'messages/_item.html'
+LIKE_SLOT = '<!--like-->'
+LIKES_COUNT_SLOT = '<!--likes-count-->'
+
+fragment_cache = LRUCache(max_size=0)
+
+
+def fragment_key(message_id, author_id, profile_version):
+    return f"message:{message_id}:{author_id}:{profile_version}"
+
+
+def render_message(msg):
+    """HTML for `msg`, a MessageView, as an item in a message list."""
+
+    key = fragment_key(msg.id, msg.user.id, msg.user.profile_version)
+    html = fragment_cache.get(key)
+
+    if html is None:
+        html = str(get_template_attribute(TEMPLATE, 'item')(msg))
+        fragment_cache.set(key, html)
+
+    like_button = get_template_attribute(TEMPLATE, 'like_button')(msg)
+    likes_count = get_template_attribute(TEMPLATE, 'likes_count')(msg)
+
+    return Markup(html
+                  .replace(LIKE_SLOT, like_button)
+                  .replace(LIKES_COUNT_SLOT, likes_count))
+
+
+def invalidate_message(message_id, author_id, profile_version):
+    """Drop the cached HTML for a message, e.g. once it's deleted."""
+
+    fragment_cache.delete(
+        fragment_key(message_id, author_id, profile_version))
+
+
+def init_fragments(app):
+    """Set up the fragment cache from `app`'s config, and let templates
+    call render_message()."""
+
+    global fragment_cache
+
+    if app.config['FRAGMENT_CACHE_URL']:
+        fragment_cache = RedisCache(
+            app.config['FRAGMENT_CACHE_URL'],
+            app.config['FRAGMENT_CACHE_TTL'])
+    else:
+        fragment_cache = LRUCache(
+            app.config['FRAGMENT_CACHE_SIZE'],
+            app.config['FRAGMENT_CACHE_TTL'])
+
+    app.jinja_env.globals['render_message'] = render_message
@@ -2,29 +2,47 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. a load-test dataset:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 10000000 --likes 10000000 --seed 1 --out /tmp/big
+
+then `flask load /tmp/big --drop`.
+
+Runs offline. Rows are streamed to disk as they are made, so memory use
+doesn't grow with the row counts. Follower counts and message authorship
+follow power laws (a few very popular or prolific users), and messages are
+posted in bursts. The same --seed and --end give the same files.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import random
+from datetime import datetime
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import PowerLaw, bursty_datetimes, power_law_edges
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_LIKES = 0
+
+# bcrypt hash of "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-fake = Faker()
+# Faker output is reused from pools; calling it per row is too slow for
+# millions of rows
+POOL_SIZE = 5000
 
-# Generate random profile image URLs to use for users
+# Random profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +50,131 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header image URLs to use for users (from splashbase; listed here so we
+# don't need the network)
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    f"https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_{key}_1280.jpg"
+    for key in [
+        'mnh0n9pHJW1st5lhmo1', 'mnh0uemhCk1st5lhmo1', 'mnh121HEWa1st5lhmo1',
+        'mnh17lfd9R1st5lhmo1', 'mnh1d7s3UD1st5lhmo1', 'mnh1jdFvHR1st5lhmo1',
+        'mnh1uhYnog1st5lhmo1', 'mnh25vNOvI1st5lhmo1', 'mnh29fxz111st5lhmo1',
+        'mnh2m1hnS81st5lhmo1', 'mo1h6tGOZf1st5lhmo1', 'mo2wz2LTCs1st5lhmo1',
+        'mo2x3aAnRH1st5lhmo1', 'mo2x80NkDu1st5lhmo1', 'mo2x9xqeef1st5lhmo1',
+        'mo2xbk8JUK1st5lhmo1', 'mo2xdqmle51st5lhmo1', 'mo2xfarCvW1st5lhmo1',
+        'mo2xgqdEFn1st5lhmo1', 'mo2xijE2nr1st5lhmo1', 'mopq4kHmAg1st5lhmo1',
+        'mopq69jlcS1st5lhmo1', 'mopq8fyQwI1st5lhmo1', 'mopqamedKu1st5lhmo1',
+        'mopqc3ZZcz1st5lhmo1', 'mopqdfx05t1st5lhmo1', 'mopqfpSTPN1st5lhmo1',
+        'mopqhxFulr1st5lhmo1', 'mopqj9QUeq1st5lhmo1', 'mopqkkwK2M1st5lhmo1',
+        'mp6rzyNlAN1st5lhmo1', 'mp6s1hAudo1st5lhmo1', 'mp6s32zb6l1st5lhmo1',
+        'mp6s4dzqHA1st5lhmo1', 'mp6s661UgK1st5lhmo1', 'mp6s7lR1lS1st5lhmo1',
+        'mp6s995bvI1st5lhmo1', 'mp6sasSvPZ1st5lhmo1', 'mp6scv2xrZ1st5lhmo1',
+        'mpp6f50W261st5lhmo1', 'mpp6gwrYvm1st5lhmo1', 'mpp6l06zXi1st5lhmo1',
+        'mpp6poZxE51st5lhmo1', 'mpp6tjdFhf1st5lhmo1', 'mpp6w0dxAm1st5lhmo1',
+    ]
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--likes', type=int, default=NUM_LIKES)
+    parser.add_argument('--seed', type=int, default=None,
+                        help="random seed, for repeatable output")
+    parser.add_argument('--end', type=datetime.fromisoformat, default=None,
+                        help="latest message timestamp (default: now)")
+    parser.add_argument('--out', default='generator',
+                        help="directory to write the CSVs to")
+    return parser.parse_args()
+
+
+def write_csv(path, headers, rows):
+    """Stream `rows` (tuples in `headers` order) to a CSV; returns the count."""
+
+    count = 0
+
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(headers)
+
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+
+    return count
+
+
+def users(rng, fake, num_users):
+    usernames = [fake.user_name() for _ in range(POOL_SIZE)]
+    domains = [fake.free_email_domain() for _ in range(50)]
+    bios = [fake.sentence() for _ in range(POOL_SIZE)]
+    cities = [fake.city() for _ in range(POOL_SIZE)]
+
+    for id in range(1, num_users + 1):
+        # the id suffix keeps usernames and emails unique
+        username = f"{rng.choice(usernames)}{id}"
+
+        yield (
+            id,
+            f"{username}@{rng.choice(domains)}",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            rng.choice(bios),
+            rng.choice(header_image_urls),
+            rng.choice(cities),
+        )
+
+
+def messages(rng, fake, num_users, num_messages, end):
+    texts = [fake.paragraph()[:MAX_WARBLER_LENGTH] for _ in range(POOL_SIZE)]
+    # authorship is less skewed than follower counts
+    authors = PowerLaw(num_users, exponent=0.7, rng=rng)
+    timestamps = bursty_datetimes(rng, now=end)
+
+    for id in range(1, num_messages + 1):
+        yield id, rng.choice(texts), next(timestamps), authors()
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    fake = Faker()
+    Faker.seed(args.seed)
+    os.makedirs(args.out, exist_ok=True)
+
+    def out(filename):
+        return os.path.join(args.out, filename)
+
+    counts = {}
+
+    counts['users'] = write_csv(
+        out('users.csv'), USERS_CSV_HEADERS,
+        users(rng, fake, args.users))
+
+    counts['messages'] = write_csv(
+        out('messages.csv'), MESSAGES_CSV_HEADERS,
+        messages(rng, fake, args.users, args.messages, args.end))
+
+    # Generate follows.csv with power-law in- and out-degrees
+
+    follows = power_law_edges(
+        rng, args.users, PowerLaw(args.users, rng=rng), args.follows,
+        exclude_self=True)
+    counts['follows'] = write_csv(
+        out('follows.csv'), FOLLOWS_CSV_HEADERS,
+        ((followed_user, follower) for follower, followed_user in follows))
+
+    if args.likes:
+        likes = power_law_edges(
+            rng, args.users, PowerLaw(args.messages, rng=rng), args.likes)
+        counts['likes'] = write_csv(out('likes.csv'), LIKES_CSV_HEADERS, likes)
+
+    for name, count in counts.items():
+        print(f"{name}: {count:,} rows")
+
+
+if __name__ == '__main__':
+    main()
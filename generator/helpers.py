@@ -1,14 +1,115 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from datetime import datetime, timedelta
+from math import gcd
 
 
-def get_random_datetime(year_gap=2):
+def get_random_datetime(year_gap=2, rng=random, now=None):
     """Get a random datetime within the last few years."""
 
-    now = datetime.now()
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def bursty_datetimes(rng=random, year_gap=2, now=None, burst_size=20,
+                     burst_minutes=60):
+    """Yield datetimes that arrive in bursts, like real posting activity.
+
+    Each burst starts at a random moment (from get_random_datetime) and
+    holds about `burst_size` timestamps spread over about `burst_minutes`,
+    with exponentially distributed gaps; burst sizes are exponential too.
+    """
+
+    now = now or datetime.now()
+    mean_gap = burst_minutes * 60 / burst_size
+
+    while True:
+        moment = get_random_datetime(year_gap, rng, now)
+
+        for _ in range(1 + int(rng.expovariate(1 / burst_size))):
+            moment += timedelta(seconds=rng.expovariate(1 / mean_gap))
+            yield min(moment, now)
+
+
+class PowerLaw:
+    """Draw ids 1..n with Zipf-like popularity, in O(1) memory.
+
+    Popularity rank r is drawn with probability roughly proportional to
+    r ** -exponent (any exponent but 1) by inverting the continuous
+    distribution, then mapped to an id by a random scramble, so the most
+    popular ids are spread out rather than being 1, 2, 3..., and two
+    PowerLaws over the same ids don't favor the same ones.
+    """
+
+    def __init__(self, n, exponent=0.9, rng=random):
+        self.n = n
+        self.rng = rng
+        self._power = 1 - exponent
+        self._top = (n + 1) ** self._power - 1
+
+        # any step coprime with n makes rank -> id a permutation
+        start = rng.randrange(n // 2 + 1, n + 2)
+        self._step = next(
+            step for step in range(start, start + 2 * n + 2)
+            if gcd(step, n) == 1)
+
+    def rank(self):
+        """A popularity rank in 1..n, 1 being the most likely."""
+
+        draw = (self._top * self.rng.random() + 1) ** (1 / self._power)
+        return min(int(draw), self.n)
+
+    def __call__(self):
+        """A random id in 1..n."""
+
+        return (self.rank() * self._step) % self.n + 1
+
+
+def power_law_edges(rng, num_sources, targets, total, exclude_self=False,
+                    alpha=1.5):
+    """Yield about `total` distinct (source, target) pairs, source by source.
+
+    Sources 1..num_sources get Pareto-distributed out-degrees (a few very
+    active users, many quiet ones) and draw their targets from `targets`,
+    a PowerLaw, so in-degrees follow a power law too. Only one source's
+    targets are held in memory at a time.
+    """
+
+    # scales a Pareto(alpha) draw to mean 1
+    scale = (alpha - 1) / alpha
+    cap = max(1, (targets.n - 1) // 4)
+    remaining = total
+
+    for source in range(1, num_sources + 1):
+        if remaining <= 0:
+            return
+
+        sources_left = num_sources - source + 1
+        mean = remaining / sources_left
+
+        if sources_left == 1:
+            degree = remaining
+        else:
+            degree = round(mean * rng.paretovariate(alpha) * scale)
+
+        degree = min(degree, cap, remaining)
+        chosen = set()
+
+        # popular targets repeat, so allow some misses before giving up
+        for _ in range(degree * 20):
+            if len(chosen) == degree:
+                break
+
+            target = targets()
+
+            if not (exclude_self and target == source):
+                chosen.add(target)
+
+        remaining -= len(chosen)
+
+        for target in chosen:
+            yield source, target
@@ -0,0 +1,94 @@
+"""Password hashing for Warbler, run off the request thread.
+
+bcrypt is deliberately slow, so a burst of logins can pin every web worker
+on CPU. Hashing and checking run on a small process pool instead, and once
+more than `workers + queue_depth` calls are waiting, new ones fail fast
+with HasherBusy rather than queueing behind them.
+
+The work factor is BCRYPT_LOG_ROUNDS. Hashes made with a different factor
+are reported by needs_rehash() so they can be upgraded at login.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from threading import BoundedSemaphore, Lock
+
+import bcrypt
+
+
+class HasherBusy(Exception):
+    """Too many password hashes are already queued."""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(
+        password.encode('UTF-8'), bcrypt.gensalt(rounds)).decode('UTF-8')
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(password.encode('UTF-8'), hashed.encode('UTF-8'))
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a bounded process pool.
+
+    With workers=0 the work runs inline in the calling thread.
+    """
+
+    def __init__(self, rounds=12, workers=0, queue_depth=0, timeout=None):
+        self._pool = None
+        self._lock = Lock()
+        self.configure(rounds, workers, queue_depth, timeout)
+
+    def configure(self, rounds, workers=0, queue_depth=0, timeout=None):
+        """Set the work factor and pool size; the pool starts on first use."""
+
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+            self.rounds = rounds
+            self.workers = workers
+            self.timeout = timeout
+            self._slots = BoundedSemaphore(workers + queue_depth or 1)
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+
+        try:
+            with self._lock:
+                if self._pool is None:
+                    # spawn, not fork: the web process may hold DB
+                    # connections and threads the workers mustn't inherit
+                    self._pool = ProcessPoolExecutor(
+                        self.workers, mp_context=get_context('spawn'))
+                pool = self._pool
+
+            return pool.submit(fn, *args).result(timeout=self.timeout)
+
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Is `password` the one `hashed` was made from?"""
+
+        return self._run(_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than configured?"""
+
+        # bcrypt hashes look like $2b$12$<salt and hash>
+        return int(hashed.split('$')[2]) != self.rounds
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,36 @@
+"""Hashtags in message text.
+
+A hashtag is a # followed by letters, digits and underscores, at least one
+of them not a digit, and not straight after a letter or digit, so "#warbler"
+and "#2fast" are tags but "#1" and "email#tag" aren't. Tags are compared
+lowercased: "#Warbler" and "#warbler" are the same tag.
+"""
+
+import re
+
+from markupsafe import Markup, escape
+
+HASHTAG = re.compile(r'(?<![\w&])#(\w*[^\W\d]\w*)')
+
+
+def parse_tags(text):
+    """The distinct tags in `text`, lowercased, in order of appearance."""
+
+    return list(dict.fromkeys(
+        match.lower() for match in HASHTAG.findall(text)))
+
+
+def link_tags(text):
+    """`text`, escaped, with each hashtag linked to its tag page."""
+
+    def link(match):
+        return (f'<a href="/tags/{match.group(1).lower()}">'
+                f'{match.group(0)}</a>')
+
+    return Markup(HASHTAG.sub(link, str(escape(text))))
+
+
+def init_hashtags(app):
+    """Let templates link hashtags with the link_tags filter."""
+
+    app.jinja_env.filters['link_tags'] = link_tags
@@ -0,0 +1,118 @@
+"""HTTP caching for Warbler.
+
+Static files linked through static_url() carry a hash of their contents in
+a `v` query argument, so a URL only ever names one version of a file and
+browsers may keep it for a year without asking again. Static files
+requested without the current hash (e.g. the default profile images stored
+in users' rows) are revalidated with the ETag Flask gives them.
+
+Pages that call request_is_fresh() get an ETag and Last-Modified derived
+from the versions of the users whose data they show, so a repeat view
+whose data hasn't changed is answered 304 before any rendering. Every
+other response is marked no-store.
+"""
+
+import hashlib
+import os
+from time import time
+
+from flask import current_app, g, request, session, url_for
+from werkzeug.http import is_resource_modified
+
+# a year, the longest max-age caches are expected to honor
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# filename -> (modification time, content hash)
+_fingerprints = {}
+
+
+def fingerprint(filename):
+    """A short hash of static file `filename`'s contents."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    mtime = os.stat(path).st_mtime
+    cached = _fingerprints.get(filename)
+
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as file:
+            cached = (mtime, hashlib.sha256(file.read()).hexdigest()[:12])
+        _fingerprints[filename] = cached
+
+    return cached[1]
+
+
+def static_url(filename):
+    """URL of static file `filename`, fingerprinted with its contents."""
+
+    return url_for('static', filename=filename, v=fingerprint(filename))
+
+
+def _csrf_period():
+    """Which stretch of time the page's CSRF token was made in.
+
+    Pages embed a CSRF token that expires after WTF_CSRF_TIME_LIMIT, so a
+    page only stays fresh for half that, and re-renders with a new token.
+    """
+
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    return int(time() // (limit / 2)) if limit else 0
+
+
+def request_is_fresh(users, *keys):
+    """Does the client already have this page, built from `users`' data?
+
+    `users` are the User rows the page shows data from (including the
+    viewer's), and `keys` anything else that picks what's shown, like the
+    page cursor. Records the page's validators for set_cache_headers; if
+    this returns True, the route should answer 304 without rendering.
+    """
+
+    # a page about to show flashed messages isn't the one the client has
+    if '_flashes' in session:
+        return False
+
+    digest = hashlib.sha256(repr((
+        [(user.id, user.version) for user in users],
+        keys,
+        session.get('csrf_token'),
+        _csrf_period(),
+    )).encode()).hexdigest()
+
+    g.etag = digest[:32]
+    g.last_modified = max(user.updated_at for user in users)
+
+    return not is_resource_modified(
+        request.environ, g.etag, last_modified=g.last_modified)
+
+
+def set_cache_headers(response):
+    """Set Cache-Control, and validators for pages that recorded them."""
+
+    if request.endpoint == 'static':
+        filename = request.view_args.get('filename')
+
+        if (response.status_code == 200 and
+                request.args.get('v') == fingerprint(filename)):
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+
+        return response
+
+    if 'etag' in g and response.status_code in (200, 304):
+        response.set_etag(g.etag)
+        response.last_modified = g.last_modified
+        # the page depends on who is logged in, so only browsers keep it
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    else:
+        # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
+        response.cache_control.no_store = True
+
+    return response
+
+
+def init_http_cache(app):
+    """Let templates call static_url()."""
+
+    app.jinja_env.globals['static_url'] = static_url
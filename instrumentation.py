@@ -0,0 +1,131 @@
+"""Per-request SQL instrumentation for Warbler.
+
+Counts the statements each request runs and the time spent in them, on
+every engine, without Flask-DebugToolbar. The totals go out in
+Server-Timing and X-DB-Queries response headers and one log line per
+request, and a warning is logged when the same statement shape runs more
+than SQL_REPEAT_WARNING times in one request: usually a lazy load inside a
+loop (an N+1).
+
+A streamed response's body runs its statements after the headers are
+sent, so streamed responses get no headers; their totals are logged once
+the response is closed. Either way, each request's final QueryStats are
+passed to the functions in stats_listeners (bench.py collects them).
+"""
+
+import re
+from collections import Counter
+from time import perf_counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# expanded IN lists and VALUES rows vary in length from call to call
+_PLACEHOLDERS = re.compile(r"\((?:\s*(?:\?|%\(\w+\)s|%s)\s*,?)+\)")
+_SPACE = re.compile(r"\s+")
+
+# functions called with each request's final QueryStats
+stats_listeners = []
+
+
+def statement_shape(statement):
+    """`statement` with whitespace and placeholder lists normalized."""
+
+    return _PLACEHOLDERS.sub("(?)", _SPACE.sub(" ", statement).strip())
+
+
+class QueryStats:
+    """Statements run during one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold):
+        """[(shape, times)] for shapes run more than `threshold` times."""
+
+        return [(shape, times) for shape, times in self.shapes.most_common()
+                if times > threshold]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = conn.info['query_start'].pop()
+
+    if has_request_context() and 'sql_stats' in g:
+        g.sql_stats.record(statement, perf_counter() - start)
+
+
+def _handle_error(context):
+    # a failed statement never gets to after_cursor_execute
+    connection = context.connection
+
+    if (connection is not None and context.execution_context is not None
+            and connection.info.get('query_start')):
+        connection.info['query_start'].pop()
+
+
+def init_instrumentation(app):
+    """Instrument every engine, and report per request for `app`."""
+
+    if not app.config['SQL_INSTRUMENTATION']:
+        return
+
+    # on the Engine class, so read replicas and test engines are covered
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+    @app.before_request
+    def start_query_stats():
+        g.sql_stats = QueryStats()
+
+    def report(method, path, stats):
+        app.logger.info("%s %s: %d queries in %.2fms", method, path,
+                        stats.count, stats.duration * 1000)
+
+        threshold = app.config['SQL_REPEAT_WARNING']
+        for shape, times in stats.repeated(threshold):
+            app.logger.warning("%s %s ran the same query %d times: %s",
+                               method, path, times, shape)
+
+        for listener in stats_listeners:
+            listener(stats)
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = g.get('sql_stats')
+
+        if stats is None:
+            return response
+
+        if response.is_streamed:
+            # g.sql_stats keeps counting while the body is generated
+            method, path = request.method, request.path
+            response.call_on_close(lambda: report(method, path, stats))
+            return response
+
+        g.pop('sql_stats')
+        milliseconds = stats.duration * 1000
+        response.headers['X-DB-Queries'] = str(stats.count)
+        response.headers.add(
+            'Server-Timing',
+            f'db;desc="{stats.count} queries";dur={milliseconds:.2f}')
+
+        report(request.method, request.path, stats)
+
+        return response
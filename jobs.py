@@ -0,0 +1,233 @@
+"""A job queue for Warbler, kept in the jobs table.
+
+Routes hand slow follow-on work to enqueue(type, payload). The job row is
+added in the request's transaction, so it commits or rolls back with the
+change that needs it, and worker processes run it later:
+
+    flask worker            # run jobs until stopped
+    flask worker --once     # run what's due, then exit
+
+Handlers are registered with @handler(type, batch_size=..., concurrency=...)
+and take a list of payloads: a worker takes up to batch_size due jobs of a
+type and runs them in one call and one transaction, and at most
+`concurrency` batches of a type run at once across all workers. If a batch
+fails, its jobs are run one by one, so one bad job doesn't hold back the
+rest.
+
+A job whose handler raises is retried after JOB_RETRY_SECONDS * 2 **
+(attempts - 1) seconds, up to JOB_MAX_ATTEMPTS attempts; then it's kept,
+with status 'failed' and its last error, for inspection. A batch whose
+worker died is taken again once its lease (JOB_LEASE_SECONDS, or the
+handler's `lease`) runs out, so handlers must be safe to run twice.
+
+With JOBS_EAGER set (the default), enqueue() runs the handler at once in
+the caller's transaction, and no worker is needed.
+"""
+
+import json
+import os
+import socket
+from datetime import datetime, timedelta
+from time import sleep
+from uuid import uuid4
+
+from flask import current_app
+from sqlalchemy import and_, delete, func, or_, select
+
+from models import db, Job
+
+
+class Handler:
+    """A registered job handler and its limits."""
+
+    def __init__(self, function, batch_size, concurrency, lease):
+        self.function = function
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.lease = lease
+
+    @property
+    def lease_seconds(self):
+        return self.lease or current_app.config['JOB_LEASE_SECONDS']
+
+
+# job type -> Handler
+HANDLERS = {}
+
+
+def handler(type, batch_size=1, concurrency=1, lease=None):
+    """Register the decorated function as the handler of `type` jobs.
+
+    `lease` is how many seconds a batch may run before it's taken to have
+    died (default JOB_LEASE_SECONDS).
+    """
+
+    def register(function):
+        HANDLERS[type] = Handler(function, batch_size, concurrency, lease)
+        return function
+
+    return register
+
+
+def enqueue(type, payload, delay=0):
+    """Run `type`'s handler on `payload`, a JSON-able value, after `delay`
+    seconds; or now, if JOBS_EAGER. The caller commits."""
+
+    if current_app.config['JOBS_EAGER']:
+        HANDLERS[type].function([payload])
+        return
+
+    db.session.add(Job(
+        type=type,
+        payload=json.dumps(payload),
+        run_at=datetime.utcnow() + timedelta(seconds=delay)))
+
+
+def _due(now, lease_start):
+    """Jobs ready to run: queued and due, or taken before `lease_start`."""
+
+    return or_(
+        and_(Job.status == 'queued', Job.run_at <= now),
+        and_(Job.status == 'running', Job.locked_at < lease_start))
+
+
+def _claim(type, now):
+    """Take a batch of due `type` jobs, if fewer than the type's
+    concurrency are running. Commits; returns (token, job ids)."""
+
+    spec = HANDLERS[type]
+    lease_start = now - timedelta(seconds=spec.lease_seconds)
+    is_postgres = db.engine.dialect.name == 'postgresql'
+
+    if is_postgres:
+        # claims of one type take turns, so two workers can't both see a
+        # free slot and take it
+        db.session.execute(select(func.pg_advisory_xact_lock(
+            func.hashtext(f'warbler-jobs:{type}'))))
+
+    running = (db.session
+               .query(func.count(func.distinct(Job.locked_by)))
+               .filter(Job.type == type, Job.status == 'running',
+                       Job.locked_at >= lease_start)
+               .scalar())
+
+    if running >= spec.concurrency:
+        db.session.commit()
+        return None, []
+
+    query = (db.session
+             .query(Job.id)
+             .filter(Job.type == type, _due(now, lease_start))
+             .order_by(Job.run_at, Job.id)
+             .limit(spec.batch_size))
+
+    if is_postgres:
+        query = query.with_for_update(skip_locked=True)
+
+    job_ids = [id for (id,) in query]
+    token = f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+
+    if job_ids:
+        (Job.query
+            .filter(Job.id.in_(job_ids))
+            .update({Job.status: 'running', Job.locked_by: token,
+                     Job.locked_at: now, Job.attempts: Job.attempts + 1},
+                    synchronize_session=False))
+
+    db.session.commit()
+
+    return token, job_ids
+
+
+def _run(type, token, job_ids):
+    """Run a claimed batch; returns how many of its jobs succeeded."""
+
+    payloads = [json.loads(payload) for (payload,) in db.session
+                .query(Job.payload)
+                .filter(Job.id.in_(job_ids))
+                .order_by(Job.id)]
+
+    try:
+        HANDLERS[type].function(payloads)
+        db.session.execute(
+            delete(Job)
+            .where(Job.id.in_(job_ids), Job.locked_by == token)
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+        return len(job_ids)
+
+    except Exception as error:
+        db.session.rollback()
+
+        if len(job_ids) > 1:
+            return sum(_run(type, token, [id]) for id in job_ids)
+
+        current_app.logger.exception("%s job #%s failed", type, job_ids[0])
+        _retry(job_ids[0], token, error)
+        return 0
+
+
+def _retry(job_id, token, error):
+    """Queue a failed job to run again later, or mark it failed."""
+
+    job = Job.query.filter_by(id=job_id, locked_by=token).first()
+
+    if job is None:
+        return
+
+    job.last_error = f'{type(error).__name__}: {error}'
+    job.locked_by = None
+    job.locked_at = None
+
+    if job.attempts >= current_app.config['JOB_MAX_ATTEMPTS']:
+        job.status = 'failed'
+    else:
+        job.status = 'queued'
+        job.run_at = datetime.utcnow() + timedelta(
+            seconds=current_app.config['JOB_RETRY_SECONDS'] *
+            2 ** (job.attempts - 1))
+
+    db.session.commit()
+
+
+def _pending_types():
+    """Types with queued or running jobs that this process can run."""
+
+    types = [type for (type,) in db.session
+             .query(Job.type)
+             .filter(Job.status.in_(('queued', 'running')))
+             .distinct()
+             if type in HANDLERS]
+    db.session.commit()
+
+    return types
+
+
+def work_once():
+    """Run one batch of each job type that has due jobs; returns how many
+    batches ran."""
+
+    batches = 0
+
+    for type in _pending_types():
+        token, job_ids = _claim(type, datetime.utcnow())
+
+        if job_ids:
+            _run(type, token, job_ids)
+            batches += 1
+
+    return batches
+
+
+def run_worker(once=False, poll=1.0):
+    """Run due jobs, polling every `poll` seconds when there are none.
+
+    With `once`, return when nothing is left to run instead.
+    """
+
+    while True:
+        if not work_once():
+            if once:
+                return
+
+            sleep(poll)
@@ -0,0 +1,248 @@
+"""Like and unlike writes for Warbler.
+
+apply_likes() sets (user, message) pairs to liked or not in a few batched
+statements. It's idempotent: liking twice, or unliking something never
+liked, changes nothing, and only rows that really changed move the count
+columns and the hourly leaderboard rollups (see models.LikeRollup).
+
+Hot messages get liked and unliked in quick bursts. With LIKE_BUFFER_SECONDS
+set, like_buffer holds each user's latest choice per message in memory
+(so a like then an unlike cancel out) and applies them in one batch every
+few seconds, or sooner once LIKE_BUFFER_SIZE pairs are waiting. Until then
+the user's own pages show their pending likes (see feed.hydrate); other
+users see them after the flush. The buffer is per process, and pending
+likes are lost if a worker is killed before it flushes.
+"""
+
+import atexit
+from collections import Counter, defaultdict
+from datetime import datetime
+from threading import Lock, Timer
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, LikedMessage, LikeRollup, Message, User
+
+
+def _add_likes(pairs, now):
+    """Insert (user_id, message_id) likes that don't exist yet, made at
+    `now`; returns the (user_id, message_id, timestamp) rows inserted."""
+
+    if not pairs:
+        return []
+
+    # liking a deleted message, or as a deleted user, is a no-op, not a
+    # foreign key error
+    messages = {id for (id,) in db.session.query(Message.id).filter(
+        Message.id.in_({message_id for _, message_id in pairs}))}
+    users = {id for (id,) in db.session.query(User.id).filter(
+        User.id.in_({user_id for user_id, _ in pairs}))}
+    rows = [{'user_id': user_id, 'message_id': message_id, 'timestamp': now}
+            for user_id, message_id in pairs
+            if message_id in messages and user_id in users]
+
+    if not rows:
+        return []
+
+    if db.engine.dialect.name == 'postgresql':
+        return [tuple(row) for row in db.session.execute(
+            postgresql.insert(LikedMessage)
+            .values(rows)
+            .on_conflict_do_nothing()
+            .returning(LikedMessage.user_id, LikedMessage.message_id,
+                       LikedMessage.timestamp))]
+
+    statement = sqlite.insert(LikedMessage).on_conflict_do_nothing()
+    return [(row['user_id'], row['message_id'], now) for row in rows
+            if db.session.execute(statement, row).rowcount]
+
+
+def _remove_likes(pairs):
+    """Delete (user_id, message_id) likes; returns the (user_id,
+    message_id, timestamp) rows deleted."""
+
+    if not pairs:
+        return []
+
+    key = tuple_(LikedMessage.user_id, LikedMessage.message_id)
+    columns = (LikedMessage.user_id, LikedMessage.message_id,
+               LikedMessage.timestamp)
+
+    if db.engine.dialect.name == 'postgresql':
+        return [tuple(row) for row in db.session.execute(
+            LikedMessage.__table__.delete()
+            .where(key.in_(pairs))
+            .returning(*columns))]
+
+    rows = [tuple(row) for row in db.session.execute(
+        select(*columns).where(key.in_(pairs)))]
+
+    return [(user_id, message_id, timestamp)
+            for user_id, message_id, timestamp in rows
+            if db.session.execute(
+                LikedMessage.__table__.delete()
+                .where(LikedMessage.user_id == user_id,
+                       LikedMessage.message_id == message_id)).rowcount]
+
+
+def _adjust(adjust, deltas):
+    """Call adjust(ids, delta) once per distinct non-zero delta in
+    `deltas`, {id: delta}."""
+
+    by_delta = defaultdict(list)
+    for id, delta in deltas.items():
+        if delta:
+            by_delta[delta].append(id)
+
+    for delta, ids in by_delta.items():
+        adjust(ids, delta)
+
+
+def apply_likes(changes):
+    """Apply `changes`, {(user_id, message_id): liked}, in SQL.
+
+    For the likes that actually changed, updates the likers' and the
+    messages' likes_count and the hourly rollups, and bumps the authors'
+    versions. Returns the (user_id, message_id) pairs changed. The caller
+    commits.
+    """
+
+    now = datetime.utcnow()
+
+    added = _add_likes(
+        [pair for pair, liked in changes.items() if liked], now)
+    removed = _remove_likes(
+        [pair for pair, liked in changes.items() if not liked])
+
+    user_deltas = Counter()
+    message_deltas = Counter()
+    rollup_deltas = Counter()
+
+    for rows, delta in ((added, 1), (removed, -1)):
+        for user_id, message_id, timestamp in rows:
+            user_deltas[user_id] += delta
+            message_deltas[message_id] += delta
+            bucket = LikeRollup.bucket_of(timestamp)
+            rollup_deltas[(message_id, bucket)] += delta
+
+    _adjust(lambda ids, delta: User.adjust_counts(ids, likes_count=delta),
+            user_deltas)
+    _adjust(Message.adjust_likes, message_deltas)
+    LikeRollup.add(rollup_deltas, now)
+
+    changed = [(user_id, message_id)
+               for user_id, message_id, _ in added + removed]
+
+    if changed:
+        # the authors' pages show the messages' like counts
+        User.touch(
+            select(Message.user_id)
+            .where(Message.id.in_(list(message_deltas))))
+
+    return changed
+
+
+class LikeBuffer:
+    """Pending likes, merged per (user, message), applied in batches.
+
+    Disabled (every like is applied at once) when `seconds` is 0.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = Lock()
+        self._timer = None
+        self.app = None
+        self.configure(None, 0)
+
+    def configure(self, app, seconds, max_size=1000):
+        """Flush after `seconds`, or once `max_size` pairs are pending."""
+
+        self.flush_pending()
+
+        self.app = app
+        self.seconds = seconds
+        self.max_size = max_size
+
+    @property
+    def enabled(self):
+        return self.seconds > 0
+
+    def record(self, user_id, message_id, liked):
+        """Set `user_id`'s like of `message_id`, to be applied later."""
+
+        with self._lock:
+            self._pending[(user_id, message_id)] = liked
+            full = len(self._pending) >= self.max_size
+
+            if self._timer is None and not full:
+                self._timer = Timer(self.seconds, self._flush_in_app)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if full:
+            self.flush()
+
+    def pending_for(self, user_id):
+        """{message_id: liked} for `user_id`'s pending likes."""
+
+        with self._lock:
+            return {message_id: liked
+                    for (liker_id, message_id), liked in self._pending.items()
+                    if liker_id == user_id}
+
+    def _take(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            pending, self._pending = self._pending, {}
+            return pending
+
+    def flush(self):
+        """Apply and commit the pending likes, in the current app context."""
+
+        pending = self._take()
+
+        if pending:
+            apply_likes(pending)
+            db.session.commit()
+
+    def _flush_in_app(self):
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception("Flushing pending likes failed")
+
+    def flush_pending(self):
+        """Flush anything pending, from outside any app context."""
+
+        if self.app is not None and self._pending:
+            self._flush_in_app()
+
+
+like_buffer = LikeBuffer()
+
+atexit.register(like_buffer.flush_pending)
+
+
+def set_like(user_id, message_id, liked):
+    """Like or unlike, now or through the buffer. The caller commits."""
+
+    if like_buffer.enabled:
+        like_buffer.record(user_id, message_id, liked)
+        # the liker's own pages must not be served from stale copies
+        User.touch([user_id])
+    else:
+        apply_likes({(user_id, message_id): liked})
+
+
+def init_likes(app):
+    """Set up the like buffer from `app`'s config."""
+
+    like_buffer.configure(
+        app, app.config['LIKE_BUFFER_SECONDS'], app.config['LIKE_BUFFER_SIZE'])
@@ -0,0 +1,210 @@
+"""Bulk loader for Warbler CSV snapshots.
+
+Streams users.csv, messages.csv, follows.csv and (if present) likes.csv
+from a directory into the database in chunks, so memory stays flat however
+big the files are. PostgreSQL loads each chunk with COPY; other databases
+(SQLite) fall back to executemany.
+
+On PostgreSQL, secondary indexes and foreign key/unique constraints on the
+loaded tables are dropped for the load and rebuilt once at the end, which
+is much faster than maintaining them row by row, and id sequences are
+moved past any ids loaded explicitly. The same goes for timeline_entries
+while the home timelines are rebuilt from the loaded rows. The whole load
+is one transaction.
+
+Each CSV's header row names the table columns it holds.
+"""
+
+import csv
+import os
+from io import StringIO
+from itertools import islice
+from time import perf_counter
+
+from sqlalchemy import text
+
+from follow_graph import follow_graph
+from models import (
+    db, Follows, LikeRollup, Message, MessageTag, TagRollup, TimelineEntry,
+    User)
+
+# table name -> CSV file name, in foreign key order
+CSV_FILES = {
+    'users': 'users.csv',
+    'messages': 'messages.csv',
+    'follows': 'follows.csv',
+    'liked_messages': 'likes.csv',
+}
+
+CHUNK_SIZE = 50000
+
+
+def read_chunks(path, chunk_size):
+    """Yield (columns, rows) for `path`, `chunk_size` rows at a time."""
+
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        columns = next(reader)
+
+        while True:
+            rows = list(islice(reader, chunk_size))
+
+            if not rows:
+                return
+
+            yield columns, rows
+
+
+def copy_rows(conn, table, columns, rows):
+    """Load `rows` into `table` with PostgreSQL COPY."""
+
+    buffer = StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buffer)
+
+
+def insert_rows(conn, table, columns, rows):
+    """Load `rows` into `table` with one executemany INSERT."""
+
+    statement = text(
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join(':' + column for column in columns)})")
+
+    # COPY reads empty unquoted CSV fields as NULL; match that
+    conn.execute(statement, [
+        {column: value or None for column, value in zip(columns, row)}
+        for row in rows])
+
+
+def drop_deferred(conn, tables):
+    """Drop secondary indexes and FK/unique constraints on `tables`.
+
+    Returns the DDL to recreate them, in the order to run it.
+    """
+
+    constraints = conn.execute(text("""
+        SELECT conrelid::regclass::text, conname, contype,
+               pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid::regclass::text = ANY(:tables)
+          AND contype IN ('f', 'u')
+        ORDER BY contype
+    """), {'tables': tables}).all()
+
+    indexes = conn.execute(text("""
+        SELECT indexname, indexdef
+        FROM pg_indexes
+        WHERE tablename = ANY(:tables)
+          AND indexname NOT IN (SELECT conname FROM pg_constraint)
+    """), {'tables': tables}).all()
+
+    # foreign keys ('f') sort first, so they go before the unique
+    # constraints they may depend on, and come back after them
+    for table, name, _, _ in constraints:
+        conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'))
+
+    for name, _ in indexes:
+        conn.execute(text(f'DROP INDEX "{name}"'))
+
+    return (
+        [definition for _, definition in indexes] +
+        [f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'
+         for table, name, _, definition in reversed(constraints)])
+
+
+def resync_sequences(conn, tables):
+    """Move each serial id sequence past the largest id loaded."""
+
+    for table in tables:
+        if 'id' not in db.metadata.tables[table].c:
+            continue
+
+        sequence = conn.execute(
+            text("SELECT pg_get_serial_sequence(:table, 'id')"),
+            {'table': table}).scalar()
+
+        if sequence:
+            conn.execute(text(
+                f"SELECT setval('{sequence}', COALESCE(MAX(id), 1), "
+                f"MAX(id) IS NOT NULL) FROM {table}"))
+
+
+def load_csvs(directory, drop=False, chunk_size=CHUNK_SIZE, echo=print):
+    """Load the CSVs in `directory`; returns {table: rows loaded}.
+
+    With `drop`, all tables are dropped and recreated first.
+    """
+
+    if drop:
+        db.drop_all()
+        db.create_all()
+
+    paths = {
+        table: os.path.join(directory, filename)
+        for table, filename in CSV_FILES.items()
+        if os.path.exists(os.path.join(directory, filename))}
+
+    is_postgres = db.engine.dialect.name == 'postgresql'
+    load_rows = copy_rows if is_postgres else insert_rows
+    timelines = [TimelineEntry.__tablename__]
+    counts = {}
+
+    # the session's connection, so the rebuild below shares the transaction
+    conn = db.session.connection()
+
+    try:
+        deferred = drop_deferred(conn, list(paths)) if is_postgres else []
+
+        for table, path in paths.items():
+            start = perf_counter()
+            counts[table] = 0
+
+            for columns, rows in read_chunks(path, chunk_size):
+                load_rows(conn, table, columns, rows)
+                counts[table] += len(rows)
+
+            elapsed = perf_counter() - start
+            echo(f"{table}: {counts[table]:,} rows in {elapsed:.1f}s "
+                 f"({counts[table] / (elapsed or 1):,.0f} rows/sec)")
+
+        start = perf_counter()
+
+        for statement in deferred:
+            conn.execute(text(statement))
+
+        if is_postgres:
+            resync_sequences(conn, list(paths))
+            echo(f"indexes and constraints: {perf_counter() - start:.1f}s")
+
+        # loaded rows skip fan-out and counting, so build those in one pass
+        start = perf_counter()
+        deferred = drop_deferred(conn, timelines) if is_postgres else []
+
+        TimelineEntry.rebuild()
+        User.recount()
+        Message.recount_likes()
+        LikeRollup.rebuild()
+        MessageTag.rebuild()
+        TagRollup.rebuild()
+
+        for statement in deferred:
+            conn.execute(text(statement))
+
+        db.session.commit()
+        echo(f"timelines, counts and tags: {perf_counter() - start:.1f}s")
+
+        if follow_graph.directory is not None:
+            start = perf_counter()
+            Follows.compact_graph()
+            echo(f"follow graph: {perf_counter() - start:.1f}s")
+
+    except BaseException:
+        db.session.rollback()
+        raise
+
+    return counts
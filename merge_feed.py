@@ -0,0 +1,234 @@
+"""Pull-model home feeds, merged from per-author recent-message lists.
+
+The default home feed reads the user's materialized timeline (see
+TimelineEntry), which add_message fans out to. With FEED_STRATEGY set to
+"merge", the home feed is instead assembled at read time: each author's
+newest AUTHOR_RECENT_LENGTH messages are kept in recent_cache as a list of
+(timestamp, id), newest first, and a page is a k-way merge of the lists
+of the authors the user follows, on a heap of each list's next entry,
+stopped as soon as the page is full. Past heapifying one entry per
+author, the merge's work grows with the page size, not the number of
+authors; the lists are one cache read each, plus one query for all the
+authors missing from the cache.
+
+add_message and delete_message update the author's list in this process;
+other workers' copies catch up within RECENT_CACHE_TTL seconds.
+
+An author's list is bounded, so once a merge runs past the end of a full
+list, that author's older messages are read from the messages table, as
+many as the page still needs, and the merge goes on with them.
+"""
+
+import heapq
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import func, select, tuple_
+
+from caching import LRUCache
+from models import db, Message
+from pagination import Page, decode_cursor, encode_cursor
+
+# process-wide cache of author id -> [(timestamp, message id)], newest
+# first; set up by init_merge_feed
+recent_cache = LRUCache(max_size=0)
+
+CURSOR_COLUMNS = (Message.timestamp, Message.id)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _load_recent(author_ids):
+    """{author id: [(timestamp, message id)]} read from the messages table,
+    newest AUTHOR_RECENT_LENGTH per author."""
+
+    ranked = (
+        select(
+            Message.user_id,
+            Message.timestamp,
+            Message.id,
+            func.row_number().over(
+                partition_by=Message.user_id,
+                order_by=(Message.timestamp.desc(), Message.id.desc()),
+            ).label('rank'))
+        .where(Message.user_id.in_(author_ids))
+        .subquery())
+
+    length = current_app.config['AUTHOR_RECENT_LENGTH']
+    lists = {author_id: [] for author_id in author_ids}
+
+    for author_id, timestamp, message_id in db.session.execute(
+            select(ranked.c.user_id, ranked.c.timestamp, ranked.c.id)
+            .where(ranked.c.rank <= length)
+            .order_by(ranked.c.user_id, ranked.c.rank)):
+        lists[author_id].append((timestamp, message_id))
+
+    return lists
+
+
+def _load_older(author_id, before, limit):
+    """Up to `limit` of `author_id`'s [(timestamp, message id)], newest
+    first, older than `before`, read from the messages table."""
+
+    return [tuple(row) for row in db.session.execute(
+        select(*CURSOR_COLUMNS)
+        .where(Message.user_id == author_id,
+               tuple_(*CURSOR_COLUMNS) < before)
+        .order_by(Message.timestamp.desc(), Message.id.desc())
+        .limit(limit))]
+
+
+def recent_messages(author_ids):
+    """{author id: [(timestamp, message id)]}, newest first, for
+    `author_ids`, through recent_cache."""
+
+    lists = {}
+    missing = []
+
+    for author_id in author_ids:
+        recent = recent_cache.get(author_id)
+
+        if recent is None:
+            missing.append(author_id)
+        else:
+            lists[author_id] = recent
+
+    if missing:
+        for author_id, recent in _load_recent(missing).items():
+            recent_cache.set(author_id, recent)
+            lists[author_id] = recent
+
+    return lists
+
+
+def message_added(message):
+    """Put a new `message` at the front of its author's cached list."""
+
+    recent = recent_cache.get(message.user_id)
+
+    if recent is not None:
+        length = current_app.config['AUTHOR_RECENT_LENGTH']
+        recent_cache.set(
+            message.user_id,
+            [(message.timestamp, message.id), *recent][:length])
+
+
+def message_deleted(author_id, message_id):
+    """Drop a deleted message from its author's cached list.
+
+    A full list is dropped from the cache instead, to be reloaded with the
+    next-oldest message filling the gap.
+    """
+
+    recent = recent_cache.get(author_id)
+
+    if recent is None:
+        return
+
+    if len(recent) >= current_app.config['AUTHOR_RECENT_LENGTH']:
+        recent_cache.delete(author_id)
+    else:
+        recent_cache.set(
+            author_id, [entry for entry in recent if entry[1] != message_id])
+
+
+def _heap_key(entry):
+    """Sort key for a (timestamp, id) entry that puts the newest first."""
+
+    timestamp, message_id = entry
+    return (EPOCH - timestamp, -message_id)
+
+
+def _start(recent, after):
+    """Index of the first entry of `recent`, newest first, older than
+    `after`."""
+
+    low, high = 0, len(recent)
+
+    while low < high:
+        middle = (low + high) // 2
+
+        if recent[middle] < after:
+            high = middle
+        else:
+            low = middle + 1
+
+    return low
+
+
+def merged_page(author_ids, per_page, cursor=None):
+    """A Page of (message id, timestamp) rows, newest first, merged from
+    the recent lists of `author_ids`, starting after `cursor`.
+
+    Cursors are those of a (Message.timestamp, Message.id) keyset page, so
+    they work across both feed strategies.
+    """
+
+    lists = recent_messages(author_ids)
+    length = current_app.config['AUTHOR_RECENT_LENGTH']
+    after = decode_cursor(cursor, CURSOR_COLUMNS) if cursor else None
+
+    # authors whose list may have been cut short, so whose older messages
+    # are read from the database once the merge runs past its end
+    more = {author_id for author_id, recent in lists.items()
+            if len(recent) >= length}
+    rows = []
+
+    def load_older(author_id, before):
+        limit = per_page + 1 - len(rows)
+        lists[author_id] = _load_older(author_id, before, limit)
+
+        if len(lists[author_id]) < limit:
+            more.discard(author_id)
+
+    # a heap of each list's next entry; popping the newest and pushing the
+    # next from its list, per_page times, merges the lists
+    heap = []
+
+    for author_id, recent in list(lists.items()):
+        position = _start(recent, after) if after else 0
+
+        if position == len(recent) and author_id in more:
+            load_older(author_id, after)
+            position = 0
+
+        if position < len(lists[author_id]):
+            heap.append((_heap_key(lists[author_id][position]), author_id,
+                         position))
+
+    heapq.heapify(heap)
+
+    while heap and len(rows) <= per_page:
+        _, author_id, position = heap[0]
+        recent = lists[author_id]
+
+        rows.append(recent[position])
+        position += 1
+
+        if (position == len(recent) and author_id in more
+                and len(rows) <= per_page):
+            load_older(author_id, recent[-1])
+            position = 0
+
+        if position < len(lists[author_id]):
+            heapq.heapreplace(
+                heap, (_heap_key(lists[author_id][position]), author_id,
+                       position))
+        else:
+            heapq.heappop(heap)
+
+    items = [(message_id, timestamp) for timestamp, message_id in rows]
+    next_cursor = None
+
+    if len(items) > per_page:
+        items = items[:per_page]
+        next_cursor = encode_cursor(rows[per_page - 1])
+
+    return Page(items, next_cursor)
+
+
+def init_merge_feed(app):
+    """Set up recent_cache from `app`'s config."""
+
+    recent_cache.configure(
+        app.config['RECENT_CACHE_SIZE'], app.config['RECENT_CACHE_TTL'])
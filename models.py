@@ -1,12 +1,34 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, DateTime, Integer, delete, event, exists, func
+from sqlalchemy import insert, literal, select, true, tuple_, union_all
+from sqlalchemy.dialects import postgresql, sqlite
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from caching import LRUCache
+from follow_graph import follow_graph
+from hashing import password_hasher
+from hashtags import parse_tags
+from routing import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
+
+# optional process-wide cache of user id -> frozenset of followed user ids;
+# sized by FOLLOW_CACHE_SIZE in connect_db (0, the default, disables it)
+follow_cache = LRUCache(max_size=0)
+
+# process-wide cache of user id -> CurrentUser fields for the logged-in
+# user; sized by CURRENT_USER_CACHE_SIZE in connect_db
+current_user_cache = LRUCache(max_size=0)
+
+# process-wide cache of leaderboard window -> LikeRollup.top() rows, kept
+# for LEADERBOARD_CACHE_TTL seconds (0 disables it); set up in connect_db
+leaderboard_cache = LRUCache(max_size=0)
+
+# the same for trending tag windows -> TagRollup.top() rows, kept for
+# TRENDING_CACHE_TTL seconds
+trending_cache = LRUCache(max_size=0)
 
 DEFAULT_IMAGE_URL = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
@@ -28,6 +50,34 @@ class Follows(db.Model):
         db.ForeignKey('users.id', ondelete="cascade"),
         primary_key=True,
     )
+
+    # the primary key covers "who follows X"; this covers "who X follows"
+    __table_args__ = (
+        db.Index(
+            'ix_follows_user_following_id',
+            'user_following_id', 'user_being_followed_id'),
+    )
+
+    # rows read from the table at a time when compacting the follow graph
+    GRAPH_CHUNK_SIZE = 100000
+
+    @classmethod
+    def edges(cls):
+        """Yield lists of (follower id, followed id) for every follow,
+        GRAPH_CHUNK_SIZE at a time."""
+
+        result = db.session.execute(
+            select(cls.user_following_id, cls.user_being_followed_id)
+            .execution_options(yield_per=cls.GRAPH_CHUNK_SIZE))
+
+        for rows in result.partitions():
+            yield [tuple(row) for row in rows]
+
+    @classmethod
+    def compact_graph(cls):
+        """Rebuild the follow graph snapshot from this table."""
+
+        follow_graph.compact(cls.edges(), User.id_limit())
 # is primary/secondary join because of composite primary keys?
 
 class User(db.Model):
@@ -75,19 +125,90 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', backref="user")
+    # denormalized counts, kept in step by the routes that change them and
+    # recomputed in bulk by User.recount()
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # bumped whenever the profile changes; cached fragments that show the
+    # user's name or image are keyed by it (see fragments.py)
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # bumped, with updated_at, whenever anything shown on the user's pages
+    # changes: their profile, counts, likes on their messages, or what
+    # they've liked and followed; pages derive their ETags from these
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=func.now(),
+    )
+
+    # set when the account is deleted; purge.py removes its rows later, and
+    # until then reads treat it as gone
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # rows that reference users and messages go with them through the
+    # foreign keys' ON DELETE CASCADE; passive_deletes stops the ORM from
+    # loading them first
+    messages = db.relationship(
+        'Message', backref="user", passive_deletes=True)
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
         secondaryjoin=(Follows.user_following_id == id),
-        backref="following",
+        backref=db.backref("following", passive_deletes=True),
+        passive_deletes=True,
     )
 
-    liked_messages = db.relationship('Message',
-                                    secondary="liked_messages",
-                                    backref="user_likes")
+    liked_messages = db.relationship(
+        'Message',
+        secondary="liked_messages",
+        backref=db.backref("user_likes", passive_deletes=True),
+        passive_deletes=True,
+    )
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
@@ -99,7 +220,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -111,6 +232,25 @@ class User(db.Model):
         db.session.add(user)
         return user
 
+    @classmethod
+    def id_limit(cls):
+        """One more than the largest user id."""
+
+        return (db.session.query(func.max(cls.id)).scalar() or 0) + 1
+
+    @classmethod
+    def active(cls):
+        """Query of the users that aren't deleted."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
+
+    @classmethod
+    def get_active_or_404(cls, user_id):
+        """The user with `user_id`, or a 404 if there's none or they're
+        deleted."""
+
+        return cls.active().filter(cls.id == user_id).first_or_404()
+
     @classmethod
     def authenticate(cls, username, password):
         """Find user with `username` and `password`.
@@ -121,37 +261,298 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        A hash made with an outdated work factor is replaced on the user;
+        the caller commits it.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Does `password` match this user's, without re-querying the user?
+
+        Upgrades the stored hash if its work factor is out of date.
+        """
+
+        if not password_hasher.check(self.password, password):
+            return False
+
+        if password_hasher.needs_rehash(self.password):
+            self.password = password_hasher.hash(password)
+
+        return True
+
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Add `deltas` to the count columns of `user_ids`, in SQL, and
+        bump their version.
+
+        `user_ids` may be a list or a select of ids, e.g.
+        User.adjust_counts([1, 2], followers_count=1)
+        """
+
+        values = {
+            getattr(cls, column): getattr(cls, column) + delta
+            for column, delta in deltas.items()}
+
+        (cls.query
+            .filter(cls.id.in_(user_ids))
+            .update({**values, **cls._bumped()}, synchronize_session=False))
+        cls._changed(user_ids)
+
+    @classmethod
+    def touch(cls, user_ids):
+        """Bump the version of `user_ids` (a list or select of ids), for
+        changes to their pages that don't change their counts."""
+
+        (cls.query
+            .filter(cls.id.in_(user_ids))
+            .update(cls._bumped(), synchronize_session=False))
+        cls._changed(user_ids)
+
+    @classmethod
+    def _bumped(cls):
+        return {cls.version: cls.version + 1,
+                cls.updated_at: datetime.utcnow()}
+
+    @classmethod
+    def _changed(cls, user_ids):
+        """Drop `user_ids` (None for every user) from current_user_cache
+        once the session commits; a select of ids is left to expire."""
+
+        if user_ids is None:
+            db.session.info['changed_all_users'] = True
+        elif isinstance(user_ids, (list, tuple, set, frozenset)):
+            db.session.info.setdefault('changed_users', set()).update(
+                user_ids)
+
+    @classmethod
+    def recount(cls, user_ids=None):
+        """Recompute the count columns from the source tables, bumping
+        versions.
+
+        Recounts `user_ids` (a list or select of ids), or every user.
+        """
+
+        def count(column, where):
+            return select(func.count(column)).where(where).scalar_subquery()
+
+        query = cls.query
+        if user_ids is not None:
+            query = query.filter(cls.id.in_(user_ids))
+
+        query.update({
+            cls.messages_count:
+                count(Message.id, Message.user_id == cls.id),
+            cls.following_count:
+                count(Follows.user_being_followed_id,
+                      Follows.user_following_id == cls.id),
+            cls.followers_count:
+                count(Follows.user_following_id,
+                      Follows.user_being_followed_id == cls.id),
+            cls.likes_count:
+                count(LikedMessage.message_id, LikedMessage.user_id == cls.id),
+            **cls._bumped(),
+        }, synchronize_session=False)
+        cls._changed(user_ids)
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_use`?
+
+        Checks the follow graph or the follow cache if either is enabled,
+        else does an indexed existence check on follows.
+        """
+
+        if follow_graph.enabled:
+            return follow_graph.is_following(self.id, other_user.id)
+
+        if follow_cache.enabled:
+            return other_user.id in self.following_ids()
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            Follows.query
+            .filter_by(user_being_followed_id=other_user.id,
+                       user_following_id=self.id)
+            .exists()
+        ).scalar()
+
+    def followed_among(self, user_ids):
+        """Return the frozenset of `user_ids` this user follows.
+
+        For pages of users: one indexed query, however many ids, unless
+        the follow graph or follow cache can answer.
+        """
+
+        user_ids = list(user_ids)
+
+        if not user_ids:
+            return frozenset()
+
+        if follow_graph.enabled or follow_cache.enabled:
+            return self.following_ids().intersection(user_ids)
+
+        return frozenset(
+            followed_id for (followed_id,) in db.session
+            .query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == self.id,
+                    Follows.user_being_followed_id.in_(user_ids)))
+
+    def following_ids(self):
+        """Return a frozenset of the ids this user follows.
+
+        Served from the follow graph or the follow cache when enabled; the
+        routes that change follows log to the graph and invalidate the
+        cache, and the cache's TTL bounds staleness in other workers.
+        """
+
+        if follow_graph.enabled:
+            return frozenset(follow_graph.following(self.id).tolist())
+
+        ids = follow_cache.get(self.id)
+
+        if ids is None:
+            ids = frozenset(
+                followed_id for (followed_id,) in db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id))
+            follow_cache.set(self.id, ids)
+
+        return ids
 
     def check_liked_message(self, message):
         """Checks if message is liked by current user"""
 
-        liked_message_list = [
-            msg for msg in self.liked_messages if msg == message]
-        return liked_message_list
+        return message.id in self.liked_message_ids([message.id])
+
+    def liked_message_ids(self, message_ids):
+        """Return the set of `message_ids` this user has liked.
+
+        One indexed query, however many ids; templates check membership in
+        the result instead of calling check_liked_message per message.
+        """
+
+        message_ids = list(message_ids)
+
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(LikedMessage.message_id)
+                .filter(LikedMessage.user_id == self.id,
+                        LikedMessage.message_id.in_(message_ids)))
+        return {message_id for (message_id,) in rows}
+
+
+# Indexes for username search (see search.py), which PostgreSQL can use for
+# case-insensitive prefix and substring matches. The trigram index needs the
+# pg_trgm extension, so it is only created where that is available.
+event.listen(User.__table__, 'after_create', DDL("""
+    CREATE INDEX IF NOT EXISTS ix_users_username_prefix
+        ON users (lower(username) text_pattern_ops);
+
+    DO $$
+    BEGIN
+        IF EXISTS (
+            SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'
+        ) THEN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+                ON users USING gin (lower(username) gin_trgm_ops);
+        END IF;
+    END
+    $$;
+""").execute_if(dialect='postgresql'))
+
+
+class CurrentUser:
+    """Stand-in for the logged-in user, held on g.user.
+
+    Carries the profile fields and counts templates show, and the version
+    page ETags need, loaded through current_user_cache so most requests
+    don't query the users table. Anything else (relationships, the
+    password) is read from the full User, which is loaded on first use;
+    routes that change the user should work on `.model` and then call
+    current_user_cache.delete(user.id). The count and version updates
+    (adjust_counts, touch, recount) drop the users they're given once the
+    session commits.
+    """
+
+    FIELDS = (
+        'id', 'username', 'email', 'image_url', 'header_image_url', 'bio',
+        'location', 'profile_version', 'messages_count', 'following_count',
+        'followers_count', 'likes_count', 'version', 'updated_at')
+
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+        self._model = None
+
+    @classmethod
+    def load(cls, user_id):
+        """Return a CurrentUser for `user_id`, or None if there is no such
+        user."""
+
+        fields = current_user_cache.get(user_id)
+
+        if fields is None:
+            row = (db.session
+                   .query(*[getattr(User, field) for field in cls.FIELDS])
+                   .filter(User.id == user_id, User.deleted_at.is_(None))
+                   .first())
+
+            if row is None:
+                return None
+
+            fields = row._asdict()
+            current_user_cache.set(user_id, fields)
+
+        return cls(fields)
+
+    @property
+    def model(self):
+        """The full User, loaded on first use."""
+
+        if self._model is None:
+            self._model = User.query.get(self.id)
+
+        return self._model
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    # these only need the user's id, so they don't load the full User
+    is_following = User.is_following
+    followed_among = User.followed_among
+    is_followed_by = User.is_followed_by
+    following_ids = User.following_ids
+    check_liked_message = User.check_liked_message
+    liked_message_ids = User.liked_message_ids
+
+
+@event.listens_for(db.session, 'after_commit')
+def _forget_changed_users(session):
+    if session.info.pop('changed_all_users', False):
+        current_user_cache.clear()
+
+    current_user_cache.delete(*session.info.pop('changed_users', ()))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _keep_unchanged_users(session):
+    session.info.pop('changed_all_users', None)
+    session.info.pop('changed_users', None)
 
 
 class Message(db.Model):
@@ -181,6 +582,45 @@ class Message(db.Model):
     )
     # must enable nullable on foreign key for ondelete cascade to delete record
 
+    # kept by likes.apply_likes, so lists don't count likes per message
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_messages_user_id_timestamp',
+            'user_id', 'timestamp', 'id'),
+    )
+
+    @classmethod
+    def adjust_likes(cls, message_ids, delta):
+        """Add `delta` to the likes_count of `message_ids`, in SQL."""
+
+        (cls.query
+            .filter(cls.id.in_(message_ids))
+            .update({cls.likes_count: cls.likes_count + delta},
+                    synchronize_session=False))
+
+    @classmethod
+    def recount_likes(cls, message_ids=None):
+        """Recompute likes_count from the likes table, for `message_ids`
+        (a list or select of ids) or every message."""
+
+        query = cls.query
+        if message_ids is not None:
+            query = query.filter(cls.id.in_(message_ids))
+
+        query.update({
+            cls.likes_count:
+                select(func.count(LikedMessage.user_id))
+                .where(LikedMessage.message_id == cls.id)
+                .scalar_subquery(),
+        }, synchronize_session=False)
+
 class LikedMessage(db.Model):
     """Connection of a messages <-> liked_by_user."""
 
@@ -198,6 +638,790 @@ class LikedMessage(db.Model):
         primary_key=True,
     )
 
+    # when the like was made; unliking takes it off that hour's rollup
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=func.now(),
+    )
+
+    # the primary key covers a user's likes; this covers a message's, for
+    # like counts and the cascade when a message is deleted
+    __table_args__ = (
+        db.Index(
+            'ix_liked_messages_message_id',
+            'message_id', 'user_id'),
+    )
+
+
+class HourlyRollup:
+    """Counts kept per hour, summed over a window for a ranking.
+
+    Subclasses are models with a `bucket` primary key column, the start of
+    the hour, next to their key column(s) and a count column.
+    """
+
+    BUCKET = timedelta(hours=1)
+
+    RETENTION = timedelta(days=7)
+
+    # ranking windows, by the name used in URLs
+    WINDOWS = {
+        '24h': timedelta(hours=24),
+        '7d': timedelta(days=7),
+    }
+
+    @classmethod
+    def bucket_of(cls, timestamp):
+        """The bucket `timestamp` falls in."""
+
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+
+    @classmethod
+    def window_start(cls, window, now=None):
+        """The first bucket in `window`, one of WINDOWS, ending at `now`."""
+
+        now = now or datetime.utcnow()
+        return cls.bucket_of(now) - cls.WINDOWS[window] + cls.BUCKET
+
+    @classmethod
+    def _add(cls, key, count, deltas, now=None):
+        """Add `deltas`, {(key, bucket): delta}, to the `count` column of
+        the buckets, upserting on (`key`, bucket).
+
+        Deltas for buckets past RETENTION are dropped, as those buckets may
+        already be pruned.
+        """
+
+        oldest = cls.bucket_of(now or datetime.utcnow()) - cls.RETENTION
+        rows = [{key.key: value, 'bucket': bucket, count.key: delta}
+                for (value, bucket), delta in sorted(deltas.items())
+                if delta and bucket > oldest]
+
+        if not rows:
+            return
+
+        dialect = postgresql
+        if db.engine.dialect.name == 'sqlite':
+            dialect = sqlite
+
+        statement = dialect.insert(cls)
+        db.session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[key, cls.bucket],
+                set_={count.key: count + getattr(statement.excluded,
+                                                 count.key)}),
+            rows)
+
+    @classmethod
+    def _top(cls, key, count, window, limit, now=None):
+        """The `limit` (key, total) pairs with the highest `count` totals
+        in `window`, highest first."""
+
+        total = func.sum(count).label('total')
+
+        return db.session.execute(
+            select(key, total)
+            .where(cls.bucket >= cls.window_start(window, now))
+            .group_by(key)
+            .having(total > 0)
+            .order_by(total.desc(), key.desc())
+            .limit(limit)).all()
+
+    @classmethod
+    def _rebuild(cls, columns, key, timestamp, now=None):
+        """Rebuild the buckets within RETENTION, counting rows of `key` by
+        the hour of `timestamp`, columns of the table the rollup sums.
+
+        Used after bulk loads, which don't add to the rollups.
+        """
+
+        oldest = cls.bucket_of(now or datetime.utcnow()) - cls.RETENTION
+        bucket = func.date_trunc('hour', timestamp)
+        if db.engine.dialect.name == 'sqlite':
+            # in the format SQLAlchemy stores SQLite datetimes in
+            bucket = func.strftime('%Y-%m-%d %H:00:00.000000', timestamp)
+
+        db.session.execute(delete(cls))
+        db.session.execute(
+            insert(cls).from_select(
+                columns,
+                select(key, bucket, func.count())
+                .where(timestamp >= oldest + cls.BUCKET)
+                .group_by(key, bucket)))
+
+    @classmethod
+    def prune(cls, now=None):
+        """Delete buckets past RETENTION; returns how many."""
+
+        oldest = cls.bucket_of(now or datetime.utcnow()) - cls.RETENTION
+
+        return db.session.execute(
+            delete(cls).where(cls.bucket <= oldest)).rowcount
+
+
+class LikeRollup(HourlyRollup, db.Model):
+    """Likes a message got in one hour, for the most-liked leaderboard.
+
+    Kept up to date by likes.apply_likes: a like adds one to the bucket of
+    the hour it was made, and unliking takes it off again. A window's
+    leaderboard sums that window's buckets, a few rows per liked message,
+    rather than counting the likes table. Buckets older than RETENTION
+    are dropped by prune().
+    """
+
+    __tablename__ = 'message_like_rollups'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    # start of the hour
+    bucket = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_message_like_rollups_bucket',
+            'bucket', 'message_id', 'likes'),
+    )
+
+    @classmethod
+    def add(cls, deltas, now=None):
+        """Add `deltas`, {(message_id, bucket): delta}, to the buckets."""
+
+        cls._add(cls.message_id, cls.likes, deltas, now)
+
+    @classmethod
+    def top(cls, window, limit, now=None):
+        """The `limit` most liked messages in `window`, as (message_id,
+        likes) pairs, most liked first."""
+
+        return cls._top(cls.message_id, cls.likes, window, limit, now)
+
+    @classmethod
+    def leaderboard(cls, window):
+        """top() for `window`, LEADERBOARD_SIZE long, through the
+        leaderboard cache."""
+
+        rows = leaderboard_cache.get(window)
+
+        if rows is None:
+            rows = cls.top(window, db.get_app().config['LEADERBOARD_SIZE'])
+            leaderboard_cache.set(window, rows)
+
+        return rows
+
+    @classmethod
+    def rebuild(cls, now=None):
+        """Rebuild the buckets within RETENTION from the likes table."""
+
+        cls._rebuild(
+            [cls.message_id, cls.bucket, cls.likes],
+            LikedMessage.message_id, LikedMessage.timestamp, now)
+
+
+class MessageTag(db.Model):
+    """A hashtag in a message: the inverted index behind the tag pages.
+
+    Written by index() when a message is posted. The message's timestamp
+    is copied in, so a tag's page, newest first, is one range read on
+    (tag, timestamp).
+    """
+
+    __tablename__ = 'message_tags'
+
+    # lowercased, without the # (see hashtags.py)
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_message_tags_tag_timestamp',
+            'tag', 'timestamp', 'message_id'),
+        db.Index(
+            'ix_message_tags_message_id',
+            'message_id'),
+    )
+
+    CHUNK_SIZE = 10000
+
+    @classmethod
+    def index(cls, message):
+        """Index the tags in `message`, which must be flushed, and count
+        them towards trending."""
+
+        tags = parse_tags(message.text)
+
+        if not tags:
+            return
+
+        db.session.execute(insert(cls), [
+            {'tag': tag, 'message_id': message.id,
+             'timestamp': message.timestamp}
+            for tag in tags])
+        TagRollup.add({
+            (tag, TagRollup.bucket_of(message.timestamp)): 1
+            for tag in tags})
+
+    @classmethod
+    def unindex(cls, message_ids):
+        """Take the tags of `message_ids`, about to be deleted, off
+        trending; their rows go with the messages."""
+
+        deltas = {}
+
+        for tag, timestamp in (db.session
+                               .query(cls.tag, cls.timestamp)
+                               .filter(cls.message_id.in_(message_ids))):
+            key = (tag, TagRollup.bucket_of(timestamp))
+            deltas[key] = deltas.get(key, 0) - 1
+
+        TagRollup.add(deltas)
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild the index from the messages table.
+
+        Used after bulk loads, which bypass index().
+        """
+
+        db.session.execute(delete(cls))
+
+        result = db.session.execute(
+            select(Message.id, Message.text, Message.timestamp)
+            .execution_options(yield_per=cls.CHUNK_SIZE))
+
+        for messages in result.partitions():
+            rows = [{'tag': tag, 'message_id': id, 'timestamp': timestamp}
+                    for id, text, timestamp in messages
+                    for tag in parse_tags(text)]
+
+            if rows:
+                db.session.execute(insert(cls), rows)
+
+
+class TagRollup(HourlyRollup, db.Model):
+    """Messages posted with a tag in one hour, for trending tags.
+
+    Kept up to date by MessageTag.index() and unindex(), so a window's
+    trending tags sum that window's buckets, never reading the messages
+    or their tags. Buckets older than RETENTION are dropped by prune().
+    """
+
+    __tablename__ = 'tag_rollups'
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # start of the hour
+    bucket = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    uses = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_tag_rollups_bucket',
+            'bucket', 'tag', 'uses'),
+    )
+
+    @classmethod
+    def add(cls, deltas, now=None):
+        """Add `deltas`, {(tag, bucket): delta}, to the buckets."""
+
+        cls._add(cls.tag, cls.uses, deltas, now)
+
+    @classmethod
+    def top(cls, window, limit, now=None):
+        """The `limit` most used tags in `window`, as (tag, uses) pairs,
+        most used first."""
+
+        return cls._top(cls.tag, cls.uses, window, limit, now)
+
+    @classmethod
+    def trending(cls, window):
+        """top() for `window`, TRENDING_SIZE long, through the trending
+        cache."""
+
+        rows = trending_cache.get(window)
+
+        if rows is None:
+            rows = cls.top(window, db.get_app().config['TRENDING_SIZE'])
+            trending_cache.set(window, rows)
+
+        return rows
+
+    @classmethod
+    def rebuild(cls, now=None):
+        """Rebuild the buckets within RETENTION from the tag index."""
+
+        cls._rebuild(
+            [cls.tag, cls.bucket, cls.uses],
+            MessageTag.tag, MessageTag.timestamp, now)
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's home timeline.
+
+    Rows are written when a message is posted (fan-out on write), so reading
+    the home feed is a single range read on (user_id, timestamp). A
+    timeline that grows TIMELINE_SLACK entries past TIMELINE_LENGTH is cut
+    back to the newest TIMELINE_LENGTH by trim(), which `flask
+    trim-timelines` runs (e.g. from cron) rather than every post, on the
+    timelines whose TimelineSize says they've grown that far.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # author of the message, so unfollowing is a delete on (user, author)
+    # and a deleted author's entries go with them
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_timeline_entries_user_id_timestamp',
+            'user_id', 'timestamp', 'message_id'),
+        # for the cascades when a message or its author is deleted
+        db.Index(
+            'ix_timeline_entries_message_id',
+            'message_id'),
+        db.Index(
+            'ix_timeline_entries_author_id',
+            'author_id'),
+    )
+
+    COLUMNS = ['user_id', 'message_id', 'author_id', 'timestamp']
+
+    @classmethod
+    def fan_out(cls, message):
+        """Add `message` to its author's timeline and all their followers'.
+
+        The message must already be flushed so it has an id. Timelines
+        that already have it, e.g. from a backfill, are skipped.
+        """
+
+        recipients = union_all(
+            select(literal(message.user_id, Integer).label('user_id'))
+            .where(~cls.has(message.user_id, message.id)),
+            select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == message.user_id)
+            .where(Follows.user_following_id != message.user_id)
+            .where(~cls.has(Follows.user_following_id, message.id)),
+        ).subquery()
+
+        # counted first, while has() still picks the same timelines
+        TimelineSize.add(select(recipients.c.user_id, literal(1, Integer)))
+        db.session.execute(
+            insert(cls).from_select(
+                cls.COLUMNS,
+                select(
+                    recipients.c.user_id,
+                    literal(message.id, Integer),
+                    literal(message.user_id, Integer),
+                    literal(message.timestamp, DateTime),
+                )))
+
+    @classmethod
+    def backfill(cls, user_id, author_id):
+        """Copy `author_id`'s recent messages into `user_id`'s timeline.
+
+        Called when `user_id` starts following `author_id`; does nothing if
+        they've stopped since, and skips messages already there, e.g. from
+        a fan-out.
+        """
+
+        recent = (
+            select(
+                literal(user_id, Integer),
+                Message.id,
+                Message.user_id,
+                Message.timestamp,
+            )
+            .where(Message.user_id == author_id)
+            .where(exists().where(
+                Follows.user_being_followed_id == author_id,
+                Follows.user_following_id == user_id))
+            .where(~cls.has(user_id, Message.id))
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(db.get_app().config['TIMELINE_LENGTH'])
+        )
+
+        added = db.session.execute(
+            insert(cls).from_select(cls.COLUMNS, recent)).rowcount
+
+        if added:
+            TimelineSize.add(select(literal(user_id, Integer),
+                                    literal(added, Integer)))
+
+    @classmethod
+    def has(cls, user_id, message_id):
+        """EXISTS clause: is `message_id` in `user_id`'s timeline?"""
+
+        return exists().where(
+            cls.user_id == user_id, cls.message_id == message_id)
+
+    @classmethod
+    def remove_author(cls, user_id, author_id):
+        """Drop `author_id`'s messages from `user_id`'s timeline.
+
+        Called when `user_id` stops following `author_id`.
+        """
+
+        db.session.execute(
+            delete(cls)
+            .where(cls.user_id == user_id, cls.author_id == author_id)
+            .execution_options(synchronize_session=False))
+
+    @classmethod
+    def trim(cls, user_ids):
+        """Cut the timelines of `user_ids` that have grown past
+        TIMELINE_LENGTH + TIMELINE_SLACK back to the newest TIMELINE_LENGTH
+        entries; returns how many entries were deleted.
+
+        Each timeline costs an index probe at that offset, plus, if it's
+        overgrown, a probe for the oldest entry to keep and a range delete
+        of those older. Their TimelineSize rows are set to the sizes left.
+        """
+
+        config = db.get_app().config
+        length = config['TIMELINE_LENGTH']
+        limit = length + config['TIMELINE_SLACK']
+        deleted = 0
+
+        for user_id in user_ids:
+            newest = (
+                select(cls.timestamp, cls.message_id)
+                .where(cls.user_id == user_id)
+                .order_by(cls.timestamp.desc(), cls.message_id.desc())
+                .limit(1))
+
+            if db.session.execute(newest.offset(limit)).first() is None:
+                # overcounted, e.g. after unfollows; count what's there
+                size = db.session.execute(
+                    select(func.count()).select_from(
+                        select(cls.message_id)
+                        .where(cls.user_id == user_id)
+                        .limit(limit)
+                        .subquery())).scalar()
+            else:
+                size = length
+                oldest_kept = db.session.execute(
+                    newest.offset(length - 1)).one()
+                deleted += db.session.execute(
+                    delete(cls)
+                    .where(cls.user_id == user_id,
+                           tuple_(cls.timestamp, cls.message_id) <
+                           tuple_(*oldest_kept))
+                    .execution_options(synchronize_session=False)).rowcount
+
+            (TimelineSize.query
+                .filter_by(user_id=user_id)
+                .update({TimelineSize.entries: size},
+                        synchronize_session=False))
+
+        return deleted
+
+    @classmethod
+    def overgrown(cls):
+        """Ids of the users whose timelines trim() may cut, by their
+        TimelineSize."""
+
+        config = db.get_app().config
+
+        return [user_id for (user_id,) in db.session
+                .query(TimelineSize.user_id)
+                .filter(TimelineSize.entries >
+                        config['TIMELINE_LENGTH'] + config['TIMELINE_SLACK'])
+                .order_by(TimelineSize.user_id)]
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild every timeline from the messages and follows tables.
+
+        Used after bulk loads, which bypass fan-out.
+        """
+
+        sources = union_all(
+            select(User.id.label('user_id'), User.id.label('author_id')),
+            select(
+                Follows.user_following_id,
+                Follows.user_being_followed_id,
+            ).where(
+                Follows.user_following_id != Follows.user_being_followed_id),
+        ).subquery()
+
+        ranked = (
+            select(
+                sources.c.user_id,
+                Message.id.label('message_id'),
+                Message.user_id.label('author_id'),
+                Message.timestamp,
+                func.row_number().over(
+                    partition_by=sources.c.user_id,
+                    order_by=(Message.timestamp.desc(), Message.id.desc()),
+                ).label('rank'),
+            )
+            .join(Message, Message.user_id == sources.c.author_id)
+            .subquery()
+        )
+
+        db.session.execute(delete(cls))
+        db.session.execute(
+            insert(cls).from_select(
+                cls.COLUMNS,
+                select(
+                    ranked.c.user_id,
+                    ranked.c.message_id,
+                    ranked.c.author_id,
+                    ranked.c.timestamp,
+                ).where(
+                    ranked.c.rank <= db.get_app().config['TIMELINE_LENGTH'])))
+        TimelineSize.rebuild()
+
+
+class TimelineSize(db.Model):
+    """How many entries a user's timeline has, so `flask trim-timelines`
+    finds the overgrown ones without counting timeline_entries.
+
+    Added to as entries are written (TimelineEntry.fan_out and backfill)
+    and set by TimelineEntry.trim(). Entries deleted otherwise (unfollows,
+    deleted messages) aren't taken off, so a size can run high, never low;
+    trim() checks the timeline before cutting it.
+    """
+
+    __tablename__ = 'timeline_sizes'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    entries = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        # for TimelineEntry.overgrown()
+        db.Index(
+            'ix_timeline_sizes_entries',
+            'entries'),
+    )
+
+    @classmethod
+    def add(cls, rows):
+        """Add `rows`, a select of (user_id, entries), to the sizes,
+        upserting on user_id."""
+
+        dialect = postgresql
+        if db.engine.dialect.name == 'sqlite':
+            dialect = sqlite
+
+        # SQLite can only parse an upsert from a select with a WHERE
+        statement = dialect.insert(cls).from_select(
+            ['user_id', 'entries'], rows.where(true()))
+        db.session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[cls.user_id],
+                set_={'entries': cls.entries + statement.excluded.entries}))
+
+    @classmethod
+    def rebuild(cls):
+        """Count every timeline again.
+
+        Used after bulk loads, which bypass fan-out, and by `flask recount`.
+        """
+
+        db.session.execute(delete(cls))
+        db.session.execute(
+            insert(cls).from_select(
+                ['user_id', 'entries'],
+                select(TimelineEntry.user_id, func.count())
+                .group_by(TimelineEntry.user_id)))
+
+
+class Job(db.Model):
+    """A unit of deferred work, waiting in or taken from the job queue.
+
+    See jobs.py. Rows are deleted once their job succeeds; jobs that
+    failed their last attempt stay, with status 'failed', for inspection.
+    """
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # the name a handler is registered under
+    type = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    # JSON
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # 'queued', 'running' or 'failed'
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='queued',
+        server_default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # not run before this; pushed back after each failed attempt
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # the worker batch running the job, and when it took it; a job whose
+    # lease has run out is taken again
+    locked_by = db.Column(
+        db.String(100),
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_jobs_type_status_run_at',
+            'type', 'status', 'run_at'),
+    )
+
+
+class FollowSuggestion(db.Model):
+    """A user `user_id` may want to follow, and how many of the people
+    they follow already follow them.
+
+    Rebuilt as a whole by `flask suggest-follows` (see suggestions.py).
+    """
+
+    __tablename__ = 'follow_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    suggested_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        # for the cascade when a suggested user is deleted
+        db.Index(
+            'ix_follow_suggestions_suggested_id',
+            'suggested_id'),
+    )
+
+    @classmethod
+    def for_user(cls, user_id, limit):
+        """Up to `limit` (user, score) suggestions for `user_id`, best
+        first, leaving out users they've followed since or that are
+        deleted."""
+
+        followed = exists().where(
+            Follows.user_following_id == user_id,
+            Follows.user_being_followed_id == cls.suggested_id)
+
+        return (db.session
+                .query(User, cls.score)
+                .join(cls, cls.suggested_id == User.id)
+                .filter(cls.user_id == user_id, User.deleted_at.is_(None))
+                .filter(~followed)
+                .order_by(cls.score.desc(), User.id)
+                .limit(limit)
+                .all())
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -207,3 +1431,23 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+
+    password_hasher.configure(
+        app.config.get('BCRYPT_LOG_ROUNDS', 12),
+        app.config.get('HASH_WORKERS', 0),
+        app.config.get('HASH_QUEUE_DEPTH', 0),
+        app.config.get('HASH_TIMEOUT'))
+    follow_cache.configure(
+        app.config.get('FOLLOW_CACHE_SIZE', 0),
+        app.config.get('FOLLOW_CACHE_TTL'))
+    current_user_cache.configure(
+        app.config.get('CURRENT_USER_CACHE_SIZE', 0),
+        app.config.get('CURRENT_USER_CACHE_TTL'))
+
+    leaderboard_ttl = app.config.get('LEADERBOARD_CACHE_TTL', 0)
+    leaderboard_cache.configure(
+        len(LikeRollup.WINDOWS) if leaderboard_ttl else 0, leaderboard_ttl)
+
+    trending_ttl = app.config.get('TRENDING_CACHE_TTL', 0)
+    trending_cache.configure(
+        len(TagRollup.WINDOWS) if trending_ttl else 0, trending_ttl)
@@ -0,0 +1,117 @@
+"""Keyset (cursor) pagination for Warbler list pages.
+
+Pages are read in order of a sort key such as (timestamp, id), newest-first
+unless asked otherwise. The cursor for the next page is the key of the last
+row shown, so fetching any page is an indexed range read no matter how deep
+it is.
+
+Cursors are the key values joined with "|" and urlsafe base64 encoded,
+e.g. "2017-01-21T11:04:53.522807|42".
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime
+
+from flask import abort, request, url_for
+from sqlalchemy import DateTime, tuple_
+
+
+class Page:
+    """One page of results plus the cursor for the page after it."""
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def next_url(self):
+        """URL of the next page of the current route, or None."""
+
+        if not self.next_cursor:
+            return None
+
+        args = {**request.view_args, **request.args.to_dict()}
+        args['cursor'] = self.next_cursor
+        return url_for(request.endpoint, **args)
+
+
+def encode_cursor(values):
+    """Encode a tuple of key values (datetimes or ints) as a cursor."""
+
+    parts = [
+        value.isoformat() if isinstance(value, datetime) else str(value)
+        for value in values]
+    return urlsafe_b64encode('|'.join(parts).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """Decode `cursor` into values typed like `columns`.
+
+    Aborts with 400 if the cursor is malformed.
+    """
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        parts = urlsafe_b64decode(padded).decode().split('|')
+
+        if len(parts) != len(columns):
+            raise ValueError(cursor)
+
+        return tuple(
+            datetime.fromisoformat(part)
+            if isinstance(column.type, DateTime) else int(part)
+            for part, column in zip(parts, columns))
+
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        abort(400)
+
+
+def keyset(query, columns, cursor=None, descending=True):
+    """`query` ordered by `columns`, starting after `cursor` if given."""
+
+    if cursor:
+        values = decode_cursor(cursor, columns)
+
+        if descending:
+            query = query.filter(tuple_(*columns) < tuple_(*values))
+        else:
+            query = query.filter(tuple_(*columns) > tuple_(*values))
+
+    return query.order_by(*[
+        column.desc() if descending else column.asc()
+        for column in columns])
+
+
+def paginate(query, columns, per_page, cursor=None, key=None,
+             descending=True):
+    """Return a Page of `query` ordered by `columns`.
+
+    - columns: the sort key, e.g. (Message.timestamp, Message.id)
+    - cursor: cursor from a previous page, or None for the first page
+    - key: function giving the sort key of a result row; defaults to
+      reading the columns' attribute names off the row
+    - descending: newest-first (the default) or ascending order
+    """
+
+    if key is None:
+        def key(row):
+            return tuple(getattr(row, column.key) for column in columns)
+
+    rows = (keyset(query, columns, cursor, descending)
+            .limit(per_page + 1)
+            .all())
+
+    items = rows[:per_page]
+    next_cursor = None
+
+    if len(rows) > per_page:
+        next_cursor = encode_cursor(key(items[-1]))
+
+    return Page(items, next_cursor)
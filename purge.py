@@ -0,0 +1,217 @@
+"""Account deletion for Warbler.
+
+Deleting a user row makes the database delete everything that references
+it through the foreign keys' ON DELETE CASCADE: messages, follows, likes,
+timeline entries. For a big account that is one statement touching
+millions of rows, holding locks for as long as it runs, and the counts of
+everyone they followed or liked still need fixing afterwards.
+
+So delete_account() first soft-deletes the user (sets deleted_at), which
+takes them out of every page at once. Then purge_user() removes their
+rows in batches of PURGE_BATCH_SIZE, committing after each, fixing other
+users' counts as it goes, and finally deletes the user row. Accounts with
+up to ACCOUNT_PURGE_THRESHOLD rows are purged within the request; bigger
+ones by a purge_user job (see jobs.py), or, if jobs run eagerly, on a
+background thread, so the request returns at once. If a thread dies
+mid-purge, `flask purge-deleted` finishes the job.
+"""
+
+from datetime import datetime
+from threading import Thread
+
+from flask import current_app
+from sqlalchemy import delete, select, tuple_
+
+from follow_graph import follow_graph
+from jobs import enqueue
+from likes import apply_likes
+from models import (
+    db, current_user_cache, follow_cache, Follows, FollowSuggestion,
+    LikedMessage, Message, MessageTag, TimelineEntry, User)
+from search import username_index
+
+
+def account_size(user):
+    """Roughly how many rows deleting `user` touches, counting their
+    messages' copies in their followers' timelines."""
+
+    fan_out = user.followers_count * min(
+        user.messages_count, current_app.config['TIMELINE_LENGTH'])
+
+    return (user.messages_count + user.following_count +
+            user.followers_count + user.likes_count + fan_out)
+
+
+def delete_account(user):
+    """Soft-delete `user` and purge them, now or in the background.
+
+    Commits. Returns the purging thread, or None if the purge is done or
+    queued.
+    """
+
+    user.deleted_at = datetime.utcnow()
+    # they drop off the follow pages of everyone on either side at once
+    User.touch(select(Follows.user_following_id)
+               .where(Follows.user_being_followed_id == user.id))
+    User.touch(select(Follows.user_being_followed_id)
+               .where(Follows.user_following_id == user.id))
+    db.session.commit()
+    current_user_cache.delete(user.id)
+    username_index.invalidate()
+
+    if account_size(user) <= current_app.config['ACCOUNT_PURGE_THRESHOLD']:
+        purge_user(user.id)
+        return None
+
+    if not current_app.config['JOBS_EAGER']:
+        enqueue('purge_user', {'user_id': user.id})
+        db.session.commit()
+        return None
+
+    app = current_app._get_current_object()
+    thread = Thread(target=_purge_in_app, args=(app, user.id),
+                    name=f'purge-user-{user.id}', daemon=True)
+    thread.start()
+
+    return thread
+
+
+def _purge_in_app(app, user_id):
+    with app.app_context():
+        try:
+            purge_user(user_id)
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Purging user #%s failed", user_id)
+
+
+def _batches(query):
+    """Yield lists of `query`'s rows, PURGE_BATCH_SIZE at a time, until
+    it comes back empty; the caller deletes each batch."""
+
+    size = current_app.config['PURGE_BATCH_SIZE']
+
+    while True:
+        rows = query.limit(size).all()
+
+        if not rows:
+            return
+
+        yield rows
+
+
+def _delete_returning(model, where, *columns):
+    """Delete `model`'s rows matching `where`; returns the `columns` of
+    the rows this statement deleted, so a purge running alongside can't
+    have them counted twice."""
+
+    table = model.__table__
+
+    if db.engine.dialect.name == 'postgresql':
+        return db.session.execute(
+            table.delete().where(where).returning(*columns)).all()
+
+    # SQLite has one writer at a time, so nothing goes in between
+    rows = db.session.execute(select(*columns).where(where)).all()
+    db.session.execute(table.delete().where(where))
+
+    return rows
+
+
+def _purge_rows(model, *where):
+    """Delete `model`'s rows matching `where`, a batch at a time."""
+
+    key = list(model.__table__.primary_key.columns)
+
+    for rows in _batches(db.session.query(*key).filter(*where)):
+        db.session.execute(
+            delete(model)
+            .where(tuple_(*key).in_([tuple(row) for row in rows]))
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+
+
+def _purge_likes(user_id):
+    for rows in _batches(
+            db.session.query(LikedMessage.message_id)
+            .filter(LikedMessage.user_id == user_id)):
+        apply_likes({(user_id, message_id): False for (message_id,) in rows})
+        db.session.commit()
+
+
+def _purge_follows(user_id, column, other_column, other_count):
+    """Delete the follows with `user_id` in `column`, taking one off the
+    `other_count` column of the users at the other end."""
+
+    key = (Follows.user_following_id, Follows.user_being_followed_id)
+
+    for rows in _batches(db.session.query(*key).filter(column == user_id)):
+        rows = _delete_returning(
+            Follows, tuple_(*key).in_([tuple(row) for row in rows]), *key)
+        edges = [tuple(row) for row in rows]
+        others = [getattr(row, other_column.key) for row in rows]
+
+        User.adjust_counts(
+            [id for id in others if id != user_id], **{other_count: -1})
+        db.session.commit()
+        follow_cache.delete(*others)
+        follow_graph.record([
+            (follower_id, followed_id, False)
+            for follower_id, followed_id in edges])
+
+
+def _purge_messages(user_id):
+    for rows in _batches(
+            db.session.query(Message.id).filter(Message.user_id == user_id)):
+        message_ids = [id for (id,) in rows]
+
+        likers = {id for (id,) in _delete_returning(
+            LikedMessage, LikedMessage.message_id.in_(message_ids),
+            LikedMessage.user_id)}
+
+        MessageTag.unindex(message_ids)
+
+        # the tags and rollups go with the messages
+        db.session.execute(
+            delete(Message)
+            .where(Message.id.in_(message_ids))
+            .execution_options(synchronize_session=False))
+        User.recount(list(likers))
+        db.session.commit()
+
+
+def purge_user(user_id):
+    """Delete soft-deleted `user_id`'s rows in batches, then the user."""
+
+    _purge_likes(user_id)
+    _purge_follows(user_id, Follows.user_being_followed_id,
+                   Follows.user_following_id, 'following_count')
+    _purge_follows(user_id, Follows.user_following_id,
+                   Follows.user_being_followed_id, 'followers_count')
+    # their messages' copies in followers' timelines, before the messages
+    # would take them in one cascade per batch
+    _purge_rows(TimelineEntry, TimelineEntry.author_id == user_id)
+    _purge_messages(user_id)
+    _purge_rows(TimelineEntry, TimelineEntry.user_id == user_id)
+    _purge_rows(FollowSuggestion, FollowSuggestion.user_id == user_id)
+    _purge_rows(FollowSuggestion, FollowSuggestion.suggested_id == user_id)
+
+    # nothing references the user now
+    db.session.execute(
+        delete(User)
+        .where(User.id == user_id)
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+    follow_cache.delete(user_id)
+
+
+def purge_deleted():
+    """Purge every soft-deleted user; returns how many."""
+
+    user_ids = [id for (id,) in db.session.query(User.id)
+                .filter(User.deleted_at.isnot(None))]
+
+    for user_id in user_ids:
+        purge_user(user_id)
+
+    return len(user_ids)
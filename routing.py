@@ -0,0 +1,88 @@
+"""Read-replica routing for Warbler's database session.
+
+With SQLALCHEMY_REPLICA_URIS set, SELECTs made while handling a GET or HEAD
+request, including lazy loads from templates, go to one of the replicas
+(picked once per request). Everything else goes to the primary: writes,
+reads in any other request, reads after the session has written anything,
+and reads outside a request, like CLI commands.
+
+Replicas lag behind the primary, so after a request that may have written
+(a POST), the user's reads stick to the primary for REPLICA_STICKY_SECONDS,
+tracked in their session cookie. That way the page a POST redirects to
+shows the change it made.
+"""
+
+import random
+from time import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, orm
+from sqlalchemy.sql import CompoundSelect, Select
+
+READ_METHODS = ('GET', 'HEAD')
+
+PRIMARY_UNTIL_KEY = 'primary_until'
+
+# replica URI -> engine
+_engines = {}
+
+
+def replica_engine(uri):
+    engine = _engines.get(uri)
+
+    if engine is None:
+        engine = _engines[uri] = create_engine(uri)
+
+    return engine
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends a GET request's reads to a replica."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wrote = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._reads_from_replica(clause):
+            if 'replica_uri' not in g:
+                g.replica_uri = random.choice(
+                    current_app.config['SQLALCHEMY_REPLICA_URIS'])
+
+            return replica_engine(g.replica_uri)
+
+        if self._flushing or not isinstance(clause, (Select, CompoundSelect)):
+            self._wrote = True
+
+        return super().get_bind(mapper, clause)
+
+    def _reads_from_replica(self, clause):
+        return (
+            has_request_context()
+            and bool(current_app.config['SQLALCHEMY_REPLICA_URIS'])
+            and request.method in READ_METHODS
+            and not self._wrote
+            and not self._flushing
+            and isinstance(clause, (Select, CompoundSelect))
+            and session.get(PRIMARY_UNTIL_KEY, 0) <= time())
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with RoutingSession as its session class."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def init_replica_routing(app):
+    """Keep users on the primary for a while after requests that write."""
+
+    @app.after_request
+    def stick_to_primary(response):
+        if (app.config['SQLALCHEMY_REPLICA_URIS'] and
+                request.method not in READ_METHODS):
+            session[PRIMARY_UNTIL_KEY] = (
+                time() + app.config['REPLICA_STICKY_SECONDS'])
+
+        return response
@@ -0,0 +1,171 @@
+"""Username search for the /users directory.
+
+Results are case-insensitive substring matches, ranked exact match, then
+prefix match, then any other substring match, and paged with a
+(rank, id) cursor.
+
+On PostgreSQL the search runs in SQL against the indexes on lower(username)
+(see models.py). Exact and prefix matches are a LIKE 'q%' range read of the
+text_pattern_ops btree; the other substring matches are only queried when
+those don't fill the page, through the trigram GIN index where the pg_trgm
+extension is available (a scan of the users table otherwise). Other
+databases (SQLite test runs) use an in-process sorted index instead.
+"""
+
+from bisect import bisect_left
+from time import monotonic
+
+from sqlalchemy import case, func
+
+from models import db, User
+from pagination import Page, decode_cursor, encode_cursor, keyset
+
+EXACT = 0
+PREFIX = 1
+SUBSTRING = 2
+
+
+def search_rank(username, search):
+    """Rank of `username` for lowercased `search` (lower ranks first)."""
+
+    name = username.lower()
+
+    if name == search:
+        return EXACT
+
+    if name.startswith(search):
+        return PREFIX
+
+    return SUBSTRING
+
+
+def rank_column(search):
+    """SQL expression computing search_rank() for the users table."""
+
+    name = func.lower(User.username)
+
+    return case(
+        (name == search, EXACT),
+        (name.startswith(search, autoescape=True), PREFIX),
+        else_=SUBSTRING,
+    )
+
+
+class UsernameIndex:
+    """Sorted in-memory list of (lowercased username, id).
+
+    Exact and prefix matches are a bisect; substring matches scan the list.
+    Used when the database has no trigram support. The list is rebuilt
+    after `ttl` seconds or when invalidate() is called, which the routes
+    that add, rename or delete users do.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._names = None
+        self._loaded_at = None
+
+    def invalidate(self):
+        self._names = None
+
+    def _load(self):
+        if self._names is None or monotonic() - self._loaded_at > self.ttl:
+            rows = (db.session.query(User.username, User.id)
+                    .filter(User.deleted_at.is_(None)))
+            self._names = sorted((name.lower(), id) for name, id in rows)
+            self._loaded_at = monotonic()
+
+        return self._names
+
+    def search(self, search):
+        """Return (rank, id) pairs matching `search`, in rank order."""
+
+        names = self._load()
+
+        start = bisect_left(names, (search,))
+        end = bisect_left(names, (search + '\uffff',))
+
+        matches = [
+            (EXACT if name == search else PREFIX, id)
+            for name, id in names[start:end]]
+        matches.extend(
+            (SUBSTRING, id)
+            for name, id in names[:start] + names[end:]
+            if search in name)
+
+        return sorted(matches)
+
+
+username_index = UsernameIndex()
+
+
+def prefix_pattern(search):
+    """LIKE pattern matching names that start with `search`, escaped with
+    "/"; a literal, so PostgreSQL can plan it as a btree range."""
+
+    escaped = (search.replace('/', '//').replace('%', '/%')
+               .replace('_', '/_'))
+
+    return f'{escaped}%'
+
+
+def _search_sql(search, per_page, cursor):
+    """search_users() on PostgreSQL: the exact and prefix matches, then,
+    if they don't fill the page, the other substring matches."""
+
+    name = func.lower(User.username)
+    prefix = name.like(prefix_pattern(search), escape='/')
+    columns = (rank_column(search), User.id)
+    after = decode_cursor(cursor, columns) if cursor else None
+    rows = []
+
+    if after is None or after[0] != SUBSTRING:
+        rows = (keyset(User.active().filter(prefix), columns, cursor,
+                       descending=False)
+                .limit(per_page + 1)
+                .all())
+
+    if len(rows) <= per_page:
+        query = User.active().filter(
+            name.contains(search, autoescape=True), ~prefix)
+
+        if after is not None and after[0] == SUBSTRING:
+            query = query.filter(User.id > after[1])
+
+        rows += query.order_by(User.id).limit(per_page + 1 - len(rows)).all()
+
+    next_cursor = None
+
+    if len(rows) > per_page:
+        last = rows[per_page - 1]
+        next_cursor = encode_cursor((search_rank(last.username, search),
+                                     last.id))
+
+    return Page(rows[:per_page], next_cursor)
+
+
+def search_users(search, per_page, cursor=None):
+    """Return a Page of users whose username contains `search`."""
+
+    search = search.lower()
+
+    if db.engine.dialect.name == 'postgresql':
+        return _search_sql(search, per_page, cursor)
+
+    matches = username_index.search(search)
+
+    if cursor:
+        after = decode_cursor(cursor, (rank_column(search), User.id))
+        matches = [match for match in matches if match > after]
+
+    page = matches[:per_page]
+    users = {
+        user.id: user
+        for user in User.query.filter(User.id.in_([id for _, id in page]))}
+
+    next_cursor = None
+
+    if len(matches) > per_page:
+        next_cursor = encode_cursor(page[-1])
+
+    return Page([users[id] for _, id in page if id in users], next_cursor)
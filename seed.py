@@ -1,19 +1,10 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
-
-db.drop_all()
-db.create_all()
-
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+Drops and recreates all tables. To load a large snapshot from another
+directory, or into existing tables, use `flask load DIRECTORY`.
+"""
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+from app import db
+from loader import load_csvs
 
-db.session.commit()
+load_csvs('generator', drop=True)
@@ -0,0 +1,40 @@
+// Like buttons in message lists: like and unlike in place through the JSON
+// toggle endpoint instead of posting the form and reloading the page, and
+// show the message's new like count. If the request fails, fall back to
+// posting the form.
+
+document.addEventListener("submit", async function (evt) {
+  const form = evt.target.closest("form.like-form");
+  if (!form) return;
+
+  evt.preventDefault();
+
+  const like = form.action.endsWith("/like");
+  const data = new FormData(form);
+  data.append("liked", like ? "true" : "false");
+
+  let result;
+  try {
+    const resp = await fetch(form.dataset.toggleUrl, { method: "POST", body: data });
+    if (!resp.ok) throw new Error(resp.statusText);
+    result = await resp.json();
+  } catch (err) {
+    form.submit();
+    return;
+  }
+
+  const base = form.action.slice(0, form.action.lastIndexOf("/"));
+  form.action = `${base}/${result.liked ? "unlike" : "like"}`;
+
+  const button = form.querySelector("button");
+  button.classList.toggle("btn-primary", result.liked);
+  button.classList.toggle("btn-outline-primary", !result.liked);
+  button.querySelector("i").className =
+    result.liked ? "bi bi-tree-fill" : "bi bi-tree";
+
+  const count = form.closest("li").querySelector(".likes-count");
+  if (count) {
+    count.textContent =
+      result.likes_count ? `\u00b7 ${result.likes_count} likes` : "";
+  }
+});
@@ -0,0 +1,113 @@
+"""Who-to-follow suggestions, scored offline from the follow graph.
+
+`flask suggest-follows` (e.g. nightly, from cron) reads the follows table
+into a sparse adjacency matrix A, with A[u, v] = 1 where u follows v, and
+scores each candidate w for user u by mutual connections: how many of the
+people u follows follow w, which is (A @ A)[u, w]. Users u already
+follows, and u themselves, are left out, and the SUGGESTIONS_PER_USER best
+of the rest are written to follow_suggestions, for the home page sidebar.
+
+A @ A is multiplied out SUGGESTION_BLOCK_SIZE rows at a time, so memory
+is bounded by one block's friends of friends, and each block's top
+candidates are picked with a sort over the whole block, not a loop per
+user. The table is replaced in one transaction, so pages keep reading the
+old suggestions until the new ones are all written.
+"""
+
+from time import perf_counter
+
+import numpy as np
+from flask import current_app
+from scipy import sparse
+from sqlalchemy import delete
+
+from follow_graph import edge_arrays
+from loader import copy_rows, insert_rows
+from models import db, Follows, FollowSuggestion, User
+
+COLUMNS = ['user_id', 'suggested_id', 'score']
+
+
+def adjacency(edges, size):
+    """CSR matrix A, with A[u, v] = 1 where u follows v, of `edges`, lists
+    of (follower id, followed id); `size` is one more than the largest
+    user id."""
+
+    followers, followed = edge_arrays(edges)
+
+    if len(followers):
+        size = max(size, int(followers.max()) + 1, int(followed.max()) + 1)
+
+    return sparse.csr_matrix(
+        (np.ones(len(followers), dtype=np.int32), (followers, followed)),
+        shape=(size, size))
+
+
+def top_candidates(following, start, stop, limit):
+    """(user ids, suggested ids, scores) arrays of the best `limit`
+    candidates for each of users `start` to `stop` - 1, best first.
+
+    `following` is the adjacency matrix; ties go to the lower id.
+    """
+
+    block = following[start:stop]
+    scores = block @ following
+
+    # zero out the users each one already follows
+    scores = (scores - scores.multiply(block)).tocoo()
+
+    users = scores.row.astype(np.int64) + start
+    keep = (scores.data > 0) & (scores.col != users)
+    users = users[keep]
+    candidates = scores.col[keep]
+    counts = scores.data[keep]
+
+    order = np.lexsort((candidates, -counts, users))
+    users, candidates, counts = users[order], candidates[order], counts[order]
+
+    # each entry's place among its user's candidates
+    rank = np.arange(len(users)) - np.searchsorted(users, users)
+    top = rank < limit
+
+    return users[top], candidates[top], counts[top]
+
+
+def suggest_follows(echo=print):
+    """Replace follow_suggestions with fresh scores from the follows table.
+
+    Returns how many suggestions were written.
+    """
+
+    limit = current_app.config['SUGGESTIONS_PER_USER']
+    block_size = current_app.config['SUGGESTION_BLOCK_SIZE']
+    started = perf_counter()
+
+    following = adjacency(Follows.edges(), User.id_limit())
+    size = following.shape[0]
+    echo(f"Read {following.nnz} follows in "
+         f"{perf_counter() - started:.1f}s.")
+
+    conn = db.session.connection()
+    load_rows = (copy_rows if db.engine.dialect.name == 'postgresql'
+                 else insert_rows)
+
+    db.session.execute(
+        delete(FollowSuggestion)
+        .execution_options(synchronize_session=False))
+
+    written = 0
+
+    for start in range(0, size, block_size):
+        users, candidates, scores = top_candidates(
+            following, start, min(start + block_size, size), limit)
+
+        if len(users):
+            load_rows(conn, FollowSuggestion.__tablename__, COLUMNS,
+                      zip(users.tolist(), candidates.tolist(),
+                          scores.tolist()))
+            written += len(users)
+
+    db.session.commit()
+    echo(f"Wrote {written} suggestions in {perf_counter() - started:.1f}s.")
+
+    return written
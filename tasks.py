@@ -0,0 +1,45 @@
+"""Job handlers for the follow-on work routes hand to the job queue.
+
+See jobs.py. A handler may see a job again after a worker died partway
+through it, so each must be safe to run twice.
+"""
+
+from jobs import handler
+from models import db, Message, TimelineEntry
+from purge import purge_user
+
+
+@handler('fan_out', batch_size=100, concurrency=4)
+def fan_out(payloads):
+    """Add new messages, [{'message_id'}], to their followers' timelines.
+
+    Timelines that already have a message are skipped (see
+    TimelineEntry.fan_out), and messages deleted since are dropped.
+    """
+
+    for payload in payloads:
+        # already in the session when run eagerly, from add_message
+        message = db.session.get(Message, payload['message_id'])
+
+        if message is not None:
+            TimelineEntry.fan_out(message)
+
+
+@handler('backfill', batch_size=100, concurrency=4)
+def backfill(payloads):
+    """Copy followed authors' recent messages into their new followers'
+    timelines, [{'user_id', 'author_id'}].
+
+    Follows undone since are skipped (see TimelineEntry.backfill).
+    """
+
+    for payload in payloads:
+        TimelineEntry.backfill(payload['user_id'], payload['author_id'])
+
+
+@handler('purge_user', concurrency=1, lease=3600)
+def purge(payloads):
+    """Purge soft-deleted accounts, [{'user_id'}] (see purge.py)."""
+
+    for payload in payloads:
+        purge_user(payload['user_id'])
@@ -0,0 +1,147 @@
+"""JSON API view tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_api_views.py
+
+
+import os
+from unittest import TestCase
+
+from instrumentation import stats_listeners
+from likes import apply_likes
+from models import db, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class ApiViewTestCase(TestCase):
+    def setUp(self):
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        messages = [Message(text=f"m{i}", user_id=u1.id) for i in range(3)]
+        db.session.add_all(messages)
+        db.session.flush()
+        apply_likes({(u2.id, messages[0].id): True})
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m_ids = [m.id for m in messages]
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+
+    def test_api_requires_login(self):
+        """ tests the API answers 401 when logged out """
+
+        resp = self.client.get("/api/timeline")
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn('error', resp.get_json())
+
+
+    def test_user_messages_pages(self):
+        """ tests a user's messages stream a page at a time, newest first """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get(f"/api/users/{self.u1_id}/messages?limit=2")
+            page = resp.get_json()
+
+            self.assertEqual(resp.mimetype, 'application/json')
+            self.assertEqual(
+                [m['id'] for m in page['messages']], self.m_ids[:0:-1])
+            self.assertEqual(page['messages'][0]['user']['username'], "u1")
+
+            resp = c.get(f"/api/users/{self.u1_id}/messages?limit=2"
+                         f"&cursor={page['next_cursor']}")
+            page = resp.get_json()
+
+            self.assertEqual([m['id'] for m in page['messages']],
+                             self.m_ids[:1])
+            self.assertTrue(page['messages'][0]['liked'])
+            self.assertEqual(page['messages'][0]['likes_count'], 1)
+            self.assertIsNone(page['next_cursor'])
+
+
+    def test_user_likes_and_timeline(self):
+        """ tests the likes and timeline lists """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            page = c.get(f"/api/users/{self.u2_id}/likes").get_json()
+            self.assertEqual([m['id'] for m in page['messages']],
+                             self.m_ids[:1])
+
+            c.post("/messages/new", data={"text": "posted"})
+            page = c.get("/api/timeline").get_json()
+            self.assertEqual([m['text'] for m in page['messages']],
+                             ["posted"])
+
+
+    def test_streamed_query_stats(self):
+        """ tests a streamed response's statements are counted through its
+        body, and reported once it is closed, not in its headers """
+
+        counts = []
+        listener = lambda stats: counts.append(stats.count)
+        stats_listeners.append(listener)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                resp = c.get(f"/api/users/{self.u1_id}/messages")
+                self.assertNotIn('X-DB-Queries', resp.headers)
+
+                resp.get_data()
+                self.assertEqual(counts, [])
+                resp.close()
+        finally:
+            stats_listeners.remove(listener)
+
+        # the user, then the page of messages and its authors and likes
+        self.assertEqual(len(counts), 1)
+        self.assertGreater(counts[0], 2)
+
+
+    def test_bad_limit(self):
+        """ tests out of range limits are rejected """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get("/api/timeline?limit=0")
+            self.assertEqual(resp.status_code, 400)
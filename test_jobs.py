@@ -0,0 +1,224 @@
+"""Job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import json
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Follows, Job, Message, TimelineEntry, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from jobs import HANDLERS, Handler, enqueue, run_worker, work_once
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class JobsTestCase(TestCase):
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+
+        Job.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.saved = {key: app.config[key] for key in (
+            'JOBS_EAGER', 'JOB_RETRY_SECONDS', 'JOB_MAX_ATTEMPTS')}
+        app.config['JOBS_EAGER'] = False
+
+        self.calls = []
+        HANDLERS['test'] = Handler(self.calls.append, 2, 1, None)
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config.update(self.saved)
+        del HANDLERS['test']
+        self.context.pop()
+
+
+    def test_batches(self):
+        """ tests queued jobs wait for a worker, which runs them a batch at
+        a time and deletes them """
+
+        for i in range(3):
+            enqueue('test', {'n': i})
+        db.session.commit()
+
+        self.assertEqual(self.calls, [])
+        self.assertEqual(Job.query.count(), 3)
+
+        run_worker(once=True)
+
+        self.assertEqual(self.calls, [[{'n': 0}, {'n': 1}], [{'n': 2}]])
+        self.assertEqual(Job.query.count(), 0)
+
+
+    def test_retries(self):
+        """ tests a failing job is retried later, doubling the wait each
+        time, until it runs out of attempts; its batch mates still run """
+
+        def handle(payloads):
+            if {'n': 1} in payloads:
+                raise ValueError("bad job")
+            self.calls.append(payloads)
+
+        HANDLERS['test'].function = handle
+        app.config['JOB_RETRY_SECONDS'] = 10
+        app.config['JOB_MAX_ATTEMPTS'] = 3
+
+        enqueue('test', {'n': 0})
+        enqueue('test', {'n': 1})
+        db.session.commit()
+
+        run_worker(once=True)
+
+        self.assertEqual(self.calls, [[{'n': 0}]])
+        job = Job.query.one()
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.last_error, "ValueError: bad job")
+        wait = job.run_at - datetime.utcnow()
+        self.assertTrue(timedelta(seconds=5) < wait <= timedelta(seconds=10))
+
+        # not due yet
+        self.assertEqual(work_once(), 0)
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        run_worker(once=True)
+
+        job = Job.query.one()
+        self.assertEqual(job.attempts, 2)
+        wait = job.run_at - datetime.utcnow()
+        self.assertTrue(timedelta(seconds=15) < wait <= timedelta(seconds=20))
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        run_worker(once=True)
+
+        job = Job.query.one()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, 3)
+        self.assertEqual(work_once(), 0)
+
+
+    def test_concurrency(self):
+        """ tests a type's running batches hold back new ones up to its
+        concurrency, until their lease runs out """
+
+        enqueue('test', {'n': 0})
+        enqueue('test', {'n': 1})
+        db.session.commit()
+
+        running = Job(type='test', payload=json.dumps({'n': 2}),
+                      status='running', attempts=1, locked_by='other',
+                      locked_at=datetime.utcnow())
+        db.session.add(running)
+        db.session.commit()
+
+        self.assertEqual(work_once(), 0)
+        self.assertEqual(self.calls, [])
+
+        running.locked_at = datetime.utcnow() - timedelta(
+            seconds=app.config['JOB_LEASE_SECONDS'] + 1)
+        db.session.commit()
+
+        run_worker(once=True)
+
+        self.assertEqual(
+            sorted(payload['n'] for batch in self.calls for payload in batch),
+            [0, 1, 2])
+        self.assertEqual(Job.query.count(), 0)
+
+
+    def test_deferred_fan_out(self):
+        """ tests a posted message reaches followers' timelines once the
+        worker runs its fan-out job """
+
+        author = User.signup("author", "author@test.com", "password", None)
+        follower = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+        author_id, follower_id = author.id, follower.id
+
+        db.session.add(Follows(user_being_followed_id=author_id,
+                               user_following_id=follower_id))
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            resp = c.post("/messages/new", data={"text": "deferred"})
+            self.assertEqual(resp.status_code, 302)
+
+        message = Message.query.filter_by(text="deferred").one()
+        self.assertEqual(
+            TimelineEntry.query.filter_by(message_id=message.id).count(), 0)
+
+        run_worker(once=True)
+
+        self.assertEqual(
+            {entry.user_id for entry in
+             TimelineEntry.query.filter_by(message_id=message.id)},
+            {author_id, follower_id})
+
+        # running it again, as after a worker died, adds nothing twice
+        enqueue('fan_out', {'message_id': message.id})
+        db.session.commit()
+        run_worker(once=True)
+
+        self.assertEqual(
+            TimelineEntry.query.filter_by(message_id=message.id).count(), 2)
+
+
+    def test_deferred_follow_and_post(self):
+        """ tests a deferred backfill and fan-out that both cover a message
+        put it in the new follower's timeline once """
+
+        author = User.signup("author", "author@test.com", "password", None)
+        follower = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+        author_id, follower_id = author.id, follower.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            c.post(f"/users/follow/{author_id}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+
+            c.post("/messages/new", data={"text": "both"})
+
+        self.assertEqual(
+            {job.type for job in Job.query}, {'backfill', 'fan_out'})
+
+        run_worker(once=True)
+
+        self.assertEqual(Job.query.count(), 0)
+        message = Message.query.filter_by(text="both").one()
+        self.assertEqual(
+            TimelineEntry.query
+            .filter_by(user_id=follower_id, message_id=message.id)
+            .count(), 1)
@@ -0,0 +1,85 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+
+import csv
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from models import db, User, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+from loader import load_csvs
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+def write_csv(directory, filename, rows):
+    with open(os.path.join(directory, filename), 'w', newline='') as file:
+        csv.writer(file).writerows(rows)
+
+
+class LoaderTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+
+    def test_load_csvs(self):
+        """ test CSVs with explicit ids load in chunks, keep indexes and
+        leave sequences, timelines and counts in step """
+
+        with TemporaryDirectory() as directory:
+            write_csv(directory, 'users.csv', [
+                ['id', 'email', 'username', 'password', 'bio'],
+                [9001, 'l1@email.com', 'loaded1', 'hash', ''],
+                [9002, 'l2@email.com', 'loaded2', 'hash', 'bio'],
+            ])
+            write_csv(directory, 'messages.csv', [
+                ['text', 'timestamp', 'user_id'],
+                ['one', '2017-01-21 11:04:53.522807', 9001],
+                ['two', '2017-01-22 11:04:53', 9001],
+                ['three', '2017-01-23 11:04:53', 9002],
+            ])
+            write_csv(directory, 'follows.csv', [
+                ['user_being_followed_id', 'user_following_id'],
+                [9001, 9002],
+            ])
+
+            counts = load_csvs(directory, chunk_size=2, echo=lambda _: None)
+
+        self.assertEqual(
+            counts, {'users': 2, 'messages': 3, 'follows': 1})
+
+        u1 = User.query.get(9001)
+
+        self.assertIsNone(u1.bio)
+        self.assertEqual(u1.messages_count, 2)
+        self.assertEqual(u1.followers_count, 1)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=9002).count(), 3)
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+
+        self.assertGreater(u3.id, 9002)
@@ -6,9 +6,15 @@
 
 
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from feed import hydrate
+from likes import apply_likes
+from hashtags import parse_tags
+from models import (
+    db, User, Message, Follows, LikedMessage, LikeRollup, MessageTag,
+    TagRollup, TimelineEntry, TimelineSize)
 from sqlalchemy.exc import IntegrityError
 # from psycopg2 import errors
 
@@ -72,3 +78,185 @@ class MessageModelTestCase(TestCase):
 
         self.assertRaises(IntegrityError, db.session.commit)
 
+
+
+    def test_fan_out(self):
+        """ test message is added to the author's and followers' timelines """
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+        db.session.add(Follows(user_being_followed_id=self.u1_id,
+                               user_following_id=u2.id))
+
+        m3 = Message(text="text3", user_id=self.u1_id)
+        db.session.add(m3)
+        db.session.flush()
+        TimelineEntry.fan_out(m3)
+        db.session.commit()
+
+        entries = TimelineEntry.query.filter_by(message_id=m3.id).all()
+
+        self.assertEqual({e.user_id for e in entries}, {self.u1_id, u2.id})
+
+
+    def test_timeline_trim(self):
+        """ test timelines are trimmed to TIMELINE_LENGTH newest entries once
+        their counted size grows more than TIMELINE_SLACK past it """
+
+        config = {'TIMELINE_LENGTH': 1, 'TIMELINE_SLACK': 1}
+        saved = {key: app.config[key] for key in config}
+        app.config.update(config)
+
+        try:
+            messages = [Message(text=f"text{i}", user_id=self.u1_id)
+                        for i in range(3)]
+            db.session.add_all(messages)
+            db.session.flush()
+            TimelineEntry.fan_out(messages[0])
+
+            # 1 entry: within the slack
+            self.assertEqual(TimelineEntry.overgrown(), [])
+            self.assertEqual(TimelineEntry.trim([self.u1_id]), 0)
+
+            TimelineEntry.fan_out(messages[1])
+            TimelineEntry.fan_out(messages[2])
+
+            self.assertEqual(TimelineEntry.overgrown(), [self.u1_id])
+            self.assertEqual(TimelineEntry.trim([self.u1_id]), 2)
+            self.assertEqual(TimelineEntry.overgrown(), [])
+            db.session.commit()
+        finally:
+            app.config.update(saved)
+
+        entries = TimelineEntry.query.filter_by(user_id=self.u1_id).all()
+
+        self.assertEqual([e.message_id for e in entries], [messages[2].id])
+
+
+    def test_timeline_sizes(self):
+        """ test backfills count toward timeline sizes, and a size left high
+        by an unfollow is counted again by trim """
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+        db.session.add(Follows(user_being_followed_id=self.u1_id,
+                               user_following_id=u2.id))
+        db.session.flush()
+        TimelineEntry.backfill(u2.id, self.u1_id)
+
+        self.assertEqual(
+            TimelineSize.query.get(u2.id).entries,
+            Message.query.filter_by(user_id=self.u1_id).count())
+
+        TimelineEntry.remove_author(u2.id, self.u1_id)
+        self.assertEqual(TimelineEntry.trim([u2.id]), 0)
+        db.session.commit()
+
+        self.assertEqual(TimelineSize.query.get(u2.id).entries, 0)
+
+
+    def test_hydrate(self):
+        """ test hydrate returns views in order, with author and likes """
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        m3 = Message(text="text3", user_id=self.u1_id)
+        db.session.add_all([u2, m3])
+        db.session.flush()
+        apply_likes({(u2.id, self.m1_id): True})
+        db.session.commit()
+
+        views = hydrate([m3.id, self.m1_id, -1], u2.id)
+
+        self.assertEqual([v.id for v in views], [m3.id, self.m1_id])
+        self.assertEqual(views[1].user.username, "u1")
+        self.assertEqual(views[1].likes_count, 1)
+        self.assertTrue(views[1].liked)
+        self.assertEqual(views[0].likes_count, 0)
+        self.assertFalse(views[0].liked)
+
+    def test_like_rollups(self):
+        """ test likes keep message counts and hourly rollups, and the
+        leaderboard sums the buckets in its window """
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        m3 = Message(text="text3", user_id=self.u1_id)
+        db.session.add(m3)
+        db.session.flush()
+
+        apply_likes({(u2.id, self.m1_id): True, (u3.id, self.m1_id): True,
+                     (u2.id, m3.id): True})
+        apply_likes({(u3.id, self.m1_id): False, (u3.id, m3.id): True})
+        db.session.commit()
+
+        self.assertEqual(Message.query.get(self.m1_id).likes_count, 1)
+        self.assertEqual(Message.query.get(m3.id).likes_count, 2)
+        self.assertEqual(LikeRollup.top('24h', 10),
+                         [(m3.id, 2), (self.m1_id, 1)])
+
+        # an older bucket counts for 7d only, and is pruned past that
+        now = datetime.utcnow()
+        LikeRollup.add({(self.m1_id, LikeRollup.bucket_of(now)
+                         - timedelta(days=2)): 5}, now)
+        db.session.commit()
+
+        self.assertEqual(LikeRollup.top('24h', 10)[0], (m3.id, 2))
+        self.assertEqual(LikeRollup.top('7d', 10)[0], (self.m1_id, 6))
+        self.assertEqual(LikeRollup.top('24h', 10, now + timedelta(days=1)),
+                         [])
+        self.assertEqual(LikeRollup.prune(now + timedelta(days=6)), 1)
+
+    def test_recount_likes(self):
+        """ test recount_likes and rebuild repair counts and rollups """
+
+        db.session.add(LikedMessage(user_id=self.u1_id, message_id=self.m1_id))
+        db.session.commit()
+
+        Message.recount_likes()
+        LikeRollup.rebuild()
+        db.session.commit()
+
+        self.assertEqual(Message.query.get(self.m1_id).likes_count, 1)
+        self.assertEqual(LikeRollup.top('24h', 10), [(self.m1_id, 1)])
+
+    def test_parse_tags(self):
+        """ test hashtags are found lowercased and once each, skipping
+        all-digit tags and #s inside words """
+
+        self.assertEqual(
+            parse_tags("#Warbler news: #2fast email#tag #1 #warbler #o_k!"),
+            ['warbler', '2fast', 'o_k'])
+
+    def test_tag_index(self):
+        """ test posted tags are indexed and counted for trending, deleted
+        ones come off again, and rebuilds agree """
+
+        TagRollup.query.delete()
+        m3 = Message(text="#Birds and #bees", user_id=self.u1_id)
+        m4 = Message(text="more #birds", user_id=self.u1_id)
+        db.session.add_all([m3, m4])
+        db.session.flush()
+        MessageTag.index(m3)
+        MessageTag.index(m4)
+        db.session.commit()
+
+        self.assertEqual(
+            {(tag.tag, tag.message_id) for tag in MessageTag.query},
+            {('birds', m3.id), ('bees', m3.id), ('birds', m4.id)})
+        self.assertEqual(TagRollup.top('24h', 10), [('birds', 2), ('bees', 1)])
+
+        MessageTag.unindex([m3.id])
+        db.session.delete(m3)
+        db.session.commit()
+
+        self.assertEqual(
+            [(tag.tag, tag.message_id) for tag in MessageTag.query],
+            [('birds', m4.id)])
+        self.assertEqual(TagRollup.top('24h', 10), [('birds', 1)])
+
+        MessageTag.rebuild()
+        TagRollup.rebuild()
+        db.session.commit()
+
+        self.assertEqual(MessageTag.query.count(), 1)
+        self.assertEqual(TagRollup.top('24h', 10), [('birds', 1)])
@@ -6,9 +6,18 @@
 
 
 import os
+import re
 from unittest import TestCase
 
-from models import LikedMessage, db, Message, User
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+import fragments
+import merge_feed
+from likes import like_buffer
+from models import (
+    Follows, LikedMessage, db, leaderboard_cache, Message, TagRollup,
+    trending_cache, User)
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -78,6 +87,29 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             self.assertIn('<p>Hello</p>', html)
 
 
+    def test_add_message_fans_out(self):
+        """ tests a new message shows up on a follower's home timeline """
+
+        db.session.add(Follows(user_being_followed_id=self.u1_id,
+                               user_following_id=self.u2_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "Fanned out"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<p>Fanned out</p>', html)
+
+
     def test_render_add_message(self):
         """ tests if we render the create message form"""
 
@@ -185,6 +217,19 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
         self.assertIn('show user profile test', html)
 
 
+    def test_liked_message_marked_in_feed(self):
+        """ tests a liked message shows the unlike button on the profile """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/messages/{self.m2_id}/like")
+            html = c.get(f"/users/{self.u2_id}").get_data(as_text=True)
+
+            self.assertIn(f'action="/messages/{self.m2_id}/unlike"', html)
+
+
     def test_unlike_message(self):
         """ tests if a liked message is removed from user's liked messages list
         and route redirects back to user profile"""
@@ -204,3 +249,354 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
         self.assertIn('<div class="col-sm-6">', html)
         self.assertIn('show user profile test', html)
         self.assertFalse(unliked)
+
+
+    def test_message_counts(self):
+        """ tests posting, liking and deleting keep users' counts """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/messages/{self.m1_id}/like")
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "Hello"})
+            self.assertEqual(User.query.get(self.u1_id).messages_count, 1)
+
+            c.post(f"/messages/{self.m1_id}/delete")
+            self.assertEqual(User.query.get(self.u1_id).messages_count, 0)
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 0)
+
+
+    def test_query_stats_reported(self):
+        """ tests each response reports its SQL count and warns on repeats """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/messages/{self.m1_id}")
+            self.assertGreater(int(resp.headers['X-DB-Queries']), 0)
+            self.assertIn('db;desc=', resp.headers['Server-Timing'])
+
+            threshold = app.config['SQL_REPEAT_WARNING']
+            app.config['SQL_REPEAT_WARNING'] = 0
+
+            try:
+                with self.assertLogs(app.logger, 'WARNING') as logs:
+                    c.get(f"/messages/{self.m1_id}")
+            finally:
+                app.config['SQL_REPEAT_WARNING'] = threshold
+
+            self.assertIn('ran the same query', logs.output[0])
+
+
+    def test_query_stats_failed_statement(self):
+        """ tests a failed statement doesn't leave its start time behind
+        on the connection """
+
+        with db.engine.connect() as conn:
+            with self.assertRaises(DBAPIError):
+                conn.execute(text("SELECT * FROM no_such_table"))
+
+            self.assertEqual(conn.info.get('query_start'), [])
+
+
+    def test_feed_query_count_is_fixed(self):
+        """ tests the home feed runs the same queries for 1 or 20 messages """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "first"})
+            few = int(c.get("/").headers['X-DB-Queries'])
+
+            for i in range(19):
+                c.post("/messages/new", data={"text": f"more {i}"})
+            many = int(c.get("/").headers['X-DB-Queries'])
+
+            self.assertEqual(few, many)
+
+
+    def test_merged_feed(self):
+        """ tests the merge feed strategy pages through followed authors'
+        recent messages, reading on from the database past a full list """
+
+        db.session.add(Follows(user_being_followed_id=self.u1_id,
+                               user_following_id=self.u2_id))
+        db.session.commit()
+
+        config = {'FEED_STRATEGY': 'merge', 'AUTHOR_RECENT_LENGTH': 3,
+                  'MESSAGES_PER_PAGE': 2}
+        saved = {key: app.config[key] for key in config}
+        app.config.update(config)
+        merge_feed.recent_cache.configure(100, 60)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                # cache u1's list before posting, so posts update it
+                c.get("/")
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                for i in range(4):
+                    c.post("/messages/new", data={"text": f"post {i}"})
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                html = c.get("/").get_data(as_text=True)
+                self.assertIn("<p>post 3</p>", html)
+                self.assertIn("<p>post 2</p>", html)
+                self.assertNotIn("<p>post 1</p>", html)
+
+                cursor = re.search(r'cursor=([\w-]+)', html).group(1)
+                html = c.get(f"/?cursor={cursor}").get_data(as_text=True)
+                self.assertIn("<p>post 1</p>", html)
+                # older than u1's 3 newest, so read from the database
+                self.assertIn("<p>post 0</p>", html)
+                self.assertNotIn("m2-text", html)
+
+                cursor = re.search(r'cursor=([\w-]+)', html).group(1)
+                html = c.get(f"/?cursor={cursor}").get_data(as_text=True)
+                self.assertIn("m2-text", html)
+                self.assertIn("m1-text", html)
+                self.assertNotIn("cursor=", html)
+
+                newest = Message.query.filter_by(text="post 3").one().id
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                c.post(f"/messages/{newest}/delete")
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                html = c.get("/").get_data(as_text=True)
+                self.assertNotIn("<p>post 3</p>", html)
+                self.assertIn("<p>post 2</p>", html)
+        finally:
+            app.config.update(saved)
+            merge_feed.recent_cache.configure(
+                app.config['RECENT_CACHE_SIZE'], app.config['RECENT_CACHE_TTL'])
+
+
+    def test_cached_message_splices_like_state(self):
+        """ tests cached message HTML still shows each viewer's like button """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.get(f"/users/{self.u1_id}")
+            self.assertGreater(len(fragments.fragment_cache), 0)
+
+            c.post(f"/messages/{self.m1_id}/like")
+            html = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+            self.assertIn(f'/messages/{self.m1_id}/unlike', html)
+            self.assertIn('1 likes', html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+            self.assertNotIn(f'/messages/{self.m1_id}/unlike', html)
+            self.assertNotIn(f'/messages/{self.m1_id}/like"', html)
+
+            cached = len(fragments.fragment_cache)
+            c.post(f"/messages/{self.m1_id}/delete")
+            self.assertEqual(len(fragments.fragment_cache), cached - 1)
+
+
+    def test_message_not_modified(self):
+        """ tests repeat views of a message get a 304 until it's liked """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            etag = c.get(f"/messages/{self.m1_id}").headers['ETag']
+            resp = c.get(f"/messages/{self.m1_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/messages/{self.m1_id}/like")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/messages/{self.m1_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('1 likes', resp.get_data(as_text=True))
+
+
+    def test_like_is_idempotent(self):
+        """ tests liking twice or unliking twice changes nothing more """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            for _ in range(2):
+                resp = c.post(f"/messages/{self.m1_id}/like")
+                self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(LikedMessage.query.count(), 1)
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 1)
+
+            for _ in range(2):
+                c.post(f"/messages/{self.m1_id}/unlike")
+
+            self.assertEqual(LikedMessage.query.count(), 0)
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 0)
+
+
+    def test_toggle_like(self):
+        """ tests the JSON toggle endpoint """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.post(f"/messages/{self.m1_id}/toggle-like")
+            self.assertEqual(resp.get_json(), {"liked": True, "likes_count": 1})
+
+            resp = c.post(f"/messages/{self.m1_id}/toggle-like",
+                          data={"liked": "true"})
+            self.assertEqual(resp.get_json(), {"liked": True, "likes_count": 1})
+
+            resp = c.post(f"/messages/{self.m1_id}/toggle-like")
+            self.assertEqual(resp.get_json(), {"liked": False, "likes_count": 0})
+
+            resp = c.post("/messages/0/toggle-like")
+            self.assertEqual(resp.status_code, 404)
+
+
+    def test_like_buffer_merges_toggles(self):
+        """ tests buffered likes merge per message and flush in a batch """
+
+        like_buffer.configure(app, 60)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                c.post(f"/messages/{self.m1_id}/like")
+                c.post(f"/messages/{self.m1_id}/unlike")
+                c.post(f"/messages/{self.m1_id}/like")
+
+                self.assertEqual(like_buffer.pending_for(self.u2_id),
+                                 {self.m1_id: True})
+                self.assertEqual(LikedMessage.query.count(), 0)
+
+                html = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+                self.assertIn(f'/messages/{self.m1_id}/unlike', html)
+
+                like_buffer.flush()
+
+            self.assertEqual(LikedMessage.query.count(), 1)
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 1)
+        finally:
+            like_buffer.configure(app, 0)
+
+
+    def test_top_messages(self):
+        """ tests the leaderboard ranks messages by likes in the window """
+
+        leaderboard_cache.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/messages/{self.m2_id}/like")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/messages/{self.m2_id}/like")
+            c.post(f"/messages/{self.m1_id}/like")
+
+            self.assertEqual(Message.query.get(self.m2_id).likes_count, 2)
+
+            resp = c.get("/messages/top?window=7d")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertLess(html.index("m2-text"), html.index("m1-text"))
+            self.assertIn(
+                '<span class="text-muted likes-count">&middot; 2 likes</span>',
+                html)
+
+            resp = c.get("/messages/top?window=1y")
+            self.assertEqual(resp.status_code, 404)
+
+
+    def test_deleting_user_removes_their_likes(self):
+        """ tests deleting a user takes their likes off message counts """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/messages/{self.m1_id}/like")
+            c.post("/users/delete")
+
+        self.assertEqual(Message.query.get(self.m1_id).likes_count, 0)
+
+
+    def test_tag_pages(self):
+        """ tests posted hashtags link to a paginated tag page, and trending
+        ranks tags by use """
+
+        TagRollup.query.delete()
+        db.session.commit()
+        trending_cache.clear()
+
+        config = {'MESSAGES_PER_PAGE': 2}
+        saved = {key: app.config[key] for key in config}
+        app.config.update(config)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                for i in range(3):
+                    c.post("/messages/new", data={"text": f"#Flask post {i}"})
+                c.post("/messages/new", data={"text": "#jinja too"})
+
+                html = c.get("/tags/flask").get_data(as_text=True)
+                self.assertIn('<a href="/tags/flask">#Flask</a> post 2', html)
+                self.assertIn("post 1", html)
+                self.assertNotIn("post 0", html)
+
+                cursor = re.search(r'cursor=([\w-]+)', html).group(1)
+                html = c.get(f"/tags/Flask?cursor={cursor}").get_data(
+                    as_text=True)
+                self.assertIn("post 0", html)
+                self.assertNotIn("cursor=", html)
+
+                html = c.get("/tags").get_data(as_text=True)
+                self.assertLess(html.index("#flask"), html.index("#jinja"))
+                self.assertIn("3 messages", html)
+
+                resp = c.get("/tags?window=1y")
+                self.assertEqual(resp.status_code, 404)
+        finally:
+            app.config.update(saved)
@@ -0,0 +1,116 @@
+"""Who-to-follow suggestion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_suggestions.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Follows, FollowSuggestion, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from suggestions import adjacency, suggest_follows, top_candidates
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class SuggestionsTestCase(TestCase):
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+
+        User.query.delete()
+        db.session.commit()
+
+        self.users = []
+
+        for i in range(5):
+            user = User.signup(f"s{i}", f"s{i}@test.com", "password", None)
+            self.users.append(user)
+
+        db.session.commit()
+        self.ids = [user.id for user in self.users]
+
+    def tearDown(self):
+        db.session.rollback()
+        self.context.pop()
+
+    def follow(self, *pairs):
+        for follower, followed in pairs:
+            db.session.add(Follows(
+                user_following_id=self.ids[follower],
+                user_being_followed_id=self.ids[followed]))
+        db.session.commit()
+
+
+    def test_top_candidates(self):
+        """ tests candidates are scored by mutual connections, best first,
+        without the user themselves or who they follow, cut to the limit """
+
+        following = adjacency(
+            [[(0, 1), (0, 2), (1, 3), (2, 3), (2, 4), (1, 0), (1, 2)],
+             [(3, 0)]], 5)
+
+        users, candidates, scores = top_candidates(following, 0, 2, 2)
+
+        # 0 follows 1 and 2: both follow 3, and 2 follows 4; 1 follows 0,
+        # 2 and 3, who lead to itself, 2 and 3 (followed already) and 4
+        self.assertEqual(
+            list(zip(users.tolist(), candidates.tolist(), scores.tolist())),
+            [(0, 3, 2), (0, 4, 1), (1, 4, 1)])
+
+        # 2 follows 3 and 4, and 3 follows 0; 3 follows 0, who follows 1
+        # and 2; 4 follows no one
+        users, candidates, _ = top_candidates(following, 2, 5, 1)
+        self.assertEqual(
+            list(zip(users.tolist(), candidates.tolist())), [(2, 0), (3, 1)])
+
+
+    def test_suggest_follows(self):
+        """ tests the batch job fills the table, and the home page shows
+        suggestions the user hasn't followed since """
+
+        self.follow((0, 1), (0, 2), (1, 3), (2, 3), (2, 4))
+
+        written = suggest_follows(echo=lambda line: None)
+
+        self.assertEqual(written, 2)
+        self.assertEqual(
+            [(user.id, score) for user, score in
+             FollowSuggestion.for_user(self.ids[0], 5)],
+            [(self.ids[3], 2), (self.ids[4], 1)])
+
+        self.follow((0, 4))
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids[0]
+
+            html = c.get("/").get_data(as_text=True)
+
+        self.assertIn("Who to follow", html)
+        self.assertIn("@s3", html)
+        self.assertIn("Followed by 2 people you follow", html)
+        self.assertNotIn("@s4", html)
+
+        # rerunning replaces the old suggestions
+        suggest_follows(echo=lambda line: None)
+        self.assertEqual(
+            [(row.user_id, row.suggested_id)
+             for row in FollowSuggestion.query],
+            [(self.ids[0], self.ids[3])])
@@ -6,11 +6,18 @@
 
 
 import os
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import (
+    db, User, Message, Follows, LikedMessage, CurrentUser, follow_cache,
+    current_user_cache)
 from sqlalchemy.exc import IntegrityError
 
+from follow_graph import FollowGraph, follow_graph
+from hashing import HasherBusy, PasswordHasher, password_hasher
+from search import UsernameIndex, EXACT, PREFIX, SUBSTRING
+
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
@@ -77,6 +84,105 @@ class UserModelTestCase(TestCase):
         self.assertIn(u1, u2.followers)
 
         #user model already has methods is_following and is_followed_by, does method work?
+        self.assertTrue(u1.is_following(u2))
+        self.assertTrue(u2.is_followed_by(u1))
+        self.assertFalse(u2.is_following(u1))
+
+
+    def test_user_is_following_cached(self):
+        """ test is_following through the follow cache, which is refreshed
+        once invalidated """
+
+        follow_cache.configure(100, ttl=60)
+
+        try:
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+
+            self.assertFalse(u1.is_following(u2))
+
+            db.session.add(Follows(user_being_followed_id=self.u2_id,
+                                   user_following_id=self.u1_id))
+            db.session.commit()
+
+            self.assertFalse(u1.is_following(u2))
+
+            follow_cache.delete(self.u1_id)
+
+            self.assertTrue(u1.is_following(u2))
+        finally:
+            follow_cache.configure(0)
+
+
+    def test_user_is_following_graph(self):
+        """ test is_following through the follow graph snapshot, its log,
+        and compaction """
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.add(u3)
+        db.session.flush()
+        db.session.add(Follows(user_being_followed_id=self.u2_id,
+                               user_following_id=self.u1_id))
+        db.session.commit()
+
+        with TemporaryDirectory() as directory:
+            follow_graph.configure(directory)
+
+            try:
+                self.assertFalse(follow_graph.enabled)
+                Follows.compact_graph()
+                self.assertTrue(follow_graph.enabled)
+
+                u1 = User.query.get(self.u1_id)
+                u2 = User.query.get(self.u2_id)
+
+                self.assertTrue(u1.is_following(u2))
+                self.assertTrue(u2.is_followed_by(u1))
+                self.assertFalse(u2.is_following(u1))
+
+                follow_graph.record([(self.u1_id, self.u2_id, False),
+                                     (self.u1_id, u3.id, True),
+                                     (u3.id, self.u2_id, True)])
+
+                self.assertFalse(u1.is_following(u2))
+                self.assertEqual(u1.following_ids(), {u3.id})
+                self.assertEqual(follow_graph.degree('followers', u2.id), 1)
+
+                # another worker sees the log, and the snapshot it's
+                # compacted into
+                other = FollowGraph()
+                other.configure(directory)
+                self.assertTrue(other.is_following(u3.id, self.u2_id))
+
+                Follows.compact_graph()
+                other.refresh()
+                self.assertFalse(other.is_following(u3.id, self.u2_id))
+                self.assertTrue(other.is_following(self.u1_id, self.u2_id))
+
+                # each snapshot starts a log segment, and the previous
+                # snapshot and segment are kept until the next compaction
+                first = sorted(os.listdir(directory))
+                follow_graph.record([(u3.id, self.u1_id, True)])
+                Follows.compact_graph()
+                other.record([(self.u2_id, u3.id, True)])
+
+                names = sorted(os.listdir(directory))
+                self.assertEqual(
+                    [name for name in names if name.startswith('snapshot-')],
+                    [name for name in first if name.startswith('snapshot-')]
+                    [-1:] + [names[-1]])
+                self.assertEqual(
+                    len([name for name in names
+                         if name.startswith('follows')]), 2)
+                self.assertTrue(other.is_following(self.u2_id, u3.id))
+                follow_graph.refresh()
+                self.assertTrue(
+                    follow_graph.is_following(self.u2_id, u3.id))
+                # logged but never in the table, so repaired by compaction
+                self.assertFalse(
+                    follow_graph.is_following(u3.id, self.u1_id))
+            finally:
+                follow_graph.configure(None)
 
 
     def test_user_is_not_following(self):
@@ -120,6 +226,44 @@ class UserModelTestCase(TestCase):
         self.assertEqual(u1, login_user_u1)
 
 
+    def test_user_authenticate_rehash(self):
+        """ test authenticating upgrades a hash with an old work factor """
+
+        rounds = password_hasher.rounds
+        password_hasher.configure(4)
+
+        try:
+            User.signup("u3", "u3@email.com", "password", None)
+            db.session.commit()
+
+            password_hasher.configure(5)
+            u3 = User.authenticate('u3', 'password')
+            db.session.commit()
+
+            self.assertTrue(u3.password.startswith('$2b$05$'))
+            self.assertEqual(User.authenticate('u3', 'password'), u3)
+        finally:
+            password_hasher.configure(
+                rounds, app.config['HASH_WORKERS'],
+                app.config['HASH_QUEUE_DEPTH'], app.config['HASH_TIMEOUT'])
+
+
+    def test_hasher_busy(self):
+        """ test hashing fails fast once the pool's queue is full """
+
+        hasher = PasswordHasher(rounds=4, workers=1, queue_depth=0)
+
+        try:
+            hashed = hasher.hash("password")
+
+            self.assertTrue(hasher.check(hashed, "password"))
+
+            hasher._slots.acquire()
+            self.assertRaises(HasherBusy, hasher.hash, "password")
+        finally:
+            hasher._pool.shutdown()
+
+
     def test_user_authenticate_fail_username(self):
         """ test user model authenticating invalid username """
 
@@ -132,3 +276,86 @@ class UserModelTestCase(TestCase):
 
         test_fail_user = User.authenticate('u1', 'badpass')
         self.assertFalse(test_fail_user)
+
+
+    def test_user_recount(self):
+        """ test recount repairs drifted count columns """
+
+        db.session.add(Follows(user_being_followed_id=self.u2_id,
+                               user_following_id=self.u1_id))
+        db.session.add(Message(text="text", user_id=self.u1_id))
+        User.adjust_counts([self.u2_id], messages_count=5)
+        db.session.commit()
+
+        User.recount()
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        self.assertEqual(u1.messages_count, 1)
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u2.messages_count, 0)
+        self.assertEqual(u2.followers_count, 1)
+
+
+    def test_liked_message_ids(self):
+        """ test liked_message_ids returns only the liked ids asked about """
+
+        m1 = Message(text="m1", user_id=self.u2_id)
+        m2 = Message(text="m2", user_id=self.u2_id)
+        m3 = Message(text="m3", user_id=self.u2_id)
+        db.session.add_all([m1, m2, m3])
+        db.session.flush()
+        db.session.add_all([
+            LikedMessage(user_id=self.u1_id, message_id=m1.id),
+            LikedMessage(user_id=self.u1_id, message_id=m3.id),
+        ])
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+
+        self.assertEqual(u1.liked_message_ids([m1.id, m2.id]), {m1.id})
+        self.assertEqual(u1.liked_message_ids([]), set())
+        self.assertTrue(u1.check_liked_message(m3))
+
+
+    def test_current_user_cached(self):
+        """ test CurrentUser serves cached fields until invalidated, and
+        loads the full user lazily """
+
+        cached = CurrentUser.load(self.u1_id)
+
+        User.query.filter_by(id=self.u1_id).update({"username": "renamed"})
+        db.session.commit()
+
+        self.assertEqual(CurrentUser.load(self.u1_id).username, "u1")
+        self.assertEqual(cached.messages_count, 0)
+        self.assertEqual(cached.model, User.query.get(self.u1_id))
+
+        current_user_cache.delete(self.u1_id)
+
+        self.assertEqual(CurrentUser.load(self.u1_id).username, "renamed")
+        self.assertIsNone(CurrentUser.load(0))
+
+        # count updates drop the user from the cache once committed
+        User.adjust_counts([self.u1_id], messages_count=1)
+        self.assertEqual(CurrentUser.load(self.u1_id).messages_count, 0)
+        db.session.commit()
+        self.assertEqual(CurrentUser.load(self.u1_id).messages_count, 1)
+
+
+    def test_username_index(self):
+        """ test the in-process username index ranks its matches """
+
+        User.signup("xu1", "xu1@email.com", "password", None)
+        User.signup("U1x", "u1x@email.com", "password", None)
+        db.session.commit()
+
+        index = UsernameIndex()
+        matches = index.search("u1")
+
+        self.assertEqual([rank for rank, _ in matches],
+                         [EXACT, PREFIX, SUBSTRING])
+        self.assertEqual(matches[0], (EXACT, self.u1_id))
+        self.assertEqual(index.search("nobody"), [])
@@ -6,9 +6,20 @@
 
 
 import os
+import re
+import threading
+from datetime import datetime
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 
-from models import db, Message, User
+from sqlalchemy import create_engine
+
+import purge
+import routing
+from instrumentation import stats_listeners
+from likes import apply_likes
+from models import (
+    db, Follows, FollowSuggestion, Job, Message, TimelineEntry, User)
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -145,6 +156,117 @@ class BaseViewTestCase(TestCase):
             self.assertIn('<p>@u2', html)
 
 
+    def test_search_users_ranked(self):
+        """ tests search ranks exact, then prefix, then substring matches,
+        a page at a time """
+
+        User.signup("bu1", "bu1@email.com", "password", None)
+        User.signup("U1b", "u1b@email.com", "password", None)
+        db.session.commit()
+        app.config['USERS_PER_PAGE'] = 2
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                html = c.get('/users?q=u1').get_data(as_text=True)
+
+                self.assertLess(html.index('<p>@u1<'), html.index('<p>@U1b<'))
+                self.assertNotIn('<p>@bu1', html)
+                self.assertNotIn('<p>@u2', html)
+
+                older = re.search(r'href="([^"]*cursor=[^"]*)"', html)[1]
+                html = c.get(older.replace('&amp;', '&')).get_data(
+                    as_text=True)
+
+                self.assertIn('<p>@bu1', html)
+                self.assertNotIn('<p>@U1b', html)
+
+                # a page at a time, across the prefix and substring matches
+                User.signup("cu1", "cu1@email.com", "password", None)
+                db.session.commit()
+                app.config['USERS_PER_PAGE'] = 1
+                url, names = '/users?q=u1', []
+
+                while url:
+                    html = c.get(url).get_data(as_text=True)
+                    names += re.findall(r'<p>@(\w+)<', html)
+                    url = re.search(r'href="([^"]*cursor=[^"]*)"', html)
+                    url = url and url[1].replace('&amp;', '&')
+
+                self.assertEqual(names, ['u1', 'U1b', 'bu1', 'cu1'])
+        finally:
+            app.config['USERS_PER_PAGE'] = 30
+
+
+    def test_list_users_query_count_is_fixed(self):
+        """ tests the users page checks who the viewer follows in one
+        query, however many users it shows """
+
+        for i in range(10):
+            db.session.add(User(username=f"many{i}",
+                                email=f"many{i}@email.com", password="x"))
+        db.session.add(Follows(user_being_followed_id=self.u2_id,
+                               user_following_id=self.u1_id))
+        db.session.commit()
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                # the first request loads the viewer into the user cache
+                c.get('/users')
+
+                app.config['USERS_PER_PAGE'] = 2
+                few = int(c.get('/users').headers['X-DB-Queries'])
+
+                app.config['USERS_PER_PAGE'] = 12
+                resp = c.get('/users')
+                many = int(resp.headers['X-DB-Queries'])
+                html = resp.get_data(as_text=True)
+
+                self.assertEqual(few, many)
+                self.assertIn(
+                    f'action="/users/stop-following/{self.u2_id}"', html)
+                self.assertEqual(html.count('/users/stop-following/'), 1)
+        finally:
+            app.config['USERS_PER_PAGE'] = 30
+
+
+    def test_cached_viewer_not_reloaded(self):
+        """ checks pages read the logged-in user's counts and version from
+        the user cache, not the users table """
+
+        shapes = []
+        listener = lambda stats: shapes.extend(stats.shapes.elements())
+        stats_listeners.append(listener)
+
+        def users_by_id():
+            return len([shape for shape in shapes
+                        if 'FROM users WHERE' in shape])
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                # the first request loads the viewer into the user cache
+                c.get('/')
+                shapes.clear()
+
+                html = c.get('/').get_data(as_text=True)
+                self.assertIn('<p class="small">Messages</p>', html)
+                self.assertEqual(users_by_id(), 0)
+
+                # only the profile's own user
+                c.get(f'/users/{self.u2_id}')
+                self.assertEqual(users_by_id(), 1)
+        finally:
+            stats_listeners.remove(listener)
+
+
     def test_show_single_user_logged_in(self):
         """ tests if a specific user's profile renders if user is logged in """
 
@@ -160,6 +282,43 @@ class BaseViewTestCase(TestCase):
             self.assertIn('show user profile test', html)
 
 
+    def test_show_single_user_paginates(self):
+        """ tests a user's messages are paged newest-first with an older
+        link, and a malformed cursor is rejected """
+
+        db.session.add_all([
+            Message(text="older-message", user_id=self.u1_id,
+                    timestamp=datetime(2020, 1, 1)),
+            Message(text="newer-message", user_id=self.u1_id,
+                    timestamp=datetime(2021, 1, 1)),
+        ])
+        db.session.commit()
+        app.config['MESSAGES_PER_PAGE'] = 1
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                resp = c.get(f'/users/{self.u1_id}')
+                html = resp.get_data(as_text=True)
+
+                self.assertIn('newer-message', html)
+                self.assertNotIn('older-message', html)
+
+                older = re.search(r'href="([^"]*cursor=[^"]*)"', html)[1]
+                html = c.get(older).get_data(as_text=True)
+
+                self.assertIn('older-message', html)
+                self.assertNotIn('newer-message', html)
+                self.assertNotIn('cursor=', html)
+
+                resp = c.get(f'/users/{self.u1_id}?cursor=bogus')
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 50
+
+
     def test_show_single_user_if_not_logged_in(self):
         """ tests that a specific user's profile does not render if user is
         logged out"""
@@ -267,6 +426,44 @@ class BaseViewTestCase(TestCase):
             self.assertIn('user following test', html)
 
 
+    def test_user_follow_counts(self):
+        """ tests following and unfollowing keep both users' counts """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}")
+
+            self.assertEqual(User.query.get(self.u1_id).following_count, 1)
+            self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
+
+            c.post(f"/users/stop-following/{self.u2_id}")
+
+            self.assertEqual(User.query.get(self.u1_id).following_count, 0)
+            self.assertEqual(User.query.get(self.u2_id).followers_count, 0)
+
+
+    def test_user_follow_updates_timeline(self):
+        """ tests following adds, and unfollowing removes, the followed
+        user's messages on the home timeline """
+
+        db.session.add(Message(text="u2-message", user_id=self.u2_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}")
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn('u2-message', html)
+
+            c.post(f"/users/stop-following/{self.u2_id}")
+            html = c.get("/").get_data(as_text=True)
+            self.assertNotIn('u2-message', html)
+
+
     def test_render_profile(self):
         """ renders profile for specified user """
 
@@ -303,6 +500,29 @@ class BaseViewTestCase(TestCase):
             self.assertIn('test@test2.com', html)
 
 
+    def test_edit_profile_refreshes_cached_messages(self):
+        """ checks cached message HTML shows the author's new username """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "cached message"})
+            html = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+            self.assertIn('@u1<', html)
+
+            c.post(f"/users/profile", data={"username": "renamed_u1",
+                                            "email": "renamed@email.com",
+                                            "image_url": "",
+                                            "header_image_url": "",
+                                            "bio": "renamed",
+                                            "password": "password"})
+
+            html = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+            self.assertIn('@renamed_u1<', html)
+            self.assertNotIn('@u1<', html)
+
+
     def test_delete_user(self):
         """checks if user is deleted successfully and redirects to correct page """
 
@@ -321,6 +541,123 @@ class BaseViewTestCase(TestCase):
             self.assertIsNone(user)
 
 
+    def test_delete_big_account_purges_in_background(self):
+        """checks a big account is hidden at once, then purged in batches
+        with everyone else's counts fixed """
+
+        m1 = Message(text="m1", user_id=self.u1_id)
+        m2 = Message(text="m2", user_id=self.u1_id)
+        m3 = Message(text="m3", user_id=self.u2_id)
+        db.session.add_all([
+            m1, m2, m3,
+            Follows(user_being_followed_id=self.u1_id,
+                    user_following_id=self.u2_id),
+            Follows(user_being_followed_id=self.u2_id,
+                    user_following_id=self.u1_id)])
+        db.session.flush()
+        apply_likes({(self.u2_id, m1.id): True, (self.u1_id, m3.id): True})
+        TimelineEntry.fan_out(m1)
+        TimelineEntry.fan_out(m3)
+        db.session.add(FollowSuggestion(
+            user_id=self.u2_id, suggested_id=self.u1_id, score=1))
+        User.recount()
+        db.session.commit()
+        m3_id = m3.id
+
+        app.config['ACCOUNT_PURGE_THRESHOLD'] = 0
+        app.config['PURGE_BATCH_SIZE'] = 1
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                c.post("/users/delete")
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                resp = c.get(f"/users/{self.u1_id}")
+                self.assertEqual(resp.status_code, 404)
+
+            for thread in threading.enumerate():
+                if thread.name == f'purge-user-{self.u1_id}':
+                    thread.join()
+        finally:
+            app.config['ACCOUNT_PURGE_THRESHOLD'] = 10000
+            app.config['PURGE_BATCH_SIZE'] = 1000
+
+        db.session.expire_all()
+        u2 = User.query.get(self.u2_id)
+
+        self.assertIsNone(User.query.get(self.u1_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(),
+                         0)
+        self.assertEqual((u2.followers_count, u2.following_count,
+                          u2.likes_count), (0, 0, 0))
+        self.assertEqual(Message.query.get(m3_id).likes_count, 0)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.u1_id).count(), 0)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(author_id=self.u1_id).count(), 0)
+        self.assertEqual(FollowSuggestion.query.count(), 0)
+
+
+    def test_delete_user_bumps_follow_pages(self):
+        """checks deleting a user bumps the versions of everyone on either
+        side of their follows before the purge gets to them """
+
+        db.session.add(Follows(user_being_followed_id=self.u1_id,
+                               user_following_id=self.u2_id))
+        User.recount()
+        db.session.commit()
+        version = User.query.get(self.u2_id).version
+
+        config = {'ACCOUNT_PURGE_THRESHOLD': 0, 'JOBS_EAGER': False}
+        saved = {key: app.config[key] for key in config}
+        app.config.update(config)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                c.post("/users/delete")
+        finally:
+            app.config.update(saved)
+            Job.query.delete()
+            db.session.commit()
+
+        db.session.expire_all()
+        self.assertIsNotNone(User.query.get(self.u1_id).deleted_at)
+        self.assertGreater(User.query.get(self.u2_id).version, version)
+
+
+    def test_overlapping_purges_count_once(self):
+        """checks follows another purge deleted first aren't taken off the
+        counts again """
+
+        db.session.add(Follows(user_being_followed_id=self.u1_id,
+                               user_following_id=self.u2_id))
+        User.recount()
+        db.session.commit()
+
+        batches = purge._batches
+        # both purges select the same batch
+        purge._batches = lambda query: iter([query.all()] * 2)
+
+        try:
+            with app.app_context():
+                purge._purge_follows(
+                    self.u1_id, Follows.user_being_followed_id,
+                    Follows.user_following_id, 'following_count')
+        finally:
+            purge._batches = batches
+
+        db.session.expire_all()
+        self.assertEqual(User.query.get(self.u2_id).following_count, 0)
+
+
     def test_show_liked_message(self):
         """ renders template for user's liked message page """
 
@@ -333,4 +670,87 @@ class BaseViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertIn('<ul class="list-group', html)
-            self.assertIn('liked message test', html)
\ No newline at end of file
+            self.assertIn('liked message test', html)
+
+
+    def test_static_files_fingerprinted(self):
+        """ checks static URLs carry a content hash and are cached for good """
+
+        with self.client as c:
+            html = c.get("/signup").get_data(as_text=True)
+            url = re.search(r'/static/stylesheets/style.css\?v=\w+', html)[0]
+
+            resp = c.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+
+            resp = c.get("/static/stylesheets/style.css?v=stale")
+            self.assertNotIn('immutable', resp.headers['Cache-Control'])
+            self.assertNotIn('no-store', resp.headers['Cache-Control'])
+
+
+    def test_profile_not_modified(self):
+        """ checks repeat profile views get a 304 until the data changes """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/users/{self.u2_id}")
+            etag = resp.headers['ETag']
+            self.assertIn('no-cache', resp.headers['Cache-Control'])
+            self.assertIn('Last-Modified', resp.headers)
+
+            resp = c.get(f"/users/{self.u2_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+
+            c.post(f"/users/follow/{self.u2_id}")
+
+            resp = c.get(f"/users/{self.u2_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+
+    def test_reads_go_to_replica(self):
+        """ checks GET reads use the replica, except just after a POST """
+
+        with TemporaryDirectory() as directory:
+            uri = f"sqlite:///{directory}/replica.db"
+            replica = create_engine(uri)
+            db.metadata.create_all(replica)
+
+            # the replica's copies of the users have different usernames
+            rows = [dict(row) for row in
+                    db.session.execute(User.__table__.select()).mappings()]
+            for row in rows:
+                row['username'] = f"replica_{row['username']}"
+            with replica.begin() as conn:
+                conn.execute(User.__table__.insert(), rows)
+
+            app.config['SQLALCHEMY_REPLICA_URIS'] = [uri]
+
+            try:
+                with self.client as c:
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = self.u1_id
+
+                    html = c.get(f"/users/{self.u2_id}").get_data(as_text=True)
+                    self.assertIn('@replica_u2', html)
+
+                    c.post(f"/users/follow/{self.u2_id}")
+                    html = c.get(f"/users/{self.u2_id}").get_data(as_text=True)
+                    self.assertIn('@u2', html)
+
+                    with c.session_transaction() as sess:
+                        sess[routing.PRIMARY_UNTIL_KEY] = 0
+
+                    html = c.get(f"/users/{self.u2_id}").get_data(as_text=True)
+                    self.assertIn('@replica_u2', html)
+            finally:
+                app.config['SQLALCHEMY_REPLICA_URIS'] = []
+                routing.replica_engine(uri).dispose()
+                replica.dispose()